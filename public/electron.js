@@ -130,15 +130,23 @@ app.whenReady().then(async () => {
 
     createWindows();
 
-    // Show main window when backend is ready
-    backend.stderr.on('data', data => {
-        const log = data.toString();
-        logStream.write(`BACKEND STDERR: ${log}`);
-        if (log.includes('Tor hidden service started:') && splash) {
-            splash.close();
+    // Show the main window as soon as the backend answers at all. IPFS and
+    // Tor come up behind it; the app polls /ready for those.
+    const launched = Date.now();
+    const waitForBackend = async () => {
+        try {
+            await fetch('http://localhost:5000/ready');
+            logStream.write(`BACKEND ANSWERED after ${Date.now() - launched} ms\n`);
+            if (splash) {
+                splash.close();
+                splash = null;
+            }
             mainWindow.show();
+        } catch {
+            setTimeout(waitForBackend, 100);
         }
-    });
+    };
+    waitForBackend();
 });
 
 // Cleanup
@@ -0,0 +1,1119 @@
+"""Offline benchmarks for server_persistent.
+
+Runs the real server in-process against a fake IPFS HTTP API and a stubbed
+Tor controller, drives it over HTTP and writes the results as JSON:
+
+    python benchmark.py --output results.json
+    python benchmark.py --quick --scenarios upload download
+    python benchmark.py --compare baseline.json --output results.json
+
+Every scenario reports latency percentiles, throughput and the peak RSS of
+the process so far (server, fake IPFS and load generator together). The
+scaling scenario instead launches the server with WORKERS=1, 2, ... in a
+separate process and loads it from several client processes.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import glob
+import platform
+import random
+import secrets
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MiB = 1024 * 1024
+
+
+# ========== FAKE IPFS ==========
+
+
+class FakeIPFS:
+    """The part of the IPFS HTTP API the server uses, kept in memory.
+
+    With keep set to False added content is hashed and dropped, for runs
+    that measure the server's memory rather than the fake's.
+    """
+
+    def __init__(self):
+        self.keep = True
+        self.blobs = {}
+        self.pinned = set()
+        self.calls = {}
+        self.unpinned = 0
+
+    def _count(self, endpoint):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    async def version(self, request):
+        self._count("version")
+        return web.json_response({"Version": "fake"})
+
+    async def add(self, request):
+        self._count("add")
+        reader = await request.multipart()
+        part = await reader.next()
+        digest = hashlib.sha256()
+        data = bytearray()
+        size = 0
+        while chunk := await part.read_chunk(MiB):
+            digest.update(chunk)
+            size += len(chunk)
+            if self.keep:
+                data += chunk
+        ipfs_hash = "bafk" + digest.hexdigest()[:52]
+        if self.keep:
+            self.blobs[ipfs_hash] = bytes(data)
+        self.pinned.add(ipfs_hash)
+        return web.Response(
+            text=json.dumps({"Name": "blob", "Hash": ipfs_hash, "Size": str(size)})
+        )
+
+    async def cat(self, request):
+        self._count("cat")
+        data = self.blobs.get(request.query["arg"])
+        if data is None:
+            return web.Response(status=500, text="not found")
+        offset = int(request.query.get("offset", 0))
+        length = request.query.get("length")
+        end = len(data) if length is None else offset + int(length)
+        response = web.StreamResponse()
+        await response.prepare(request)
+        view = memoryview(data)[offset:end]
+        for i in range(0, len(view), 256 * 1024):
+            await response.write(view[i : i + 256 * 1024])
+        await response.write_eof()
+        return response
+
+    async def stat(self, request):
+        self._count("files/stat")
+        ipfs_hash = request.query["arg"].rsplit("/", 1)[-1]
+        if ipfs_hash not in self.blobs:
+            return web.Response(status=500, text="not found")
+        return web.json_response({"Hash": ipfs_hash, "Size": len(self.blobs[ipfs_hash])})
+
+    async def pin_rm(self, request):
+        self._count("pin/rm")
+        hashes = request.query.getall("arg", [])
+        self.unpinned += len(hashes)
+        for ipfs_hash in hashes:
+            self.pinned.discard(ipfs_hash)
+            self.blobs.pop(ipfs_hash, None)
+        return web.json_response({"Pins": hashes})
+
+    def app(self):
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post("/api/v0/version", self.version)
+        app.router.add_post("/api/v0/add", self.add)
+        app.router.add_post("/api/v0/cat", self.cat)
+        app.router.add_post("/api/v0/files/stat", self.stat)
+        app.router.add_post("/api/v0/pin/rm", self.pin_rm)
+        return app
+
+
+class StubHiddenService:
+    service_id = "benchmarkbenchmarkbenchmarkbenchmarkbenchmarkbenchmark"
+
+
+async def serve(app, **kwargs):
+    runner = web.AppRunner(app, access_log=None, **kwargs)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+# ========== MEASUREMENT ==========
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (MiB if sys.platform == "darwin" else 1024), 1)
+
+
+def latency_stats(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "n": len(ordered),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def throughput(total_bytes, seconds):
+    return round(total_bytes / seconds / 1e6, 2) if seconds else None
+
+
+def size_label(size):
+    return f"{size // MiB}MiB" if size >= MiB else f"{size // 1024}KiB"
+
+
+def text_corpus(size, seed=1):
+    """Prose-like text over a fixed vocabulary"""
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choice("etaoinshrdlcumwfgypbvk") for _ in range(rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    out = []
+    length = 0
+    while length < size:
+        sentence = " ".join(rng.choices(words, k=rng.randint(5, 20))).capitalize()
+        out.append(sentence + ". ")
+        length += len(out[-1])
+    return "".join(out).encode()[:size]
+
+
+def log_corpus(size, seed=2):
+    """Access-log lines with timestamps, ids, statuses and timings"""
+    rng = random.Random(seed)
+    routes = ["/download/{}", "/status/{}", "/upload", "/history", "/events"]
+    out = []
+    length = 0
+    t = 1_790_000_000.0
+    while length < size:
+        t += rng.expovariate(50)
+        route = rng.choice(routes).format(secrets.token_urlsafe(16))
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t))
+        client = f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        line = (
+            f"{stamp}.{int(t % 1 * 1000):03d}Z INFO worker-{rng.randint(0, 7)} {client} "
+            f'"GET {route} HTTP/1.1" {rng.choice([200, 200, 200, 206, 304, 403, 429])} '
+            f"{rng.randint(0, 10**7)} {rng.uniform(0.1, 900):.1f}ms\n"
+        )
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+
+def binary_corpus(size):
+    """Shared libraries and executables of this Python installation"""
+    paths = [sys.executable] + sorted(
+        glob.glob(os.path.join(sys.base_prefix, "lib", "**", "*.so*"), recursive=True)
+    )
+    out = bytearray()
+    for path in paths:
+        if len(out) >= size:
+            break
+        try:
+            with open(path, "rb") as f:
+                out += f.read(size - len(out))
+        except OSError:
+            pass
+    return bytes(out)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def setup_worker():
+    """Run in each server worker of the scaling scenario before it serves"""
+    import server_persistent as sp
+
+    sp.start_tor_service = lambda: StubHiddenService()
+    if os.environ.get("DFS_BENCH_RATE_LIMITS"):
+        # Every request still takes its tokens, but no bucket ever runs out
+        for policy in sp.RATE_LIMIT_POLICIES.values():
+            for scope, (_, period) in policy.items():
+                policy[scope] = (10**9, period)
+    else:
+        sp.RATE_LIMIT_POLICIES.clear()
+
+
+def generate_load(url, kind, size, share_id, clients, repeats):
+    """One load-generating process: seconds taken by each request"""
+
+    async def drive():
+        samples = []
+        data = os.urandom(size)
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None)
+        ) as session:
+            bench = Bench(None, url, None, None)
+            bench.session = session
+
+            async def client():
+                for _ in range(repeats):
+                    started = time.perf_counter()
+                    if kind == "upload":
+                        # Fresh bytes up front defeat deduplication
+                        await bench.upload(os.urandom(8) + data[8:])
+                    else:
+                        _, _, received = await bench.download(share_id)
+                        assert received == size, (received, size)
+                    samples.append(time.perf_counter() - started)
+
+            await asyncio.gather(*[client() for _ in range(clients)])
+        return samples
+
+    return asyncio.run(drive())
+
+
+# ========== SCENARIOS ==========
+
+
+class BaselineStore:
+    """The metadata store as it was before the pooled WAL store: a new
+    connection per call, the default rollback journal, a separate check and
+    increment, and every call blocking the event loop"""
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(path) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS share_metadata (
+                    share_id TEXT PRIMARY KEY,
+                    ipfs_hash TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    content_type TEXT NOT NULL,
+                    private_key TEXT NOT NULL,
+                    max_downloads INTEGER NOT NULL,
+                    download_count INTEGER NOT NULL DEFAULT 0,
+                    active INTEGER NOT NULL DEFAULT 1,
+                    expires_at REAL NOT NULL,
+                    magnet_created INTEGER NOT NULL DEFAULT 0
+                )
+            """
+            )
+
+    async def claim(self, share_id):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute(
+                "SELECT active, download_count, max_downloads, expires_at "
+                "FROM share_metadata WHERE share_id = ?",
+                (share_id,),
+            ).fetchone()
+            if not row or not row[0] or row[1] >= row[2] or time.time() > row[3]:
+                raise ValueError("Download refused")
+        with sqlite3.connect(self.path) as conn:
+            count, max_downloads = conn.execute(
+                "SELECT download_count, max_downloads "
+                "FROM share_metadata WHERE share_id = ?",
+                (share_id,),
+            ).fetchone()
+            conn.execute(
+                "UPDATE share_metadata SET download_count = ?, active = ? "
+                "WHERE share_id = ?",
+                (count + 1, 0 if count + 1 >= max_downloads else 1, share_id),
+            )
+            conn.commit()
+
+    async def history(self):
+        # The same page the pooled store serves, so only the store differs
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(
+                """
+                SELECT share_id, filename, max_downloads, download_count, active,
+                       expires_at, magnet_created
+                FROM share_metadata ORDER BY expires_at DESC LIMIT 101
+            """
+            ).fetchall()
+
+
+class Bench:
+    def __init__(self, sp, base_url, fake_ipfs, args):
+        self.sp = sp
+        self.url = base_url
+        self.ipfs = fake_ipfs
+        self.args = args
+        self.session = None
+
+    async def wait_ready(self, launched):
+        """Seconds from launch to the first answer and until /ready says 200"""
+        first_response = None
+        while True:
+            async with self.session.get(f"{self.url}/ready") as resp:
+                if first_response is None:
+                    first_response = time.perf_counter() - launched
+                if resp.status == 200:
+                    return {
+                        "first_response_s": round(first_response, 3),
+                        "ready_s": round(time.perf_counter() - launched, 3),
+                    }
+            await asyncio.sleep(0.01)
+
+    async def upload(
+        self,
+        data,
+        max_downloads=1,
+        filename="bench.bin",
+        content_type="application/octet-stream",
+    ):
+        form = aiohttp.FormData()
+        form.add_field("files", data, filename=filename, content_type=content_type)
+        async with self.session.post(
+            f"{self.url}/upload?max_downloads={max_downloads}", data=form
+        ) as resp:
+            body = await resp.json()
+            if resp.status != 200:
+                raise RuntimeError(f"Upload failed: {resp.status} {body}")
+            return body["share_links"][0]["share_id"]
+
+    async def stream_upload(self, size, started):
+        """Seconds to upload size random bytes, generated as they are sent.
+        started is set once the first MiB has gone out."""
+        block = os.urandom(MiB)
+
+        async def body():
+            sent = 0
+            while sent < size:
+                chunk = block[: size - sent]
+                yield chunk
+                sent += len(chunk)
+                started.set()
+
+        begun = time.perf_counter()
+        with aiohttp.MultipartWriter("form-data") as writer:
+            part = writer.append(body())
+            part.set_content_disposition("form-data", name="files", filename="big.bin")
+            async with self.session.post(f"{self.url}/upload", data=writer) as resp:
+                if resp.status != 200:
+                    body = await resp.text()
+                    raise RuntimeError(f"Upload failed: {resp.status} {body}")
+        return time.perf_counter() - begun
+
+    async def download(self, share_id):
+        """(seconds to first byte, total seconds, bytes)"""
+        started = time.perf_counter()
+        first = None
+        received = 0
+        async with self.session.get(f"{self.url}/download/{share_id}") as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"Download failed: {resp.status} {await resp.text()}")
+            async for chunk in resp.content.iter_any():
+                if first is None:
+                    first = time.perf_counter() - started
+                received += len(chunk)
+        return first or 0, time.perf_counter() - started, received
+
+    async def rtc_download(self, share_id):
+        """(total seconds, bytes) of a download over a WebRTC data channel"""
+        pc = RTCPeerConnection()
+        channel = pc.createDataChannel("file")
+        done = asyncio.get_running_loop().create_future()
+        received = 0
+
+        @channel.on("message")
+        def on_message(message):
+            nonlocal received
+            if isinstance(message, bytes):
+                received += len(message)
+                return
+            message = json.loads(message)
+            if message["type"] == "meta":
+                # The server counts the download, and starts sending, on this
+                channel.send(json.dumps({"type": "ack"}))
+            elif message["type"] == "done":
+                done.set_result(None)
+            elif message["type"] == "error":
+                done.set_exception(RuntimeError(message["error"]))
+
+        started = time.perf_counter()
+        try:
+            await pc.setLocalDescription(await pc.createOffer())
+            offer = {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+            async with self.session.post(
+                f"{self.url}/signal/{share_id}", data=json.dumps(offer)
+            ) as resp:
+                answer = await resp.json()
+                if resp.status != 200:
+                    raise RuntimeError(f"Signalling failed: {resp.status} {answer}")
+            await pc.setRemoteDescription(RTCSessionDescription(**answer))
+            await done
+        finally:
+            await pc.close()
+        return time.perf_counter() - started, received
+
+    async def scenario_upload(self):
+        results = {}
+        for size in self.args.sizes:
+            data = bytearray(os.urandom(size))
+            samples = []
+            for _ in range(self.args.repeats):
+                data[:8] = os.urandom(8)  # defeat deduplication
+                started = time.perf_counter()
+                await self.upload(bytes(data))
+                samples.append(time.perf_counter() - started)
+            results[size_label(size)] = {
+                "latency": latency_stats(samples),
+                "mb_per_s": throughput(size * len(samples), sum(samples)),
+            }
+        return results
+
+    async def scenario_download(self):
+        results = {}
+        for size in self.args.sizes:
+            share_id = await self.upload(os.urandom(size), max_downloads=10**6)
+            firsts, totals = [], []
+            for _ in range(self.args.repeats):
+                first, total, received = await self.download(share_id)
+                assert received == size, (received, size)
+                firsts.append(first)
+                totals.append(total)
+            results[size_label(size)] = {
+                "ttfb": latency_stats(firsts),
+                "latency": latency_stats(totals),
+                "mb_per_s": throughput(size * len(totals), sum(totals)),
+            }
+        return results
+
+    async def scenario_webrtc(self):
+        """Loopback data-channel downloads against HTTP downloads of the same
+        share (plain HTTP here; over Tor it is far slower still)"""
+        results = {}
+        for size in self.args.sizes:
+            share_id = await self.upload(os.urandom(size), max_downloads=10**6)
+            rtc, http = [], []
+            for _ in range(self.args.repeats):
+                total, received = await self.rtc_download(share_id)
+                assert received == size, (received, size)
+                rtc.append(total)
+                http.append((await self.download(share_id))[1])
+            results[size_label(size)] = {
+                "latency": latency_stats(rtc),
+                "mb_per_s": throughput(size * len(rtc), sum(rtc)),
+                "http_mb_per_s": throughput(size * len(http), sum(http)),
+            }
+        return results
+
+    async def scenario_compression(self):
+        """Stored and transferred bytes against CPU, per content and codec"""
+        size = self.args.compression_size
+        corpora = {
+            "text": (text_corpus(size), "text/plain"),
+            "logs": (log_corpus(size), "text/plain"),
+            "binary": (binary_corpus(size), "application/octet-stream"),
+            "random": (os.urandom(size), "application/octet-stream"),
+        }
+        modes = {"off": "off", "deflate": "deflate"}
+        if self.sp.zstandard:
+            modes["zstd"] = "auto"
+        results = {"size": size}
+        async with aiohttp.ClientSession(
+            auto_decompress=False, timeout=aiohttp.ClientTimeout(total=None)
+        ) as raw:
+            for corpus, (data, content_type) in corpora.items():
+                results[corpus] = {"bytes": len(data)}
+                for label, mode in modes.items():
+                    self.sp.COMPRESSION = mode
+                    stored_before = sum(map(len, self.ipfs.blobs.values()))
+                    cpu = time.process_time()
+                    started = time.perf_counter()
+                    # A fresh first byte keeps deduplication out of it
+                    sample = os.urandom(1) + data[1:]
+                    share_id = await self.upload(
+                        sample, max_downloads=10, content_type=content_type
+                    )
+                    upload_s = time.perf_counter() - started
+                    upload_cpu = time.process_time() - cpu
+                    stored = sum(map(len, self.ipfs.blobs.values())) - stored_before
+                    metadata = await self.sp.share_metadata.get_metadata(share_id)
+                    codec = metadata["codec"]
+
+                    # Warm the blob cache so both downloads below start equal
+                    async with raw.get(f"{self.url}/download/{share_id}") as resp:
+                        await resp.read()
+                    started = time.perf_counter()
+                    async with raw.get(
+                        f"{self.url}/download/{share_id}",
+                        headers={"Accept-Encoding": codec or "identity"},
+                    ) as resp:
+                        wire = len(await resp.read())
+                    passthrough_s = time.perf_counter() - started
+                    cpu = time.process_time()
+                    started = time.perf_counter()
+                    async with raw.get(
+                        f"{self.url}/download/{share_id}",
+                        headers={"Accept-Encoding": "identity"},
+                    ) as resp:
+                        assert await resp.read() == sample
+                    decoded_s = time.perf_counter() - started
+                    decoded_cpu = time.process_time() - cpu
+                    # A resume near the end decodes only the frames it covers
+                    started = time.perf_counter()
+                    async with raw.get(
+                        f"{self.url}/download/{share_id}",
+                        headers={"Range": "bytes=-65536"},
+                    ) as resp:
+                        assert await resp.read() == sample[-65536:]
+                    tail_s = time.perf_counter() - started
+
+                    results[corpus][label] = {
+                        "codec": codec,
+                        "stored_bytes": stored,
+                        "wire_bytes": wire,
+                        "saved_pct": round((1 - wire / len(data)) * 100, 1),
+                        "upload_s": round(upload_s, 3),
+                        "upload_cpu_s": round(upload_cpu, 3),
+                        "download_s": round(passthrough_s, 3),
+                        "decoded_download_s": round(decoded_s, 3),
+                        "decoded_download_cpu_s": round(decoded_cpu, 3),
+                        "tail_range_ms": round(tail_s * 1000, 2),
+                    }
+        self.sp.COMPRESSION = "auto"
+        return results
+
+    async def download_clients(self, share_id, size):
+        """Latency and throughput of --clients concurrent downloaders"""
+        samples = []
+
+        async def client():
+            for _ in range(self.args.repeats):
+                _, total, _ = await self.download(share_id)
+                samples.append(total)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(self.args.clients)])
+        elapsed = time.perf_counter() - started
+        return {
+            "latency": latency_stats(samples),
+            "aggregate_mb_per_s": throughput(size * len(samples), elapsed),
+        }
+
+    async def scenario_concurrent(self):
+        """Concurrent downloads on their own, then while a large upload streams
+        in and competes with them for the loop and the crypto workers"""
+        size = self.args.concurrent_size
+        share_id = await self.upload(os.urandom(size), max_downloads=10**6)
+        # Fill the blob and key caches, so both rounds start warm
+        await self.download(share_id)
+        results = {
+            "clients": self.args.clients,
+            "size": size,
+            **await self.download_clients(share_id, size),
+        }
+
+        upload_size = self.args.background_upload_size
+        started = asyncio.Event()
+        # The fake daemon only hashes what the upload adds
+        self.ipfs.keep = False
+        try:
+            upload = asyncio.create_task(self.stream_upload(upload_size, started))
+            waiter = asyncio.create_task(started.wait())
+            await asyncio.wait([upload, waiter], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            loaded = await self.download_clients(share_id, size)
+            # False if the upload finished first: the downloads were not all under load
+            overlapped = not upload.done()
+            upload_seconds = await upload
+        finally:
+            self.ipfs.keep = True
+        results["with_upload"] = {
+            "upload_size": upload_size,
+            "overlapped": overlapped,
+            **loaded,
+            "upload_mb_per_s": throughput(upload_size, upload_seconds),
+        }
+        return results
+
+    def seed_shares(self, count, expires_at, path=None, max_downloads=1):
+        """Insert share rows straight into the database, returning their IDs"""
+        share_ids = [secrets.token_urlsafe(16) for _ in range(count)]
+        conn = sqlite3.connect(path or self.sp.METADATA_DB, timeout=30)
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO share_metadata (share_id, ipfs_hash, filename, content_type,
+                                            private_key, max_downloads, expires_at)
+                VALUES (?, ?, 'seed.bin', 'application/octet-stream', '', ?, ?)
+            """,
+                [
+                    (share_id, "bafkseed" + share_id, max_downloads, expires_at(i))
+                    for i, share_id in enumerate(share_ids)
+                ],
+            )
+        conn.close()
+        return share_ids
+
+    async def timed(self, request, repeats):
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            async with request() as resp:
+                await resp.read()
+                if resp.status not in (200, 206, 304):
+                    raise RuntimeError(f"{resp.url}: {resp.status}")
+            samples.append(time.perf_counter() - started)
+        return latency_stats(samples)
+
+    async def scenario_polling(self):
+        now = time.time()
+        share_ids = self.seed_shares(
+            self.args.rows, lambda i: now + 3600 + i % 86400
+        )
+        repeats = self.args.repeats * 10
+        page = await self.timed(
+            lambda: self.session.get(f"{self.url}/history?limit=100"), repeats
+        )
+        async with self.session.get(f"{self.url}/history?limit=100") as resp:
+            cursor = resp.headers.get("X-Next-Cursor")
+            revision = resp.headers.get("X-Revision")
+        deep = await self.timed(
+            lambda: self.session.get(f"{self.url}/history?limit=100&cursor={cursor}"),
+            repeats,
+        )
+        unchanged = await self.timed(
+            lambda: self.session.get(f"{self.url}/history?limit=100&since={revision}"),
+            repeats,
+        )
+        sample = share_ids[: self.sp.STATUS_MAX_IDS]
+        bulk = await self.timed(
+            lambda: self.session.post(
+                f"{self.url}/status",
+                data=json.dumps({"share_ids": sample}),
+                headers={"Content-Type": "text/plain"},
+            ),
+            repeats,
+        )
+        single = await self.timed(
+            lambda: self.session.get(f"{self.url}/status/{share_ids[len(share_ids) // 2]}"),
+            repeats,
+        )
+        return {
+            "rows": self.args.rows,
+            "history_first_page": page,
+            "history_next_page": deep,
+            "history_unchanged": unchanged,
+            f"bulk_status_{len(sample)}": bulk,
+            "single_status": single,
+        }
+
+    async def db_workload(self, claim, history, share_ids):
+        """Concurrent clients claiming downloads, every fourth call a history
+        page, while a ticker measures how long the event loop is held up"""
+        claims, pages = [], []
+        lag = [0]
+        tick = [time.perf_counter()]
+
+        async def ticker():
+            while True:
+                tick[0] = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lag.append(time.perf_counter() - tick[0] - 0.001)
+
+        async def client(n):
+            rng = random.Random(n)
+            for i in range(self.args.repeats * 20):
+                started = time.perf_counter()
+                if i % 4 == 3:
+                    await history()
+                    pages.append(time.perf_counter() - started)
+                else:
+                    await claim(rng.choice(share_ids))
+                    claims.append(time.perf_counter() - started)
+
+        ticking = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await asyncio.gather(*[client(n) for n in range(self.args.clients)])
+        elapsed = time.perf_counter() - started
+        # Calls that never yield keep the ticker from running at all
+        lag.append(time.perf_counter() - tick[0] - 0.001)
+        ticking.cancel()
+        return {
+            "claim": latency_stats(claims),
+            "history_page": latency_stats(pages),
+            "ops_per_s": round((len(claims) + len(pages)) / elapsed, 1),
+            "loop_lag_max_ms": round(max(lag) * 1000, 2),
+        }
+
+    async def scenario_database(self):
+        """The original metadata store's access pattern against the pooled
+        WAL store, under the same concurrent claims and history reads"""
+        workdir = os.path.dirname(os.path.abspath(self.sp.METADATA_DB))
+        rows = self.args.db_rows
+        expires = time.time() + 86400
+        results = {"rows": rows, "clients": self.args.clients}
+
+        baseline = BaselineStore(os.path.join(workdir, "baseline.db"))
+        share_ids = self.seed_shares(
+            rows, lambda i: expires + i, baseline.path, max_downloads=10**9
+        )
+        results["baseline"] = await self.db_workload(
+            baseline.claim, baseline.history, share_ids
+        )
+
+        pooled = self.sp.ShareMetadata(db_path=os.path.join(workdir, "pooled.db"))
+        try:
+            share_ids = self.seed_shares(
+                rows, lambda i: expires + i, pooled.db_path, max_downloads=10**9
+            )
+            results["pooled"] = await self.db_workload(
+                pooled.claim_download, lambda: pooled.list_shares(limit=100), share_ids
+            )
+        finally:
+            pooled.close()
+        return results
+
+    async def scenario_probes(self):
+        """HEAD and /meta against a one-byte ranged GET, the cheapest request
+        that has to fetch and decrypt"""
+        share_id = await self.upload(
+            os.urandom(self.args.concurrent_size), max_downloads=10**6
+        )
+        url = f"{self.url}/download/{share_id}"
+        repeats = self.args.repeats * 10
+        calls_before = sum(self.ipfs.calls.values())
+        head = await self.timed(lambda: self.session.head(url), repeats)
+        meta = await self.timed(
+            lambda: self.session.get(f"{self.url}/meta/{share_id}"), repeats
+        )
+        probe_calls = sum(self.ipfs.calls.values()) - calls_before
+        counted = (await self.sp.share_metadata.get_metadata(share_id))["download_count"]
+        ranged = await self.timed(
+            lambda: self.session.get(url, headers={"Range": "bytes=0-0"}), repeats
+        )
+        return {
+            "size": self.args.concurrent_size,
+            "head": head,
+            "meta": meta,
+            "range_1_byte": ranged,
+            "probe_ipfs_calls": probe_calls,
+            "probe_downloads_counted": counted,
+        }
+
+    async def scenario_cleanup(self):
+        now = time.time()
+        rows = self.args.cleanup_rows
+        self.seed_shares(rows, lambda i: now - 1 - i % 3600)
+        unpinned_before = self.ipfs.unpinned
+        calls_before = self.ipfs.calls.get("pin/rm", 0)
+
+        scheduler = self.sp.expiry_scheduler
+        target = scheduler.reaped + rows
+        started = time.perf_counter()
+        await scheduler.rescan()
+        # The counter moves once a batch is both committed and unpinned
+        while scheduler.reaped < target:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        return {
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_s": round(rows / elapsed, 1),
+            "unpinned": self.ipfs.unpinned - unpinned_before,
+            "pin_rm_calls": self.ipfs.calls.get("pin/rm", 0) - calls_before,
+        }
+
+    async def load(self, pool, url, kind, share_id=None):
+        """Throughput of clients spread over the load processes"""
+        processes = self.args.load_processes
+        per_process = max(1, self.args.clients // processes)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        batches = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    pool,
+                    generate_load,
+                    url,
+                    kind,
+                    self.args.concurrent_size,
+                    share_id,
+                    per_process,
+                    self.args.repeats,
+                )
+                for _ in range(processes)
+            ]
+        )
+        elapsed = time.perf_counter() - started
+        samples = [sample for batch in batches for sample in batch]
+        return {
+            "latency": latency_stats(samples),
+            "mb_per_s": throughput(self.args.concurrent_size * len(samples), elapsed),
+        }
+
+    async def wait_workers(self, url, workers, process):
+        """Until every worker answers /ready with 200"""
+        connector = aiohttp.TCPConnector(force_close=True)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Each connection goes to whichever worker accepts it first, so
+            # wait for a run of answers long enough to have met them all
+            streak = 0
+            while streak < workers * 10:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Server exited with {process.returncode}")
+                try:
+                    async with session.get(f"{url}/ready") as resp:
+                        streak = streak + 1 if resp.status == 200 else 0
+                except aiohttp.ClientConnectionError:
+                    streak = 0
+                if not streak:
+                    await asyncio.sleep(0.05)
+
+    async def scenario_scaling(self):
+        results = {}
+        size = self.args.concurrent_size
+        with ProcessPoolExecutor(self.args.load_processes) as pool:
+            for workers in self.args.workers:
+                print(f"  {workers} worker(s)", file=sys.stderr)
+                port = free_port()
+                url = f"http://127.0.0.1:{port}"
+                with tempfile.TemporaryDirectory(prefix="dfs-bench-") as workdir:
+                    env = dict(
+                        os.environ,
+                        METADATA_DB=os.path.join(workdir, "metadata.db"),
+                        BLOB_CACHE_DIR=os.path.join(workdir, "blob-cache"),
+                        UPLOAD_SPOOL_DIR=os.path.join(workdir, "upload-spool"),
+                        DFS_BENCH_RATE_LIMITS="1" if self.args.rate_limits else "",
+                    )
+                    process = subprocess.Popen(
+                        [
+                            sys.executable,
+                            os.path.abspath(__file__),
+                            "--serve-workers",
+                            str(workers),
+                            "--port",
+                            str(port),
+                        ],
+                        env=env,
+                    )
+                    try:
+                        await self.wait_workers(url, workers, process)
+                        upload = await self.load(pool, url, "upload")
+                        seed = Bench(self.sp, url, None, self.args)
+                        seed.session = self.session
+                        share_id = await seed.upload(
+                            os.urandom(size), max_downloads=10**6
+                        )
+                        download = await self.load(pool, url, "download", share_id)
+                    finally:
+                        process.terminate()
+                        process.wait()
+                results[f"{workers}_workers"] = {"upload": upload, "download": download}
+
+        base = results[f"{self.args.workers[0]}_workers"]
+        for result in results.values():
+            for kind in ("upload", "download"):
+                result[kind]["speedup"] = round(
+                    result[kind]["mb_per_s"] / base[kind]["mb_per_s"], 2
+                )
+        return {
+            "size": size,
+            "clients": self.args.load_processes
+            * max(1, self.args.clients // self.args.load_processes),
+            "load_processes": self.args.load_processes,
+            **results,
+        }
+
+
+SCENARIOS = [
+    "upload",
+    "download",
+    "webrtc",
+    "compression",
+    "concurrent",
+    "database",
+    "polling",
+    "probes",
+    "cleanup",
+    "scaling",
+]
+
+
+# ========== RUNNER ==========
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args, workdir):
+    fake_ipfs = FakeIPFS()
+    # Kubo accepts request lines far longer than aiohttp's default
+    ipfs_runner, ipfs_url = await serve(fake_ipfs.app(), max_line_size=MiB)
+
+    # The server reads its configuration at import time
+    os.environ["IPFS_API_URL"] = f"{ipfs_url}/api/v0"
+    os.environ["METADATA_DB"] = os.path.join(workdir, "metadata.db")
+    os.environ["BLOB_CACHE_DIR"] = os.path.join(workdir, "blob-cache")
+    os.environ["UPLOAD_SPOOL_DIR"] = os.path.join(workdir, "upload-spool")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server_persistent as sp
+
+    sp.start_tor_service = lambda: StubHiddenService()
+    # Everything is on loopback here, so no address is exposed
+    sp.RTC_ENABLED = True
+    if not args.rate_limits:
+        sp.RATE_LIMIT_POLICIES.clear()
+
+    launched = time.perf_counter()
+    server_runner, server_url = await serve(sp.app)
+    bench = Bench(sp, server_url, fake_ipfs, args)
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "crypto_executor": sp.CRYPTO_EXECUTOR,
+            "crypto_workers": sp.CRYPTO_WORKERS,
+            "sizes": args.sizes,
+            "repeats": args.repeats,
+        },
+        "scenarios": {},
+    }
+    try:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None)
+        ) as bench.session:
+            results["startup"] = await bench.wait_ready(launched)
+            for name in args.scenarios:
+                print(f"Running {name}...", file=sys.stderr)
+                started = time.perf_counter()
+                metrics = await getattr(bench, f"scenario_{name}")()
+                metrics["wall_seconds"] = round(time.perf_counter() - started, 3)
+                metrics["peak_rss_mb"] = peak_rss_mb()
+                results["scenarios"][name] = metrics
+        results["server_stats"] = {
+            "workers": sp.crypto_pool.stats(),
+            "blob_cache": sp.blob_cache.stats(),
+        }
+    finally:
+        await server_runner.cleanup()
+        await ipfs_runner.cleanup()
+    return results
+
+
+def flatten(tree, prefix=""):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, results):
+    """Print metrics that changed against an earlier results file"""
+    old = dict(flatten(baseline.get("scenarios", {})))
+    print(f"{'metric':60} {'before':>12} {'after':>12} {'change':>8}")
+    for key, value in flatten(results["scenarios"]):
+        if key in old and old[key] and not key.endswith(".n"):
+            change = (value - old[key]) / old[key] * 100
+            print(f"{key:60} {old[key]:>12} {value:>12} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[64 * 1024, MiB, 16 * MiB, 128 * MiB],
+        help="file sizes in bytes for the upload and download scenarios",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--concurrent-size", type=int, default=8 * MiB)
+    parser.add_argument(
+        "--background-upload-size",
+        type=int,
+        default=512 * MiB,
+        help="upload streamed during the second half of the concurrent scenario",
+    )
+    parser.add_argument("--compression-size", type=int, default=16 * MiB)
+    parser.add_argument("--rows", type=int, default=100_000, help="shares seeded for polling")
+    parser.add_argument(
+        "--db-rows",
+        type=int,
+        default=10_000,
+        help="shares seeded in each store for the database scenario",
+    )
+    parser.add_argument("--cleanup-rows", type=int, default=100_000)
+    parser.add_argument(
+        "--workers",
+        nargs="+",
+        type=int,
+        default=sorted({1, 2, os.cpu_count() or 1}),
+        help="worker counts for the scaling scenario",
+    )
+    parser.add_argument(
+        "--load-processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="client processes generating load in the scaling scenario",
+    )
+    parser.add_argument("--rate-limits", action="store_true", help="keep the rate limiter on")
+    parser.add_argument("--quick", action="store_true", help="small sizes and counts")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    # Used by the scaling scenario to launch the server under test
+    parser.add_argument("--serve-workers", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_workers:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import server_persistent as sp
+
+        sp.serve_workers(args.serve_workers, "127.0.0.1", args.port, setup=setup_worker)
+        return
+    if args.quick:
+        args.sizes = [64 * 1024, MiB, 8 * MiB]
+        args.repeats = 2
+        args.clients = 8
+        args.concurrent_size = MiB
+        args.background_upload_size = 64 * MiB
+        args.compression_size = 2 * MiB
+        args.rows = 10_000
+        args.db_rows = 1000
+        args.cleanup_rows = 10_000
+        args.workers = [1, 2]
+
+    with tempfile.TemporaryDirectory(prefix="dfs-bench-") as workdir:
+        results = asyncio.run(run(args, workdir))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["scenarios"], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
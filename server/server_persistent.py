@@ -1,12 +1,26 @@
 import hashlib
+import hmac
 import os
 import base64
 import secrets
 import json
 import asyncio
+import bisect
+import contextvars
 import logging
-import zipfile
-import ipfshttpclient
+import math
+import zlib
+import collections
+import heapq
+import ipaddress
+import mmap
+import shutil
+import signal
+import socket
+import struct
+import sys
+import urllib.parse
+import aiohttp
 from aiohttp import web, WSMsgType
 from aiohttp_sse import sse_response
 from stem.control import Controller
@@ -14,80 +28,882 @@ from aiortc import RTCPeerConnection, RTCSessionDescription, RTCDataChannel
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from io import BytesIO
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import tempfile
 import time
 from pathlib import Path
 from aiohttp.web_response import StreamResponse
 from aiohttp.web import HTTPRequestRangeNotSatisfiable, HTTPPartialContent
 import sqlite3
+import threading
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import zstandard
+except ImportError:  # optional, compression falls back to zlib
+    zstandard = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # IPFS client
-import time
-import ipfshttpclient
+IPFS_API_URL = os.environ.get("IPFS_API_URL", "http://127.0.0.1:5001/api/v0")
+IPFS_MAX_CONCURRENCY = 16  # short API calls (stat, pin, version) in flight
+IPFS_MAX_STREAMS = 32  # add/cat bodies in flight
+IPFS_TIMEOUT = 30  # seconds per short call, or between reads of a stream
+IPFS_RETRIES = 3
+IPFS_UNPIN_BATCH = 1000  # hashes per pin/rm call, they all go in the query string
 
-MAX_RETRIES = 10
-WAIT_SECONDS = 1
 
-for attempt in range(MAX_RETRIES):
-    try:
-        ipfs = ipfshttpclient.connect("/ip4/127.0.0.1/tcp/5001/http")
-        ipfs.version()  # quick test
-        break
-    except Exception as e:
-        print(f"IPFS not ready, retrying... ({attempt+1}/{MAX_RETRIES})")
-        time.sleep(WAIT_SECONDS)
-else:
-    raise Exception("Failed to connect to IPFS after several retries")
+class IPFSClient:
+    """Non-blocking client for the local IPFS daemon's HTTP API.
+
+    All calls share one pooled aiohttp session. Short calls are retried with
+    backoff on connection errors and timeouts; streamed add/cat calls are only
+    retried before their body starts flowing.
+    """
+
+    def __init__(
+        self,
+        api_url=IPFS_API_URL,
+        max_concurrency=IPFS_MAX_CONCURRENCY,
+        max_streams=IPFS_MAX_STREAMS,
+        timeout=IPFS_TIMEOUT,
+        retries=IPFS_RETRIES,
+    ):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+        self._calls = asyncio.Semaphore(max_concurrency)
+        self._streams = asyncio.Semaphore(max_streams)
+        self._pool_size = max_concurrency + max_streams
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _with_retries(self, attempt):
+        for n in range(self.retries + 1):
+            try:
+                return await attempt()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if n == self.retries:
+                    raise
+                logger.warning(f"IPFS call failed ({e!r}), retrying ({n+1}/{self.retries})")
+                await asyncio.sleep(0.2 * 2**n)
+
+    async def _call(self, endpoint, params=None, timeout=None):
+        async def attempt():
+            async with self._calls:
+                async with self.session.post(
+                    f"{self.api_url}/{endpoint}",
+                    params=params,
+                    timeout=aiohttp.ClientTimeout(total=timeout or self.timeout),
+                ) as resp:
+                    resp.raise_for_status()
+                    return await resp.json(content_type=None)
+
+        started = time.perf_counter()
+        try:
+            return await self._with_retries(attempt)
+        finally:
+            ipfs_call_seconds.observe(time.perf_counter() - started, endpoint)
+
+    async def version(self):
+        return await self._call("version")
+
+    async def stat_size(self, ipfs_hash):
+        stat = await self._call("files/stat", {"arg": f"/ipfs/{ipfs_hash}"})
+        return int(stat["Size"])
+
+    async def pin_rm(self, *ipfs_hashes):
+        """Unpin one or more hashes in a single API call"""
+        params = [("arg", h) for h in ipfs_hashes]
+        return await self._call("pin/rm", params)
+
+    async def add_stream(self, chunks):
+        """Add an async iterable of bytes as a streamed multipart body"""
+        with aiohttp.MultipartWriter("form-data") as writer:
+            part = writer.append(chunks)
+            part.set_content_disposition("form-data", name="file", filename="blob")
+            async with self._streams:
+                async with self.session.post(
+                    f"{self.api_url}/add",
+                    params={"pin": "true"},
+                    data=writer,
+                    timeout=aiohttp.ClientTimeout(sock_read=self.timeout * 10),
+                ) as resp:
+                    resp.raise_for_status()
+                    body = await resp.text()
+        # The add endpoint answers with one JSON object per line, the last is the root
+        return json.loads(body.strip().splitlines()[-1])["Hash"]
+
+    async def cat(self, ipfs_hash, offset=0, length=None):
+        """Stream (part of) an object without loading it into memory"""
+        params = {"arg": ipfs_hash, "offset": offset}
+        if length is not None:
+            params["length"] = length
+
+        async with self._streams:
+
+            async def attempt():
+                resp = await self.session.post(
+                    f"{self.api_url}/cat",
+                    params=params,
+                    timeout=aiohttp.ClientTimeout(sock_read=self.timeout),
+                )
+                if resp.status >= 400:
+                    resp.release()
+                    resp.raise_for_status()
+                return resp
+
+            resp = await self._with_retries(attempt)
+            try:
+                async for chunk in resp.content.iter_any():
+                    yield chunk
+            finally:
+                resp.release()
+
+
+ipfs = IPFSClient()
 
 
 # Tor service globals
 tor_service = None
 service_id = None
 
-# WebRTC peer connections
+# WebRTC transfers in progress, by id (see WEBRTC)
 pcs = {}
 
-# Upload progress and WebSocket tracking
-upload_progress_store = {}
-websocket_connections = {}
-
 # Constants
 MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DEFAULT_TTL = 24 * 60 * 60  # 24h
+METADATA_DB = os.environ.get("METADATA_DB", "metadata.db")
+# Processes serving port 5000 (see WORKERS). The supervisor in __main__ starts
+# WORKERS of them and passes each its index; any other process is alone.
+WORKER_INDEX = os.environ.get("DFS_WORKER_INDEX")
+WORKERS = int(os.environ.get("WORKERS", 1)) if WORKER_INDEX is not None else 1
+# One launch of the server, shared by its workers
+RUN_ID = os.environ.get("DFS_RUN_ID") or secrets.token_hex(8)
+LEADER_LOCK = METADATA_DB + ".leader"
+LEADER_POLL_INTERVAL = 1  # seconds between attempts to take over as leader
+BUS_POLL_INTERVAL = 0.1  # seconds between reads of messages from other workers
+BUS_RETAIN = 60  # seconds relayed messages are kept
+RATE_LIMIT_SYNC_INTERVAL = 0.25  # seconds between rate-limit usage sent to workers
+METRICS_SNAPSHOT_INTERVAL = 5  # seconds between metrics shared with other workers
+DB_THREADS = 4  # SQLite connections/threads serving queries
+HISTORY_MAX_LIMIT = 1000
+STATUS_MAX_IDS = 1000  # share IDs per bulk status request
+SHARE_EVENTS_HISTORY = 1000  # events kept for Last-Event-ID resume
+SHARE_EVENTS_QUEUE = 256  # events a slow /events client may lag behind
+EXPIRY_BATCH_WINDOW = 2  # seconds; shares due this close together are reaped together
+EXPIRY_HORIZON = 3600  # seconds of upcoming deadlines kept in memory
+PROGRESS_INTERVAL = 0.25  # seconds between progress updates for one upload
+PROGRESS_RETAIN = 1000  # finished uploads whose final state late subscribers can get
+# Local copies of the ciphertext of multi-download shares
+BLOB_CACHE_DIR = os.environ.get(
+    "BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dfs-blob-cache")
+)
+BLOB_CACHE_BYTES = int(os.environ.get("BLOB_CACHE_BYTES", 2 * 1024**3))
+if WORKERS > 1:
+    # Each worker indexes and trims its own cache
+    BLOB_CACHE_DIR = os.path.join(BLOB_CACHE_DIR, f"worker-{WORKER_INDEX}")
+    BLOB_CACHE_BYTES //= WORKERS
+BLOB_CACHE_CHUNK = 1024 * 1024  # bytes per cache file write and read
+# Resumable uploads: sealed spool files live here until finalized
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", "upload-spool")
+UPLOAD_MAX_SIZE = 20 * 1024**3
+UPLOAD_SESSION_CHUNK = 8 * 1024 * 1024  # chunk size suggested to clients
+UPLOAD_MAX_CHUNK = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # idle sessions are removed after this
+UPLOAD_GC_INTERVAL = 60 * 60
+DOWNLOAD_SESSION_TTL = 30 * 60  # seconds a download's follow-up requests ride on it
+DOWNLOAD_SESSION_BUDGET = 2  # times its size one download may fetch over its session
+AES_KEY_CACHE_SIZE = 256  # unwrapped share keys kept to skip RSA on repeat downloads
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100_000))
+# Per route: {"share" | "client" | "loopback" | "session": (requests, per
+# seconds)}. The share bucket keeps one link from being hammered; the client
+# bucket bounds a single peer. Onion traffic and the desktop UI all arrive
+# from loopback, where peers cannot be told apart, so loopback peers share one
+# "loopback" bucket per route instead: a ceiling for everyone coming through
+# Tor, sized well above what the UI needs. Follow-up requests of a counted
+# download (ranges, resumes) only draw on their own session bucket, sized for
+# a parallel multi-range fetch.
+RATE_LIMIT_POLICIES = {
+    "/download/{share_id}": {
+        "share": (10, 60),
+        "client": (60, 60),
+        "loopback": (600, 60),
+        "session": (1200, 60),
+    },
+    "/download/{share_id}/{file}": {
+        "share": (30, 60),
+        "client": (120, 60),
+        "loopback": (1200, 60),
+        "session": (1200, 60),
+    },
+    "/bundle/{share_id}": {
+        "share": (30, 60),
+        "client": (60, 60),
+        "loopback": (600, 60),
+    },
+    "/signal/{share_id}": {
+        "share": (10, 60),
+        "client": (60, 60),
+        "loopback": (300, 60),
+    },
+    "/status/{share_id}": {
+        "share": (10, 60),
+        "client": (120, 60),
+        "loopback": (1200, 60),
+    },
+    "/meta/{share_id}": {
+        "share": (30, 60),
+        "client": (120, 60),
+        "loopback": (1200, 60),
+    },
+    "/ws/progress/{share_id}": {
+        "share": (10, 60),
+        "client": (60, 60),
+        "loopback": (300, 60),
+    },
+    "/stop/{share_id}": {
+        "share": (10, 60),
+        "client": (60, 60),
+        "loopback": (300, 60),
+    },
+    "/upload": {"client": (30, 60), "loopback": (120, 60)},
+    "/uploads": {"client": (30, 60), "loopback": (120, 60)},
+    "/uploads/{session_id}": {"client": (1200, 60), "loopback": (2400, 60)},
+    "/uploads/{session_id}/finalize": {"client": (30, 60), "loopback": (120, 60)},
+    "/status": {"client": (60, 60), "loopback": (600, 60)},
+}
+# The onion service forwards to this port, bound to loopback only. Tor connects
+# from loopback just like the desktop UI on port 5000, so the port a request
+# arrived on is what tells onion visitors apart from the local user.
+ONION_PORT = int(os.environ.get("ONION_PORT", 5080))
+# Routes for the local user only: never served on ONION_PORT or to other hosts
+LOCAL_ROUTES = {"/events", "/stats", "/metrics"}
+# Background components a route needs (see STARTUP). Routes not listed only
+# use the database and work as soon as the port is open.
+ROUTE_REQUIREMENTS = {
+    "/upload": ("ipfs", "tor"),
+    "/uploads/{session_id}/finalize": ("ipfs", "tor"),
+    "/download/{share_id}": ("ipfs",),
+    "/download/{share_id}/{file}": ("ipfs",),
+    "/signal/{share_id}": ("ipfs",),
+}
+STARTUP_RETRY_DELAY = 1  # seconds, doubling up to the max between attempts
+STARTUP_RETRY_MAX_DELAY = 30
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 64KB per multipart read
+# Upper bound on encrypted bytes buffered between the upload and the IPFS add
+UPLOAD_WINDOW_SIZE = int(os.environ.get("UPLOAD_WINDOW_SIZE", 8 * 1024 * 1024))
+# Decrypted bytes a download may read ahead of the client
+DOWNLOAD_WINDOW_SIZE = int(os.environ.get("DOWNLOAD_WINDOW_SIZE", 4 * 1024 * 1024))
+# Downloads over WebRTC data channels. Off unless RTC_ENABLED=1: the ICE
+# candidates in an answer carry this machine's addresses, so anyone holding an
+# onion link would learn the server's IP. Only for trusted networks.
+RTC_ENABLED = os.environ.get("RTC_ENABLED", "0") == "1"
+RTC_MAX_PEERS = 32  # transfers at once, more are sent to HTTP
+# Seconds for the peer to open its data channel and confirm "meta". Matches
+# PEER_CONNECT_TIMEOUT in src/download.js, whose clock starts before the offer
+# is sent, so a client gives up before the server does and never falls back
+# to HTTP after confirming.
+RTC_CONNECT_TIMEOUT = 10
+RTC_IDLE_TIMEOUT = 30  # seconds a transfer may wait on a peer not reading
+RTC_MESSAGE_SIZE = 16 * 1024  # bytes per message, safe across browsers
+RTC_BUFFER_HIGH = 1024 * 1024  # queued bytes at which sending pauses
+RTC_BUFFER_LOW = 256 * 1024  # and resumes
+WRITE_CHUNK_MIN = 16 * 1024
+WRITE_CHUNK_MAX = 1024 * 1024
+
+# CPU-heavy stages run on a "thread" or "process" pool (see WORKER POOL)
+CRYPTO_EXECUTOR = os.environ.get("CRYPTO_EXECUTOR", "thread")
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", os.cpu_count() or 2))
+CRYPTO_BATCH_SIZE = 1024 * 1024  # bytes handed to a worker at once
+CRYPTO_INLINE_BYTES = 128 * 1024  # smaller jobs are not worth the handoff
+ZIP_STORED = 0  # zip compression methods
+ZIP_DEFLATED = 8
+ZIP_DEFLATE_LEVEL = 6
+ZIP_PARALLEL_BLOCKS = CRYPTO_WORKERS  # deflate blocks of one member in flight
+ZIP_STORE_RATIO = 0.9  # members whose first chunk deflates worse than this are stored
+# Already compressed formats, stored in bundles without trying to deflate
+STORED_CONTENT_TYPES = (
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "image/webp",
+    "image/avif",
+    "image/heic",
+    "video/",
+    "audio/",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/x-xz",
+    "application/x-bzip2",
+    "application/zstd",
+    "application/x-zstd",
+)
+# Single files are compressed before encryption when it pays off (see
+# COMPRESSION): "auto" uses zstd if installed, "deflate" forces zlib
+COMPRESSION = os.environ.get("COMPRESSION", "auto")  # auto | deflate | off
+COMPRESSION_MIN_SIZE = 4096  # first chunks shorter than this are stored as is
+COMPRESSION_SAMPLE = 64 * 1024  # bytes of the first chunk the decision is made on
+COMPRESSION_MAX_ENTROPY = 7.5  # bits per byte, above this a sample looks random
+COMPRESSION_RATIO = 0.9  # the sample must compress at least this well
+# Plaintext bytes per independently decodable frame (16 segments), so a range
+# only decodes the frames it covers
+COMPRESSION_FRAME_SIZE = 1024 * 1024
+# (file size up to, zstd level, zlib level): the tighter levels cost CPU that
+# only pays off on the smaller files
+COMPRESSION_LEVELS = (
+    (16 * 1024 * 1024, 9, 6),
+    (256 * 1024 * 1024, 3, 3),
+    (None, 1, 1),
+)
+
+# Ready-made RSA key pairs kept for new shares (see KeyPool)
+KEY_POOL_SIZE = int(os.environ.get("KEY_POOL_SIZE", 8))
+KEY_POOL_LOW_WATER = int(os.environ.get("KEY_POOL_LOW_WATER", KEY_POOL_SIZE // 2))
+
+# Share containers on IPFS (see SHARE CONTAINER below). Version 1 streamed
+# shares are magic | RSA encrypted AES key | GCM nonce | ciphertext | GCM tag,
+# legacy shares have no magic and carry the tag before the nonce.
+STREAM_MAGIC = b"DFS\x01"
+SEGMENT_MAGIC = b"DFS\x02"
+SEGMENT_SIZE = 64 * 1024  # plaintext bytes per authenticated segment
+SEGMENT_NONCE_PREFIX_BYTES = 7
+RSA_KEY_BYTES = 256
+GCM_NONCE_BYTES = 12
+GCM_TAG_BYTES = 16
+SEGMENT_HEADER_BYTES = len(SEGMENT_MAGIC) + 4 + SEGMENT_NONCE_PREFIX_BYTES + RSA_KEY_BYTES
+LEGACY_HEADER_BYTES = RSA_KEY_BYTES + GCM_TAG_BYTES + GCM_NONCE_BYTES
+
+
+# ========== METRICS ==========
+
+# Upper bounds (seconds) of the latency histogram buckets
+METRICS_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+
+
+def escape_label(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+class Metric:
+    """A family of values keyed by label values, in Prometheus text format.
+
+    Values sit in a dict keyed by the tuple of label values and are updated
+    on the event loop, so recording is a dict lookup and an add. Families
+    given a collect function read existing state at scrape time instead; it
+    returns a number, or {label values: number}.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self._values = {}
+
+    def _labels(self, values, extra=None):
+        pairs = [f'{k}="{escape_label(v)}"' for k, v in zip(self.labels, values)]
+        if WORKERS > 1:
+            pairs.append(f'worker="{WORKER_INDEX}"')
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        values = self.collect() if self.collect else self._values
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield f"{self.name}{self._labels(key)} {value}"
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def add(self, amount, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        # Counts are kept per bucket and only made cumulative when rendered
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = self._labels(key, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{self._labels(key)} {total}"
+            yield f"{self.name}_count{self._labels(key)} {cumulative}"
+
+
+class Metrics:
+    """Registry of metric families behind /metrics"""
+
+    def __init__(self):
+        self._families = []
+
+    def _add(self, family):
+        self._families.append(family)
+        return family
+
+    def counter(self, name, help, labels=(), collect=None):
+        return self._add(Counter(name, help, labels, collect))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self._add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """Current samples of every family, by family name"""
+        return {family.name: list(family.samples()) for family in self._families}
+
+    def render(self, others=()):
+        """Text exposition, with the samples of other workers' snapshots"""
+        lines = []
+        for family in self._families:
+            lines += family.render()
+            for snapshot in others:
+                lines += snapshot.get(family.name, ())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+http_requests = metrics.counter(
+    "dfs_http_requests_total", "Requests handled", ("route", "method", "status")
+)
+http_request_seconds = metrics.histogram(
+    "dfs_http_request_seconds",
+    "Time to handle a request, including the body",
+    ("route",),
+)
+http_in_flight = metrics.gauge(
+    "dfs_http_requests_in_flight", "Requests being handled", ("route",)
+)
+http_bytes = metrics.counter(
+    "dfs_http_bytes_total", "Request and response body bytes", ("direction",)
+)
+stage_seconds = metrics.histogram(
+    "dfs_stage_seconds",
+    "Time one request spent in a stage of its pipeline",
+    ("route", "stage"),
+)
+db_query_seconds = metrics.histogram(
+    "dfs_db_query_seconds", "SQLite query execution time", ("query",)
+)
+db_wait_seconds = metrics.histogram(
+    "dfs_db_wait_seconds", "Time queries waited for a database thread"
+)
+ipfs_call_seconds = metrics.histogram(
+    "dfs_ipfs_call_seconds",
+    "IPFS API call latency (not streamed bodies)",
+    ("endpoint",),
+)
+expiry_reap_seconds = metrics.histogram(
+    "dfs_expiry_reap_seconds", "Time to reap and unpin one batch of expired shares"
+)
+peer_transfers = metrics.counter(
+    "dfs_webrtc_transfers_total", "Downloads offered over WebRTC", ("outcome",)
+)
+
+# The timer of the request being handled. Tasks a request spawns inherit it,
+# so helpers deep in a pipeline charge their time to the right request.
+_stage_timer = contextvars.ContextVar("stage_timer", default=None)
+
+
+class StageTimer:
+    """Seconds a request spends in each stage (receive, encrypt, ipfs_add...).
+
+    Streamed transfers go through their stages chunk by chunk, and fetch,
+    decrypt and write overlap, so time is summed per stage and the totals
+    are observed once when the request ends.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.seconds = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = _stage_timer.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _stage_timer.reset(self._token)
+        for stage, seconds in self.seconds.items():
+            stage_seconds.observe(seconds, self.route, stage)
+
+
+def charge_stage(stage, started):
+    """Add the time since started (perf_counter) to the current request"""
+    timer = _stage_timer.get()
+    if timer is not None:
+        timer.seconds[stage] = (
+            timer.seconds.get(stage, 0.0) + time.perf_counter() - started
+        )
+
+
+async def timed_stage(stage, awaitable):
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        charge_stage(stage, started)
+
+
+async def timed_stream(stage, chunks):
+    """Pass an async stream through, charging the wait for each chunk to stage"""
+    chunks = aiter(chunks)
+    while True:
+        started = time.perf_counter()
+        chunk = await anext(chunks, None)
+        charge_stage(stage, started)
+        if chunk is None:
+            return
+        yield chunk
 
 
 # ========== PERSISTENT METADATA ==========
 
+# Schema changes applied in order on top of the original share_metadata table.
+# Never edit a released entry, append a new one.
+MIGRATIONS = [
+    # 1: history indexes and a change counter for cheap polling
+    [
+        "CREATE INDEX IF NOT EXISTS idx_share_expires ON share_metadata (expires_at, share_id)",
+        "CREATE INDEX IF NOT EXISTS idx_share_active ON share_metadata (active, expires_at)",
+        "CREATE TABLE IF NOT EXISTS share_revision (id INTEGER PRIMARY KEY CHECK (id = 1), revision INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO share_revision (id, revision) VALUES (1, 0)",
+        """CREATE TRIGGER IF NOT EXISTS share_revision_insert AFTER INSERT ON share_metadata
+           BEGIN UPDATE share_revision SET revision = revision + 1; END""",
+        """CREATE TRIGGER IF NOT EXISTS share_revision_update AFTER UPDATE ON share_metadata
+           BEGIN UPDATE share_revision SET revision = revision + 1; END""",
+        """CREATE TRIGGER IF NOT EXISTS share_revision_delete AFTER DELETE ON share_metadata
+           BEGIN UPDATE share_revision SET revision = revision + 1; END""",
+    ],
+    # 2: tell shares stopped by the owner apart from exhausted/expired ones
+    [
+        "ALTER TABLE share_metadata ADD COLUMN stopped INTEGER NOT NULL DEFAULT 0",
+    ],
+    # 3: shares whose content has been released, so expiry handles each once
+    [
+        "ALTER TABLE share_metadata ADD COLUMN reaped INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_share_unreaped ON share_metadata (expires_at) WHERE reaped = 0",
+    ],
+    # 4: encrypted blobs shared by every share of the same content
+    [
+        """CREATE TABLE IF NOT EXISTS blobs (
+               digest TEXT PRIMARY KEY,
+               ipfs_hash TEXT NOT NULL,
+               private_key TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               refcount INTEGER NOT NULL,
+               created_at REAL NOT NULL
+           )""",
+        "ALTER TABLE share_metadata ADD COLUMN digest TEXT",
+    ],
+    # 5: bundles of separately stored files behind one share
+    [
+        "ALTER TABLE share_metadata ADD COLUMN bundle INTEGER NOT NULL DEFAULT 0",
+        """CREATE TABLE IF NOT EXISTS share_members (
+               share_id TEXT NOT NULL,
+               position INTEGER NOT NULL,
+               name TEXT NOT NULL,
+               content_type TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               crc32 INTEGER NOT NULL,
+               digest TEXT NOT NULL,
+               ipfs_hash TEXT NOT NULL,
+               PRIMARY KEY (share_id, position)
+           )""",
+    ],
+    # 6: resumable uploads in progress
+    [
+        """CREATE TABLE IF NOT EXISTS upload_sessions (
+               session_id TEXT PRIMARY KEY,
+               share_id TEXT NOT NULL,
+               filename TEXT NOT NULL,
+               content_type TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               max_downloads INTEGER NOT NULL,
+               private_key TEXT NOT NULL,
+               header BLOB NOT NULL,
+               committed INTEGER NOT NULL DEFAULT 0,
+               updated_at REAL NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at)",
+    ],
+    # 7: server-side secrets that must outlive a restart
+    [
+        "CREATE TABLE IF NOT EXISTS server_secrets (name TEXT PRIMARY KEY, value BLOB NOT NULL)",
+    ],
+    # 8: state shared by worker processes
+    [
+        "CREATE TABLE IF NOT EXISTS server_state "
+        "(name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        """CREATE TABLE IF NOT EXISTS worker_bus (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               origin INTEGER NOT NULL,
+               channel TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               created_at REAL NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_worker_bus_created ON worker_bus (created_at)",
+    ],
+    # 9: content compressed before encryption ("zstd" or "deflate")
+    [
+        "ALTER TABLE blobs ADD COLUMN codec TEXT",
+        "ALTER TABLE share_metadata ADD COLUMN codec TEXT",
+    ],
+    # 10: what a download sends, so probes need neither IPFS nor the key.
+    # size is the plaintext, encoded_size the compressed bytes if any.
+    [
+        "ALTER TABLE share_metadata ADD COLUMN size INTEGER",
+        "ALTER TABLE share_metadata ADD COLUMN encoded_size INTEGER",
+        "ALTER TABLE share_metadata ADD COLUMN layout TEXT",
+        "ALTER TABLE blobs ADD COLUMN encoded_size INTEGER",
+        "ALTER TABLE blobs ADD COLUMN layout TEXT",
+        """UPDATE share_metadata
+           SET size = (SELECT size FROM blobs WHERE blobs.digest = share_metadata.digest)
+           WHERE digest IS NOT NULL""",
+    ],
+    # 11: where each compressed frame starts, packed big-endian uint64s
+    [
+        "ALTER TABLE blobs ADD COLUMN frames BLOB",
+    ],
+    # 12: rate-limit buckets shared by worker processes (see RateLimiter)
+    [
+        """CREATE TABLE IF NOT EXISTS rate_buckets (
+               key TEXT PRIMARY KEY,
+               tokens REAL NOT NULL,
+               updated REAL NOT NULL
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_rate_buckets_updated ON rate_buckets (updated)",
+    ],
+    # 13: rate-limit buckets are kept per worker again, synced over the bus
+    [
+        "DROP TABLE IF EXISTS rate_buckets",
+    ],
+]
+
+# Lifecycle state of a share, derived in SQL (the current time is bound as ?)
+SHARE_STATE_SQL = """
+    CASE WHEN stopped THEN 'stopped'
+         WHEN download_count >= max_downloads THEN 'exhausted'
+         WHEN expires_at <= ? THEN 'expired'
+         WHEN active THEN 'active'
+         ELSE 'stopped' END
+"""
+
 
 class ShareMetadata:
-    def __init__(self, db_path="metadata.db"):
+    """SQLite share store.
+
+    Queries run on a small thread pool so they never block the event loop.
+    Each thread keeps one persistent connection in WAL mode, which lets
+    readers proceed while a write is in progress.
+    """
+
+    def __init__(self, db_path=METADATA_DB, threads=DB_THREADS):
         self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="sqlite"
+        )
         self._init_db()
 
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit: single statements are atomic, transactions are explicit
+            conn = sqlite3.connect(
+                self.db_path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    async def _run(self, name, query):
+        """Run query(conn) on the database thread pool, timed under name"""
+        times = []
+
+        def run():
+            times.append(time.perf_counter())
+            try:
+                return query(self._connect())
+            finally:
+                times.append(time.perf_counter())
+
+        submitted = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+        finally:
+            # Observed here, on the loop, rather than from the database thread
+            if len(times) == 2:
+                db_wait_seconds.observe(times[0] - submitted)
+                db_query_seconds.observe(times[1] - times[0], name)
+
     def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS share_metadata (
-                    share_id TEXT PRIMARY KEY,
-                    ipfs_hash TEXT NOT NULL,
-                    filename TEXT NOT NULL,
-                    content_type TEXT NOT NULL,
-                    private_key TEXT NOT NULL,
-                    max_downloads INTEGER NOT NULL,
-                    download_count INTEGER NOT NULL DEFAULT 0,
-                    active INTEGER NOT NULL DEFAULT 1,
-                    expires_at REAL NOT NULL,
-                    magnet_created INTEGER NOT NULL DEFAULT 0
-                );
+        conn = self._connect()
+        conn.execute(
             """
-            )
-            conn.commit()
+            CREATE TABLE IF NOT EXISTS share_metadata (
+                share_id TEXT PRIMARY KEY,
+                ipfs_hash TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                private_key TEXT NOT NULL,
+                max_downloads INTEGER NOT NULL,
+                download_count INTEGER NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 1,
+                expires_at REAL NOT NULL,
+                magnet_created INTEGER NOT NULL DEFAULT 0
+            );
+        """
+        )
+        self._migrate(conn)
+
+    def _migrate(self, conn):
+        """Apply pending MIGRATIONS, tracked in PRAGMA user_version"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+                logger.info(f"Applied metadata migration {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _transaction(conn, body):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = body()
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _release(conn, shares):
+        """Drop the blob references of (share_id, ipfs_hash, digest) shares.
+
+        Returns the IPFS hashes no share uses any more. Shares from before
+        deduplication have no digest and own their object outright, as do
+        bundles their manifest and member files.
+        """
+        unpin = []
+        for share_id, ipfs_hash, digest in shares:
+            unpin += [
+                row[0]
+                for row in conn.execute(
+                    "SELECT ipfs_hash FROM share_members WHERE share_id = ?",
+                    (share_id,),
+                )
+            ]
+            if digest is None:
+                unpin.append(ipfs_hash)
+                continue
+            row = conn.execute(
+                "UPDATE blobs SET refcount = refcount - 1 WHERE digest = ? RETURNING refcount",
+                (digest,),
+            ).fetchone()
+            if not row or row[0] <= 0:
+                conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                unpin.append(ipfs_hash)
+        return unpin
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
 
     async def create_share(
         self,
@@ -98,15 +914,19 @@ class ShareMetadata:
         max_downloads=1,
         expires_at=None,
         share_id=None,
+        size=None,
+        layout=None,
     ):
         share_id = share_id or secrets.token_urlsafe(16)
         expires_at = expires_at or (time.time() + DEFAULT_TTL)
-        with sqlite3.connect(self.db_path) as conn:
+
+        def query(conn):
             conn.execute(
                 """
                 INSERT INTO share_metadata (share_id, ipfs_hash, filename, content_type,
-                                            private_key, max_downloads, expires_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
+                                            private_key, max_downloads, expires_at,
+                                            size, layout)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
                 (
                     share_id,
@@ -116,247 +936,3024 @@ class ShareMetadata:
                     private_key,
                     max_downloads,
                     expires_at,
+                    size,
+                    layout,
                 ),
             )
-            conn.commit()
+
+        await self._run("create_share", query)
         return share_id
 
-    async def check_download_limits(self, share_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT active, download_count, max_downloads, expires_at FROM share_metadata WHERE share_id = ?",
-                (share_id,),
-            )
-            row = cur.fetchone()
-            if not row:
-                raise ValueError("Invalid share ID")
-            active, count, max_dl, expires = row
-            if not active:
-                raise ValueError("Share link is inactive")
-            if count >= max_dl:
-                raise ValueError("Maximum downloads exceeded")
-            if time.time() > expires:
-                raise ValueError("Link has expired")
-
-    def get_metadata(self, share_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT * FROM share_metadata WHERE share_id = ?", (share_id,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return None
-            return dict(zip([col[0] for col in cur.description], row))
+    async def find_blob(self, digest):
+        def query(conn):
+            row = conn.execute(
+                "SELECT * FROM blobs WHERE digest = ?", (digest,)
+            ).fetchone()
+            return dict(row) if row else None
 
-    def increment_download_count(self, share_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT download_count, max_downloads FROM share_metadata WHERE share_id = ?",
-                (share_id,),
-            )
-            row = cur.fetchone()
-            if row:
-                count, max_dl = row
-                new_count = count + 1
-                active = 0 if new_count >= max_dl else 1
-                conn.execute(
+        return await self._run("find_blob", query)
+
+    async def get_frames(self, digest):
+        """Stored offsets of a compressed blob's frames, None if it is one stream"""
+
+        def query(conn):
+            row = conn.execute(
+                "SELECT frames FROM blobs WHERE digest = ?", (digest,)
+            ).fetchone()
+            return row[0] if row else None
+
+        return unpack_frames(await self._run("get_frames", query))
+
+    async def create_blob_share(
+        self,
+        digest,
+        size,
+        filename,
+        content_type,
+        max_downloads=1,
+        expires_at=None,
+        share_id=None,
+        ipfs_hash=None,
+        private_key=None,
+        codec=None,
+        layout=None,
+        encoded_size=None,
+        frames=None,
+    ):
+        """Create a share of the blob with this plaintext digest.
+
+        With ipfs_hash and private_key (and the codec it was compressed with,
+        the compressed size and frame index, if any) the blob is registered if
+        it is new; without them it must already exist (LookupError otherwise).
+        Returns the IPFS hash the share points at, which differs from
+        ipfs_hash when the same content was stored first by someone else.
+        """
+        share_id = share_id or secrets.token_urlsafe(16)
+        expires_at = expires_at or (time.time() + DEFAULT_TTL)
+
+        def body(conn):
+            if ipfs_hash:
+                blob = conn.execute(
                     """
-                    UPDATE share_metadata SET download_count = ?, active = ?
-                    WHERE share_id = ?
+                    INSERT INTO blobs (digest, ipfs_hash, private_key, size, refcount,
+                                       created_at, codec, layout, encoded_size,
+                                       frames)
+                    VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+                    ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1
+                    RETURNING ipfs_hash, private_key, codec, size, layout, encoded_size
                 """,
-                    (new_count, active, share_id),
-                )
-                conn.commit()
-
-    def stop_share(self, share_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT ipfs_hash FROM share_metadata WHERE share_id = ?", (share_id,)
+                    (
+                        digest,
+                        ipfs_hash,
+                        private_key,
+                        size,
+                        time.time(),
+                        codec,
+                        layout,
+                        encoded_size,
+                        frames,
+                    ),
+                ).fetchone()
+            else:
+                blob = conn.execute(
+                    """
+                    UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?
+                    RETURNING ipfs_hash, private_key, codec, size, layout, encoded_size
+                """,
+                    (digest,),
+                ).fetchone()
+                if not blob:
+                    raise LookupError(digest)
+            conn.execute(
+                """
+                INSERT INTO share_metadata (share_id, ipfs_hash, filename, content_type,
+                                            private_key, max_downloads, expires_at,
+                                            digest, codec, size, layout, encoded_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    share_id,
+                    blob[0],
+                    filename,
+                    content_type,
+                    blob[1],
+                    max_downloads,
+                    expires_at,
+                    digest,
+                    *blob[2:],
+                ),
             )
-            row = cur.fetchone()
-            if row:
-                ipfs_hash = row[0]
-                conn.execute(
-                    "UPDATE share_metadata SET active = 0 WHERE share_id = ?",
-                    (share_id,),
-                )
-                conn.commit()
-                return ipfs_hash
-        return None
+            return blob[0]
 
-    def get_all_expired(self):
-        now = time.time()
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT share_id, ipfs_hash FROM share_metadata WHERE expires_at <= ?",
-                (now,),
-            )
-            return cur.fetchall()
+        return await self._run(
+            "create_blob_share",
+            lambda conn: self._transaction(conn, lambda: body(conn)),
+        )
 
-    def is_active(self, share_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.execute(
-                "SELECT active FROM share_metadata WHERE share_id = ?", (share_id,)
+    async def create_bundle_share(
+        self,
+        manifest_hash,
+        filename,
+        private_key,
+        members,
+        max_downloads=1,
+        expires_at=None,
+        share_id=None,
+    ):
+        """Create a bundle share from its manifest object and member dicts"""
+        share_id = share_id or secrets.token_urlsafe(16)
+        expires_at = expires_at or (time.time() + DEFAULT_TTL)
+        # The size of the whole zip, which is what the share itself serves
+        size = ZipStream.stored_size([(m["name"], m["size"]) for m in members])
+
+        def body(conn):
+            conn.execute(
+                """
+                INSERT INTO share_metadata (share_id, ipfs_hash, filename, content_type,
+                                            private_key, max_downloads, expires_at, bundle,
+                                            size, layout)
+                VALUES (?, ?, ?, 'application/zip', ?, ?, ?, 1, ?, 'bundle')
+            """,
+                (
+                    share_id,
+                    manifest_hash,
+                    filename,
+                    private_key,
+                    max_downloads,
+                    expires_at,
+                    size,
+                ),
+            )
+            conn.executemany(
+                """
+                INSERT INTO share_members (share_id, position, name, content_type,
+                                           size, crc32, digest, ipfs_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                [
+                    (
+                        share_id,
+                        position,
+                        member["name"],
+                        member["content_type"],
+                        member["size"],
+                        member["crc32"],
+                        member["sha256"],
+                        member["ipfs_hash"],
+                    )
+                    for position, member in enumerate(members)
+                ],
             )
-            row = cur.fetchone()
-            return bool(row and row[0])
 
+        await self._run(
+            "create_bundle_share",
+            lambda conn: self._transaction(conn, lambda: body(conn)),
+        )
+        return share_id
 
-# Instantiate it
-share_metadata = ShareMetadata()
+    async def create_upload_session(self, session):
+        def query(conn):
+            conn.execute(
+                """
+                INSERT INTO upload_sessions (session_id, share_id, filename, content_type, size,
+                                             max_downloads, private_key, header, updated_at)
+                VALUES (:session_id, :share_id, :filename, :content_type, :size,
+                        :max_downloads, :private_key, :header, :updated_at)
+            """,
+                session,
+            )
 
+        await self._run("create_upload_session", query)
 
-import time
-from stem import SocketError
+    async def get_upload_session(self, session_id):
+        def query(conn):
+            row = conn.execute(
+                "SELECT * FROM upload_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            return dict(row) if row else None
 
+        return await self._run("get_upload_session", query)
 
-def start_tor_service():
-    for _ in range(5):  # retry up to 5 times
-        try:
-            with Controller.from_port(port=9051) as controller:
-                controller.authenticate()
-                hidden_service = controller.create_ephemeral_hidden_service(
-                    ports={80: 5000}, await_publication=True, detached=True
-                )
-                return hidden_service
-        except SocketError:
-            time.sleep(1)
-    raise RuntimeError("Failed to connect to Tor control port after multiple attempts")
+    async def commit_upload(self, session_id, committed):
+        """Record how many plaintext bytes are sealed in the spool"""
 
+        # Workers may commit the same session; the spool only ever grows
+        def query(conn):
+            conn.execute(
+                """
+                UPDATE upload_sessions SET committed = MAX(committed, ?), updated_at = ?
+                WHERE session_id = ?
+            """,
+                (committed, time.time(), session_id),
+            )
 
-async def handle_signaling(request, share_id):
-    async with sse_response(request) as resp:
-        pcs[share_id] = RTCPeerConnection()
-        pc = pcs[share_id]
+        await self._run("commit_upload", query)
 
-        @pc.on("datachannel")
-        def on_datachannel(channel):
-            @channel.on("message")
-            def on_message(message):
-                channel.send("File received")
+    async def delete_upload_session(self, session_id):
+        def query(conn):
+            conn.execute("DELETE FROM upload_sessions WHERE session_id = ?", (session_id,))
 
-        # Create offer
-        await pc.setLocalDescription(await pc.createOffer())
-        await resp.send(
-            json.dumps(
-                {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
-            )
-        )
+        await self._run("delete_upload_session", query)
 
-        # Handle incoming signaling messages
-        async for msg in request.content:
-            data = json.loads(msg)
-            if data["type"] == "answer":
-                await pc.setRemoteDescription(
-                    RTCSessionDescription(sdp=data["sdp"], type=data["type"])
+    async def stale_upload_sessions(self, before):
+        def query(conn):
+            return [
+                row[0]
+                for row in conn.execute(
+                    "SELECT session_id FROM upload_sessions WHERE updated_at < ?",
+                    (before,),
                 )
-            elif data["type"] == "candidate":
-                await pc.addIceCandidate(data["candidate"])
-        return resp
+            ]
 
+        return await self._run("stale_upload_sessions", query)
 
-async def download_file(request):
-    share_id = request.match_info["share_id"]
+    async def get_secret(self, name):
+        """A random 32-byte secret, created on first use"""
 
-    try:
-        # Check download limits
-        await share_metadata.check_download_limits(share_id)
+        def query(conn):
+            conn.execute(
+                "INSERT OR IGNORE INTO server_secrets (name, value) VALUES (?, ?)",
+                (name, secrets.token_bytes(32)),
+            )
+            return conn.execute(
+                "SELECT value FROM server_secrets WHERE name = ?", (name,)
+            ).fetchone()[0]
 
-        # Increment download count
-        metadata = share_metadata.get_metadata(share_id)
-        if not metadata:
-            return web.json_response({"error": "Invalid or expired link"}, status=404)
+        return await self._run("get_secret", query)
 
-        share_metadata.increment_download_count(share_id)
+    async def get_state(self, name):
+        """A JSON value shared by the worker processes, or None"""
 
-        ipfs_hash = metadata["ipfs_hash"]
-        encrypted_data = ipfs.cat(ipfs_hash)
+        def query(conn):
+            row = conn.execute(
+                "SELECT value FROM server_state WHERE name = ?", (name,)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
 
-        # Extract encryption components from stored data
-        encrypted_key = encrypted_data[:256]  # RSA encrypted AES key
-        tag = encrypted_data[256:272]  # GCM tag
-        nonce = encrypted_data[272:284]  # GCM nonce
-        ciphertext = encrypted_data[284:]  # AES-GCM ciphertext
+        return await self._run("get_state", query)
 
-        # Load RSA private key and decrypt AES key
-        private_key = serialization.load_pem_private_key(
-            metadata["private_key"].encode(), password=None
-        )
-        aes_key = private_key.decrypt(
-            encrypted_key,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
+    async def set_state(self, name, value):
+        def query(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO server_state (name, value) VALUES (?, ?)",
+                (name, json.dumps(value)),
+            )
 
-        cipher = Cipher(algorithms.AES(aes_key), modes.GCM(nonce, tag))
-        decryptor = cipher.decryptor()
-        file_size = len(ciphertext)
+        await self._run("set_state", query)
 
-        response = web.StreamResponse(
-            status=200,
-            headers={
-                "Content-Type": metadata["content_type"],
-                "Content-Disposition": f'attachment; filename="{metadata["filename"]}"',
-                "Accept-Ranges": "bytes",
-                "Content-Length": str(file_size),
-            },
-        )
+    async def get_states_like(self, pattern):
+        """{name: value} of shared state whose name matches a LIKE pattern"""
 
-        range_header = request.headers.get("Range")
-        if range_header:
-            try:
-                response.set_status(HTTPPartialContent.status_code)
-                start, end = parse_range_header(range_header, file_size)
-                response.headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
-                response.headers["Content-Length"] = str(end - start + 1)
-                ciphertext = ciphertext[start : end + 1]
-            except ValueError:
-                raise HTTPRequestRangeNotSatisfiable()
+        def query(conn):
+            rows = conn.execute(
+                "SELECT name, value FROM server_state WHERE name LIKE ?", (pattern,)
+            ).fetchall()
+            return {row[0]: json.loads(row[1]) for row in rows}
 
-        await response.prepare(request)
-        chunk_size = 8192
-        for i in range(0, len(ciphertext), chunk_size):
-            decrypted_chunk = decryptor.update(ciphertext[i : i + chunk_size])
-            await response.write(decrypted_chunk)
-        await response.write(decryptor.finalize())
-        await response.write_eof()
-        return response
+        return await self._run("get_states_like", query)
 
-    except ValueError as e:
-        return web.json_response({"error": str(e)}, status=403)
-    except Exception as e:
+    async def bus_append(self, origin, messages):
+        """Append (channel, payload) messages for the other workers"""
+        now = time.time()
+
+        def query(conn):
+            conn.executemany(
+                """
+                INSERT INTO worker_bus (origin, channel, payload, created_at)
+                VALUES (?, ?, ?, ?)
+            """,
+                [(origin, channel, payload, now) for channel, payload in messages],
+            )
+
+        await self._run("bus_append", query)
+
+    async def bus_head(self):
+        def query(conn):
+            row = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM worker_bus").fetchone()
+            return row[0]
+
+        return await self._run("bus_head", query)
+
+    async def bus_read(self, after, origin, limit=1000):
+        """Messages after seq that came from other processes, oldest first"""
+
+        def query(conn):
+            return conn.execute(
+                """
+                SELECT seq, channel, payload FROM worker_bus
+                WHERE seq > ? AND origin != ? ORDER BY seq LIMIT ?
+            """,
+                (after, origin, limit),
+            ).fetchall()
+
+        return await self._run("bus_read", query)
+
+    async def bus_trim(self, before):
+        def query(conn):
+            conn.execute("DELETE FROM worker_bus WHERE created_at < ?", (before,))
+
+        await self._run("bus_trim", query)
+
+    async def get_members(self, share_id, name=None):
+        """Member files of a bundle in upload order, or just the one called name"""
+
+        def query(conn):
+            sql = "SELECT * FROM share_members WHERE share_id = ?"
+            params = [share_id]
+            if name is not None:
+                sql += " AND name = ?"
+                params.append(name)
+            return [dict(row) for row in conn.execute(sql + " ORDER BY position", params)]
+
+        return await self._run("get_members", query)
+
+    @staticmethod
+    def _limit_error(row):
+        if not row:
+            return ValueError("Invalid share ID")
+        active, count, max_dl, expires = row
+        if not active:
+            return ValueError("Share link is inactive")
+        if count >= max_dl:
+            return ValueError("Maximum downloads exceeded")
+        if time.time() > expires:
+            return ValueError("Link has expired")
+        return None
+
+    async def check_download_limits(self, share_id):
+        def query(conn):
+            return conn.execute(
+                "SELECT active, download_count, max_downloads, expires_at FROM share_metadata WHERE share_id = ?",
+                (share_id,),
+            ).fetchone()
+
+        error = self._limit_error(await self._run("check_download_limits", query))
+        if error:
+            raise error
+
+    async def claim_download(self, share_id):
+        """Check the limits and count a download in one atomic statement.
+
+        Returns the updated share row, or raises ValueError with the reason
+        the download was refused.
+        """
+
+        def query(conn):
+            row = conn.execute(
+                """
+                UPDATE share_metadata
+                SET download_count = download_count + 1,
+                    active = CASE WHEN download_count + 1 >= max_downloads THEN 0 ELSE 1 END
+                WHERE share_id = ? AND active = 1
+                      AND download_count < max_downloads AND expires_at >= ?
+                RETURNING *
+            """,
+                (share_id, time.time()),
+            ).fetchone()
+            if row:
+                return dict(row), None
+            row = conn.execute(
+                "SELECT active, download_count, max_downloads, expires_at FROM share_metadata WHERE share_id = ?",
+                (share_id,),
+            ).fetchone()
+            return None, self._limit_error(row) or ValueError("Download refused")
+
+        metadata, error = await self._run("claim_download", query)
+        if error:
+            raise error
+        return metadata
+
+    async def get_metadata(self, share_id):
+        def query(conn):
+            row = conn.execute(
+                "SELECT * FROM share_metadata WHERE share_id = ?", (share_id,)
+            ).fetchone()
+            return dict(row) if row else None
+
+        return await self._run("get_metadata", query)
+
+    async def probe(self, share_id, name=None):
+        """The share row with its state in one indexed lookup.
+
+        With name, the bundle member of that name stands in for the file:
+        its name, type, size, digest and object replace the share's.
+        """
+        now = time.time()
+
+        def query(conn):
+            if name is None:
+                row = conn.execute(
+                    f"""
+                    SELECT *, {SHARE_STATE_SQL} AS state
+                    FROM share_metadata WHERE share_id = ?
+                """,
+                    (now, share_id),
+                ).fetchone()
+                return dict(row) if row else None
+            row = conn.execute(
+                f"""
+                SELECT s.*, {SHARE_STATE_SQL} AS state, m.name AS member_name,
+                       m.content_type AS member_type, m.size AS member_size,
+                       m.digest AS member_digest, m.ipfs_hash AS member_hash
+                FROM share_metadata s
+                JOIN share_members m ON m.share_id = s.share_id AND m.name = ?
+                WHERE s.share_id = ?
+            """,
+                (now, name, share_id),
+            ).fetchone()
+            if not row:
+                return None
+            row = dict(row)
+            row.update(
+                filename=row.pop("member_name"),
+                content_type=row.pop("member_type"),
+                size=row.pop("member_size"),
+                digest=row.pop("member_digest"),
+                ipfs_hash=row.pop("member_hash"),
+                bundle=0,
+                layout=SegmentedShare.layout,
+                codec=None,
+                encoded_size=None,
+            )
+            return row
+
+        return await self._run("probe", query)
+
+    async def record_layout(self, share_id, layout, stored_size):
+        """Fill in what shares from before migration 10 did not record.
+
+        stored_size is the size of the stored content: the plaintext, or the
+        compressed bytes of a share with a codec.
+        """
+
+        def query(conn):
+            conn.execute(
+                """
+                UPDATE share_metadata
+                SET layout = ?,
+                    size = COALESCE(size, CASE WHEN codec IS NULL THEN ? END),
+                    encoded_size = CASE WHEN codec IS NOT NULL THEN ? END
+                WHERE share_id = ?
+            """,
+                (layout, stored_size, stored_size, share_id),
+            )
+
+        await self._run("record_layout", query)
+
+    async def stop_share(self, share_id):
+        """Stop a share. Returns the IPFS hashes to unpin, None if unknown"""
+
+        def body(conn):
+            row = conn.execute(
+                "SELECT ipfs_hash, digest, reaped FROM share_metadata WHERE share_id = ?",
+                (share_id,),
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE share_metadata SET active = 0, stopped = 1, reaped = 1 WHERE share_id = ?",
+                (share_id,),
+            )
+            if row["reaped"]:
+                return []
+            return self._release(conn, [(share_id, row["ipfs_hash"], row["digest"])])
+
+        return await self._run(
+            "stop_share",
+            lambda conn: self._transaction(conn, lambda: body(conn)),
+        )
+
+    async def reap_expired(self, share_ids):
+        """Deactivate and mark reaped those of share_ids that are due.
+
+        Returns the share IDs reaped by this call only, so every share is
+        processed exactly once, and the IPFS hashes to unpin.
+        """
+        share_ids = list(share_ids)
+        now = time.time()
+
+        def body(conn):
+            reaped = []
+            for i in range(0, len(share_ids), 500):
+                batch = share_ids[i : i + 500]
+                reaped += conn.execute(
+                    f"""
+                    UPDATE share_metadata SET active = 0, reaped = 1
+                    WHERE share_id IN ({",".join("?" * len(batch))})
+                          AND reaped = 0 AND expires_at <= ?
+                    RETURNING share_id, ipfs_hash, digest
+                """,
+                    (*batch, now),
+                ).fetchall()
+            unpin = self._release(conn, reaped)
+            return [row[0] for row in reaped], unpin
+
+        return await self._run(
+            "reap_expired",
+            lambda conn: self._transaction(conn, lambda: body(conn)),
+        )
+
+    async def get_states(self, share_ids):
+        """Map share_id -> status dict for many shares in a few indexed queries"""
+        share_ids = list(dict.fromkeys(share_ids))
+        now = time.time()
+
+        def query(conn):
+            rows = []
+            for i in range(0, len(share_ids), 500):
+                batch = share_ids[i : i + 500]
+                rows += conn.execute(
+                    f"""
+                    SELECT share_id, {SHARE_STATE_SQL} AS state,
+                           download_count, max_downloads, expires_at
+                    FROM share_metadata
+                    WHERE share_id IN ({",".join("?" * len(batch))})
+                """,
+                    (now, *batch),
+                ).fetchall()
+            return rows
+
+        states = {
+            share_id: {"active": False, "state": "unknown"} for share_id in share_ids
+        }
+        for row in await self._run("get_states", query):
+            states[row["share_id"]] = {
+                "active": row["state"] == "active",
+                "state": row["state"],
+                "download_count": row["download_count"],
+                "max_downloads": row["max_downloads"],
+                "expires_at": row["expires_at"],
+            }
+        return states
+
+    async def get_unreaped(self, until):
+        """(share_id, expires_at) of unreaped shares expiring up to until"""
+
+        def query(conn):
+            return conn.execute(
+                "SELECT share_id, expires_at FROM share_metadata WHERE reaped = 0 AND expires_at <= ?",
+                (until,),
+            ).fetchall()
+
+        return [tuple(row) for row in await self._run("get_unreaped", query)]
+
+    async def is_active(self, share_id):
+        def query(conn):
+            row = conn.execute(
+                "SELECT active FROM share_metadata WHERE share_id = ?", (share_id,)
+            ).fetchone()
+            return bool(row and row[0])
+
+        return await self._run("is_active", query)
+
+    async def get_revision(self):
+        """Counter bumped by triggers on every change to share_metadata"""
+
+        def query(conn):
+            return conn.execute("SELECT revision FROM share_revision").fetchone()[0]
+
+        return await self._run("get_revision", query)
+
+    async def list_shares(
+        self,
+        limit=None,
+        cursor=None,
+        active_only=False,
+        expires_after=None,
+        expires_before=None,
+        prefix=None,
+        descending=True,
+    ):
+        """One keyset page of shares ordered by (expires_at, share_id).
+
+        cursor is the (expires_at, share_id) of the last row already seen.
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        """
+        where, params = [], []
+        if active_only:
+            where.append("active = 1")
+        if expires_after is not None:
+            where.append("expires_at >= ?")
+            params.append(expires_after)
+        if expires_before is not None:
+            where.append("expires_at <= ?")
+            params.append(expires_before)
+        if prefix:
+            escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where.append("filename LIKE ? ESCAPE '\\'")
+            params.append(escaped + "%")
+        if cursor:
+            op = "<" if descending else ">"
+            where.append(f"(expires_at, share_id) {op} (?, ?)")
+            params.extend(cursor)
+        direction = "DESC" if descending else "ASC"
+        sql = f"""
+            SELECT share_id, filename, max_downloads, download_count, active, expires_at, magnet_created
+            FROM share_metadata
+            {"WHERE " + " AND ".join(where) if where else ""}
+            ORDER BY expires_at {direction}, share_id {direction}
+        """
+        if limit:
+            # One extra row tells whether another page exists
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+
+        def query(conn):
+            return conn.execute(sql, params).fetchall()
+
+        rows = await self._run("list_shares", query)
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1][5], rows[-1][0])
+        return rows, next_cursor
+
+
+# Instantiate it
+share_metadata = ShareMetadata()
+
+
+# ========== SHARE EVENTS ==========
+
+
+class ShareEvents:
+    """In-process pub/sub of share state changes for the /events stream.
+
+    Recent events are kept in a ring so a reconnecting client can resume from
+    Last-Event-ID. Event IDs carry a random epoch, so an ID from before a
+    restart or from another worker replays nothing instead of the wrong
+    events. A subscriber that falls SHARE_EVENTS_QUEUE events behind is
+    dropped; it reconnects and resyncs through the bulk status endpoint.
+    Events of other workers arrive through the worker bus.
+    """
+
+    def __init__(self, history=SHARE_EVENTS_HISTORY):
+        self.epoch = secrets.token_hex(4)
+        self._seq = 0
+        self._recent = collections.deque(maxlen=history)
+        self._subscribers = set()
+
+    def publish(self, share_id, state, **details):
+        event = {"share_id": share_id, "state": state, **details}
+        worker_bus.send("share", event)
+        self.deliver(event)
+
+    def deliver(self, event):
+        self._seq += 1
+        event = {"seq": self._seq, **event}
+        self._recent.append(event)
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def event_id(self, event):
+        return f"{self.epoch}-{event['seq']}"
+
+    def subscribe(self, last_event_id=None):
+        queue = asyncio.Queue(maxsize=SHARE_EVENTS_QUEUE)
+        epoch, _, seq = (last_event_id or "").partition("-")
+        if epoch == self.epoch and seq.isdigit():
+            for event in self._recent:
+                if event["seq"] > int(seq) and not queue.full():
+                    queue.put_nowait(event)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+
+share_events = ShareEvents()
+
+
+import time
+from stem import SocketError
+
+
+def start_tor_service():
+    """Publish the onion service. Blocks until the descriptor is out, so it
+    runs on a thread; retries are up to the caller (see Readiness)."""
+    try:
+        with Controller.from_port(port=9051) as controller:
+            controller.authenticate()
+            return controller.create_ephemeral_hidden_service(
+                ports={80: ONION_PORT}, await_publication=True, detached=True
+            )
+    except SocketError as e:
+        raise RuntimeError(f"Tor control port unavailable: {e}") from e
+
+
+# ========== WEBRTC ==========
+
+
+class PeerTransfer:
+    """A download over a WebRTC data channel, for peers that can connect.
+
+    The downloader offers a connection with one reliable, ordered data
+    channel; the answer carries this side's candidates, so there is no
+    trickle ICE. Once the channel opens the share is described in a JSON
+    "meta" message, which the peer confirms with "ack". Only then is the
+    download counted, and a "session" message, the decrypted bytes in
+    RTC_MESSAGE_SIZE binary messages and a final "done" (or "error") message
+    follow. Sending pauses while more than RTC_BUFFER_HIGH bytes are queued
+    on the channel, until it drains to RTC_BUFFER_LOW.
+
+    A peer that has not confirmed within RTC_CONNECT_TIMEOUT is dropped
+    uncounted and downloads over HTTP instead. "session" carries a download
+    session token, so falling back after a failed transfer (with a ranged
+    request, as sessions require) is not counted again either.
+    """
+
+    def __init__(self, share_id, name):
+        self.id = secrets.token_urlsafe(8)
+        self.share_id = share_id
+        self.name = name
+        self.pc = RTCPeerConnection()
+        self.channel = None
+        self.opened = asyncio.Event()
+        self.acked = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.closed = asyncio.Event()
+        self._task = None
+        self.pc.on("datachannel", self._on_datachannel)
+        self.pc.on("connectionstatechange", self._on_state)
+
+    def _on_datachannel(self, channel):
+        if self.channel:
+            channel.close()
+            return
+        self.channel = channel
+        channel.bufferedAmountLowThreshold = RTC_BUFFER_LOW
+        channel.on("bufferedamountlow", self.drained.set)
+        channel.on("message", self._on_message)
+        channel.on("close", self.closed.set)
+        self.opened.set()
+
+    def _on_message(self, message):
+        try:
+            if isinstance(message, str) and json.loads(message)["type"] == "ack":
+                self.acked.set()
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def _on_state(self):
+        if self.pc.connectionState == "failed":
+            self.closed.set()
+            if self._task and not self.opened.is_set():
+                self._task.cancel()
+
+    async def answer(self, offer):
+        await self.pc.setRemoteDescription(offer)
+        await self.pc.setLocalDescription(await self.pc.createAnswer())
+        return self.pc.localDescription
+
+    async def _wait(self, event, timeout):
+        """Whether event is set within timeout; the channel going away ends
+        the wait early"""
+        waiters = [asyncio.create_task(e.wait()) for e in (event, self.closed)]
+        try:
+            await asyncio.wait(
+                waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        return event.is_set()
+
+    async def _send(self, data):
+        if self.closed.is_set() or self.channel.readyState != "open":
+            raise ConnectionError("Data channel closed")
+        if self.channel.bufferedAmount > RTC_BUFFER_HIGH:
+            self.drained.clear()
+            if not await self._wait(self.drained, RTC_IDLE_TIMEOUT):
+                raise ConnectionError("Peer stopped reading")
+        self.channel.send(data)
+
+    async def _open(self, metadata):
+        """(filename, content_type, size, chunks, source) of what to send"""
+        cached = metadata["max_downloads"] > 1 or bool(metadata["digest"])
+        if self.name is None and metadata["bundle"]:
+            members = await share_metadata.get_members(self.share_id)
+            size = ZipStream.stored_size([(m["name"], m["size"]) for m in members])
+            chunks = bundle_zip(members, metadata["private_key"], cached)
+            return metadata["filename"], "application/zip", size, chunks, None
+
+        filename, content_type = metadata["filename"], metadata["content_type"]
+        ipfs_hash = metadata["ipfs_hash"]
+        if self.name is not None:
+            member = (await share_metadata.get_members(self.share_id, self.name))[0]
+            filename, content_type = member["name"], member["content_type"]
+            ipfs_hash = member["ipfs_hash"]
+        source = await open_source(ipfs_hash, cached)
+        try:
+            share = await open_share(source, metadata["private_key"])
+            size = share.size
+            chunks = share.read_range(0, share.size - 1)
+            if self.name is None and metadata["codec"]:
+                size = metadata["size"]
+                frames = await share_metadata.get_frames(metadata["digest"])
+                chunks = decompress_range(
+                    share, metadata["codec"], frames, 0, size - 1
+                )
+        except Exception:
+            source.close()
+            raise
+        return filename, content_type, size, chunks, source
+
+    async def _run(self):
+        # Not part of the /signal request that started it
+        _stage_timer.set(None)
+        outcome = "error"
+        source = None
+        deadline = time.monotonic() + RTC_CONNECT_TIMEOUT
+        try:
+            try:
+                await asyncio.wait_for(self.opened.wait(), RTC_CONNECT_TIMEOUT)
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                logger.info(f"Peer for {self.share_id} never connected")
+                return
+
+            started = time.monotonic()
+            await share_metadata.check_download_limits(self.share_id)
+            metadata = await share_metadata.get_metadata(self.share_id)
+            filename, content_type, size, chunks, source = await self._open(metadata)
+            await self._send(
+                json.dumps(
+                    {
+                        "type": "meta",
+                        "filename": filename,
+                        "content_type": content_type,
+                        "size": size,
+                    }
+                )
+            )
+            # A peer that gave up has fallen back to HTTP, which counts it
+            if not await self._wait(self.acked, deadline - time.monotonic()):
+                outcome = "timeout"
+                logger.info(f"Peer for {self.share_id} did not confirm")
+                return
+            _, session = await count_download(self.share_id, self.name)
+            await self._send(json.dumps({"type": "session", "session": session}))
+            async for chunk in chunks:
+                view = memoryview(chunk)
+                for offset in range(0, len(view), RTC_MESSAGE_SIZE):
+                    await self._send(bytes(view[offset : offset + RTC_MESSAGE_SIZE]))
+            await self._send(json.dumps({"type": "done"}))
+            outcome = "complete"
+            logger.info(
+                f"Sent {self.share_id} over WebRTC: {size} bytes in "
+                f"{time.monotonic() - started:.3f}s"
+            )
+            # The peer closes once it has everything; closing first could
+            # drop messages still in flight
+            try:
+                await asyncio.wait_for(self.closed.wait(), RTC_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            if outcome == "error":
+                outcome = "failed"
+        except Exception as e:
+            logger.error(f"WebRTC transfer of {self.share_id} failed: {e}")
+            if self.channel and self.channel.readyState == "open":
+                # Limits are worth telling, anything else is ours to log
+                error = str(e) if isinstance(e, ValueError) else "Transfer failed"
+                self.channel.send(json.dumps({"type": "error", "error": error}))
+        finally:
+            peer_transfers.inc(outcome)
+            if source:
+                source.close()
+            await self.close()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        pcs.pop(self.id, None)
+        await self.pc.close()
+
+
+async def handle_signaling(request):
+    """Answer a WebRTC offer to download a share peer to peer.
+
+    The body is {"sdp", "type"[, "file"]}, parsed regardless of
+    Content-Type so browsers can skip the CORS preflight. Errors mean the
+    client should download over HTTP, as does 404 while RTC_ENABLED is off.
+    """
+    share_id = request.match_info["share_id"]
+    if not RTC_ENABLED:
+        return web.json_response({"error": "Peer transfers are disabled"}, status=404)
+    try:
+        body = json.loads(await request.text())
+        offer = RTCSessionDescription(sdp=body["sdp"], type=body["type"])
+        name = body.get("file")
+    except (ValueError, KeyError, TypeError) as e:
+        return web.json_response({"error": f"Invalid offer: {e}"}, status=400)
+    try:
+        await share_metadata.check_download_limits(share_id)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=403)
+    if name is not None and not await share_metadata.get_members(share_id, name):
+        return web.json_response({"error": "File not found"}, status=404)
+    if len(pcs) >= RTC_MAX_PEERS:
+        return web.json_response({"error": "Too many peer transfers"}, status=503)
+
+    transfer = PeerTransfer(share_id, name)
+    pcs[transfer.id] = transfer
+    try:
+        answer = await transfer.answer(offer)
+    except Exception as e:
+        await transfer.close()
+        return web.json_response({"error": f"Invalid offer: {e}"}, status=400)
+    transfer.start()
+    return web.json_response({"sdp": answer.sdp, "type": answer.type})
+
+
+# ========== DOWNLOAD SESSIONS ==========
+
+
+class DownloadSessions:
+    """Stateless tokens tying follow-up requests to an already counted download.
+
+    A token is "<expiry>.<nonce>.<mac>", an HMAC over share, file, expiry and
+    a nonce per download under a secret kept in the database, so it stays
+    valid across restarts. Clients
+    get it in X-Download-Session and a cookie scoped to the download path,
+    and may send it back in either or in ?session=. Only ranged requests
+    ride on a session, and all of them together may fetch no more than
+    DOWNLOAD_SESSION_BUDGET times the download's size, so a shared token is
+    no way around max_downloads. Each process keeps its own tally.
+    """
+
+    COOKIE = "dl_session"
+
+    def __init__(self):
+        self._secret = None
+        self._spent = {}
+        self._prune_at = 1024
+
+    async def load(self):
+        self._secret = await share_metadata.get_secret("download_session")
+
+    def _mac(self, share_id, target, expires, nonce):
+        message = f"{share_id}\0{target}\0{expires}\0{nonce}".encode()
+        digest = hmac.new(self._secret, message, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode()
+
+    def mint(self, share_id, target):
+        expires = int(time.time()) + DOWNLOAD_SESSION_TTL
+        # Downloads counted in the same second must not share a budget
+        nonce = secrets.token_urlsafe(9)
+        return f"{expires}.{nonce}.{self._mac(share_id, target, expires, nonce)}"
+
+    def verify(self, share_id, target, token):
+        if not self._secret or not token:
+            return False
+        expires, _, rest = token.partition(".")
+        nonce, _, mac = rest.partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        expected = self._mac(share_id, target, int(expires), nonce)
+        return hmac.compare_digest(mac, expected)
+
+    def _candidates(self, request):
+        yield request.query.get("session")
+        yield request.headers.get("X-Download-Session")
+        # Several path-scoped cookies of this name may apply, try each
+        for cookie in request.headers.getall("Cookie", []):
+            for pair in cookie.split(";"):
+                name, _, value = pair.strip().partition("=")
+                if name == self.COOKIE:
+                    yield value
+
+    def from_request(self, request):
+        """The valid token a ranged request carries, or None"""
+        if "Range" not in request.headers:
+            return None
+        share_id = request.match_info["share_id"]
+        target = request.match_info.get("file", "")
+        for token in self._candidates(request):
+            if self.verify(share_id, target, token):
+                return token
+        return None
+
+    def charge(self, token, length, size):
+        """Count length bytes against the token's budget; False once it would
+        go over, in which case nothing is counted"""
+        spent = self._spent.get(token, 0) + length
+        if spent > DOWNLOAD_SESSION_BUDGET * size:
+            return False
+        self._spent[token] = spent
+        if len(self._spent) >= self._prune_at:
+            now = time.time()
+            self._spent = {
+                t: n for t, n in self._spent.items() if int(t.partition(".")[0]) >= now
+            }
+            self._prune_at = max(1024, 2 * len(self._spent))
+        return True
+
+    def attach(self, request, response, token):
+        response.headers["X-Download-Session"] = token
+        response.set_cookie(
+            self.COOKIE,
+            token,
+            max_age=DOWNLOAD_SESSION_TTL,
+            path=request.path,
+            httponly=True,
+            samesite="Lax",
+        )
+
+
+download_sessions = DownloadSessions()
+
+
+async def download_file(request):
+    if request.method == "HEAD":
+        return await probe_download(request)
+    share_id = request.match_info["share_id"]
+    name = request.match_info.get("file")
+    started = time.monotonic()
+
+    # Ranged, parallel and resumed requests of a download already counted
+    # carry its session token
+    session = download_sessions.from_request(request)
+    try:
+        # A file from a bundle must exist before a download is counted for it
+        member = None
+        if name is not None:
+            members = await share_metadata.get_members(share_id, name)
+            if not members:
+                return web.json_response({"error": "File not found"}, status=404)
+            member = members[0]
+
+        metadata = None
+        if session:
+            metadata = await timed_stage(
+                "limit_check", share_metadata.get_metadata(share_id)
+            )
+            if (
+                not metadata
+                or metadata["stopped"]
+                or metadata["reaped"]
+                or metadata["expires_at"] < time.time()
+            ):
+                return web.json_response({"error": "Share link is inactive"}, status=403)
+        else:
+            metadata, session = await count_download(share_id, name)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=403)
+    except Exception as e:
         logger.error(f"Error downloading file: {str(e)}", exc_info=True)
         return web.json_response({"error": "Internal server error"}, status=500)
+    # Likely to be fetched again, keep a local copy
+    cached = metadata["max_downloads"] > 1 or bool(metadata["digest"])
+
+    if member:
+        return await serve_share(
+            request,
+            share_id,
+            member["ipfs_hash"],
+            metadata["private_key"],
+            member["name"],
+            member["content_type"],
+            cached,
+            started,
+            session,
+            digest=member["digest"],
+        )
+    if metadata["bundle"]:
+        return await serve_bundle_zip(
+            request, share_id, metadata, cached, started, session
+        )
+    return await serve_share(
+        request,
+        share_id,
+        metadata["ipfs_hash"],
+        metadata["private_key"],
+        metadata["filename"],
+        metadata["content_type"],
+        cached,
+        started,
+        session,
+        codec=metadata["codec"],
+        digest=metadata["digest"],
+        size=metadata["size"],
+        record=metadata["layout"] is None,
+    )
+
+
+async def probe_download(request):
+    """HEAD of a download: the headers its GET would send, from one database
+    lookup. Nothing is counted, fetched from IPFS or decrypted."""
+    share_id = request.match_info["share_id"]
+    metadata = await share_metadata.probe(share_id, request.match_info.get("file"))
+    if not metadata:
+        return web.Response(status=404)
+    # Follow-ups of a counted download are allowed as long as its GET would be
+    if metadata["state"] != "active" and not (
+        download_sessions.from_request(request)
+        and not metadata["stopped"]
+        and not metadata["reaped"]
+        and metadata["expires_at"] >= time.time()
+    ):
+        return web.Response(status=403)
+
+    codec = metadata["codec"]
+    decode = codec and (
+        "Range" in request.headers or not accepts_encoding(request, codec)
+    )
+    size = metadata["encoded_size"] if codec and not decode else metadata["size"]
+    headers = {
+        "Content-Type": metadata["content_type"],
+        "Content-Disposition": f'attachment; filename="{metadata["filename"]}"',
+    }
+    if metadata["bundle"]:
+        etag = entity_tags.bundle(share_id, metadata["ipfs_hash"])
+    else:
+        etag = entity_tags.share(
+            share_id,
+            metadata["digest"],
+            metadata["ipfs_hash"],
+            None if decode else codec,
+        )
+        headers["Accept-Ranges"] = "bytes"
+    headers["ETag"] = etag
+    if codec:
+        headers["Vary"] = "Accept-Encoding"
+    if codec and not decode:
+        headers["Content-Encoding"] = codec
+    if size is None:
+        # Shares from before migration 10 learn their size on first download
+        response = web.StreamResponse(headers=headers)
+        await response.prepare(request)
+        await response.write_eof()
+        return response
+
+    status = 200
+    headers["Content-Length"] = str(size)
+    range_header = request.headers.get("Range")
+    if range_header and not metadata["bundle"] and if_range_matches(request, etag):
+        try:
+            start, end = parse_range_header(range_header, size)
+        except ValueError:
+            raise HTTPRequestRangeNotSatisfiable(
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        status = HTTPPartialContent.status_code
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+    return web.Response(status=status, headers=headers)
+
+
+async def count_download(share_id, name):
+    """Count one download, returning the share row and a session token for
+    its follow-up requests. Raises ValueError if the download is refused."""
+    # Check download limits and count this download in one step. Every
+    # request for a bundle, a single file or the whole zip, is one download.
+    metadata = await timed_stage("limit_check", share_metadata.claim_download(share_id))
+    exhausted = metadata["download_count"] >= metadata["max_downloads"]
+    share_events.publish(
+        share_id,
+        "exhausted" if exhausted else "downloaded",
+        download_count=metadata["download_count"],
+        max_downloads=metadata["max_downloads"],
+    )
+    return metadata, download_sessions.mint(share_id, name or "")
+
+
+async def open_source(ipfs_hash, cached):
+    if cached:
+        return await timed_stage("ipfs_fetch", blob_cache.open(ipfs, ipfs_hash))
+    return await timed_stage("ipfs_fetch", IPFSBlobSource.open(ipfs, ipfs_hash))
+
+
+async def stream_response(request, response, chunks, share_id, length, started):
+    """Serve chunks from a producer once the first one has arrived.
+
+    Fetch and decrypt run ahead of the client by at most
+    DOWNLOAD_WINDOW_SIZE, and failures on the first segment still get a
+    proper error response.
+    """
+    window = ByteWindow(DOWNLOAD_WINDOW_SIZE)
+    producer = asyncio.create_task(pump(window, chunks))
+    try:
+        chunks = aiter(window)
+        first = await anext(chunks, b"")
+
+        await response.prepare(request)
+        writer = AdaptiveWriter(response)
+        await writer.write(first)
+        async for chunk in chunks:
+            await writer.write(chunk)
+        await writer.flush()
+        await response.write_eof()
+        if writer.first_byte_at:
+            logger.info(
+                f"Served {share_id}: {length} bytes, first byte after "
+                f"{writer.first_byte_at - started:.3f}s"
+            )
+        return response
+
+    except Exception as e:
+        logger.error(f"Error downloading file: {str(e)}", exc_info=True)
+        if response.prepared:
+            # Headers are gone already, abort so the client sees a truncated body
+            raise
+        return web.json_response({"error": "Internal server error"}, status=500)
+    finally:
+        if not producer.done():
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+
+
+async def serve_share(
+    request,
+    share_id,
+    ipfs_hash,
+    private_key,
+    filename,
+    content_type,
+    cached,
+    started,
+    session,
+    codec=None,
+    digest=None,
+    size=None,
+    record=False,
+):
+    """Decrypt one stored object to the client, honouring Range and If-Range.
+
+    Compressed content goes out as stored with a Content-Encoding when the
+    client accepts the codec, which keeps the savings on the wire; ranges and
+    other clients get it decompressed (to size bytes) on the way. With record
+    the share's layout and size are saved for later probes.
+    """
+    source = None
+    response = None
+    try:
+        source = await open_source(ipfs_hash, cached)
+
+        # Load RSA private key, decrypt AES key and pick the blob layout
+        share = await open_share(source, private_key)
+        if record:
+            await share_metadata.record_layout(share_id, share.layout, share.size)
+        file_size = share.size
+        decode = codec and (
+            "Range" in request.headers or not accepts_encoding(request, codec)
+        )
+        if decode:
+            file_size = size
+        etag = entity_tags.share(
+            share_id, digest, ipfs_hash, None if decode else codec
+        )
+
+        response = web.StreamResponse(
+            status=200,
+            headers={
+                "Content-Type": content_type,
+                "Content-Disposition": f'attachment; filename="{filename}"',
+                "Accept-Ranges": "bytes",
+                "Content-Length": str(file_size),
+                "ETag": etag,
+            },
+        )
+
+        start, end = 0, file_size - 1
+        range_header = request.headers.get("Range")
+        if range_header and if_range_matches(request, etag):
+            try:
+                start, end = parse_range_header(range_header, file_size)
+            except ValueError:
+                raise HTTPRequestRangeNotSatisfiable(
+                    headers={"Content-Range": f"bytes */{file_size}"}
+                )
+            response.set_status(HTTPPartialContent.status_code)
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            response.headers["Content-Length"] = str(end - start + 1)
+        if not download_sessions.charge(session, end - start + 1, file_size):
+            return web.json_response({"error": "Download session used up"}, status=403)
+        if codec:
+            response.headers["Vary"] = "Accept-Encoding"
+        if codec and not decode:
+            response.headers["Content-Encoding"] = codec
+        download_sessions.attach(request, response, session)
+
+        # Segmented shares are verified one segment at a time before any of
+        # its bytes are written
+        if decode:
+            frames = await share_metadata.get_frames(digest)
+            chunks = decompress_range(share, codec, frames, start, end)
+        else:
+            chunks = share.read_range(start, end)
+        return await stream_response(
+            request, response, chunks, share_id, end - start + 1, started
+        )
+
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        if response is not None and response.prepared:
+            raise
+        logger.error(f"Error downloading file: {str(e)}", exc_info=True)
+        return web.json_response({"error": "Internal server error"}, status=500)
+    finally:
+        if source:
+            source.close()
+
+
+async def bundle_zip(members, private_key, cached):
+    """Yield a stored zip of bundle members, decrypting one after another"""
+    pending = []
+
+    async def collect(data):
+        pending.append(data)
+
+    archive = ZipStream(collect)
+    for member in members:
+        entry = await archive.open_stored(member["name"], member["size"], member["crc32"])
+        if member["size"]:
+            source = await open_source(member["ipfs_hash"], cached)
+            try:
+                share = await open_share(source, private_key)
+                async for chunk in share.read_range(0, member["size"] - 1):
+                    await entry.write(chunk)
+                    yield b"".join(pending)
+                    pending.clear()
+            finally:
+                source.close()
+        await entry.close()
+    await archive.close()
+    yield b"".join(pending)
+
+
+async def serve_bundle_zip(request, share_id, metadata, cached, started, session):
+    """Assemble the whole bundle as a zip on the fly.
+
+    Members are stored uncompressed with the CRCs recorded at upload, which
+    makes the archive length known before the first byte is decrypted.
+    """
+    members = await share_metadata.get_members(share_id)
+    length = ZipStream.stored_size([(m["name"], m["size"]) for m in members])
+    if metadata["layout"] is None:
+        await share_metadata.record_layout(share_id, "bundle", length)
+    if not download_sessions.charge(session, length, length):
+        return web.json_response({"error": "Download session used up"}, status=403)
+    response = web.StreamResponse(
+        status=200,
+        headers={
+            "Content-Type": "application/zip",
+            "Content-Disposition": f'attachment; filename="{metadata["filename"]}"',
+            "Content-Length": str(length),
+            "ETag": entity_tags.bundle(share_id, metadata["ipfs_hash"]),
+        },
+    )
+    download_sessions.attach(request, response, session)
+    return await stream_response(
+        request,
+        response,
+        bundle_zip(members, metadata["private_key"], cached),
+        share_id,
+        length,
+        started,
+    )
+
+
+async def get_share_meta(request):
+    """What a download of the share would send, without counting one"""
+    share_id = request.match_info["share_id"]
+    metadata = await share_metadata.probe(share_id)
+    if not metadata:
+        return web.json_response({"error": "Invalid share ID"}, status=404)
+    if metadata["bundle"]:
+        etag = entity_tags.bundle(share_id, metadata["ipfs_hash"])
+    else:
+        etag = entity_tags.share(share_id, metadata["digest"], metadata["ipfs_hash"])
+    return web.json_response(
+        {
+            "share_id": share_id,
+            "filename": metadata["filename"],
+            "content_type": metadata["content_type"],
+            "size": metadata["size"],
+            "etag": etag,
+            "layout": metadata["layout"],
+            "codec": metadata["codec"],
+            "encoded_size": metadata["encoded_size"],
+            "bundle": bool(metadata["bundle"]),
+            "state": metadata["state"],
+            "download_count": metadata["download_count"],
+            "max_downloads": metadata["max_downloads"],
+            "expires_at": metadata["expires_at"],
+        }
+    )
+
+
+async def list_bundle(request):
+    """Files of a bundle share; listing does not count as a download"""
+    share_id = request.match_info["share_id"]
+    try:
+        await share_metadata.check_download_limits(share_id)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=403)
+    metadata = await share_metadata.get_metadata(share_id)
+    if not metadata["bundle"]:
+        return web.json_response({"error": "Not a bundle"}, status=404)
+    members = await share_metadata.get_members(share_id)
+    return web.json_response(
+        {
+            "share_id": share_id,
+            "filename": metadata["filename"],
+            "download_count": metadata["download_count"],
+            "max_downloads": metadata["max_downloads"],
+            "files": [
+                {
+                    "name": member["name"],
+                    "size": member["size"],
+                    "content_type": member["content_type"],
+                    "path": f"/download/{share_id}/{urllib.parse.quote(member['name'])}",
+                }
+                for member in members
+            ],
+        }
+    )
+
+
+class EntityTags:
+    """ETags that change with a share's content but do not reveal it.
+
+    A tag is an HMAC under a secret kept in the database over the share and
+    its content's plaintext SHA-256, or its IPFS object if the digest is not
+    known. Neither the digest nor the object (which would tie this server to
+    an IPFS node) can be read from it, nor can two links to the same content
+    be matched.
+    """
+
+    def __init__(self):
+        self._secret = None
+
+    async def load(self):
+        self._secret = await share_metadata.get_secret("etag")
+
+    def _tag(self, share_id, content):
+        message = f"{share_id}\0{content}".encode()
+        digest = hmac.new(self._secret, message, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode()
+
+    def share(self, share_id, digest, ipfs_hash, codec=None):
+        """Strong ETag of a share, marked with the content coding if any"""
+        tag = self._tag(share_id, digest or ipfs_hash)
+        return f'"{tag}-{codec}"' if codec else f'"{tag}"'
+
+    def bundle(self, share_id, manifest_hash):
+        """Weak ETag of a bundle's zip, whose entries carry the time of serving"""
+        return f'W/"{self._tag(share_id, manifest_hash)}"'
+
+
+entity_tags = EntityTags()
+
+
+def if_range_matches(request, etag):
+    """Whether Range may be honoured: no If-Range, or one naming this strong
+    ETag. Dates never match, shares carry no modification time."""
+    return request.headers.get("If-Range", etag) == etag
+
+
+def parse_range_header(range_header, file_size):
+    """Parse Range header and return (start, end) tuple"""
+    if not range_header.startswith("bytes="):
+        raise ValueError("Invalid range unit")
+    if file_size <= 0:
+        raise ValueError("Unsatisfiable range")
+    ranges = range_header[6:].split("-")
+    if len(ranges) != 2:
+        raise ValueError("Invalid range format")
+    if not ranges[0]:
+        # Suffix range: the last N bytes
+        length = int(ranges[1])
+        if length <= 0:
+            raise ValueError("Unsatisfiable range")
+        return max(file_size - length, 0), file_size - 1
+    start = int(ranges[0])
+    end = min(int(ranges[1]), file_size - 1) if ranges[1] else file_size - 1
+    if start >= file_size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+# ========== WORKER POOL ==========
+
+
+class WorkerPool:
+    """Runs CPU-heavy stages (crypto, deflate) off the event loop.
+
+    Pure functions go to the configured thread or process executor; work on
+    stateful objects that cannot be pickled (zip members, GCM contexts) always
+    uses a thread. Small jobs run inline because the handoff would cost more
+    than the work itself.
+    """
+
+    def __init__(self, kind=CRYPTO_EXECUTOR, workers=CRYPTO_WORKERS):
+        self.kind = kind
+        self.workers = workers
+        self.pending = 0
+        self.peak_pending = 0
+        self.stages = collections.defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        self._executor = None
+        self._threads = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = self.threads
+        return self._executor
+
+    @property
+    def threads(self):
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="crypto"
+            )
+        return self._threads
+
+    async def _submit(self, executor, stage, fn, args):
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, fn, *args
+            )
+        finally:
+            self.pending -= 1
+            self._record(stage, started)
+
+    def _record(self, stage, started):
+        self.stages[stage]["calls"] += 1
+        self.stages[stage]["seconds"] += time.perf_counter() - started
+        charge_stage(stage, started)
+
+    def _inline(self, stage, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._record(stage, started)
+
+    async def run(self, stage, fn, *args, size=None):
+        if size is not None and size < CRYPTO_INLINE_BYTES:
+            return self._inline(stage, fn, args)
+        return await self._submit(self.executor, stage, fn, args)
+
+    async def run_local(self, stage, fn, *args, size=None):
+        if size is not None and size < CRYPTO_INLINE_BYTES:
+            return self._inline(stage, fn, args)
+        return await self._submit(self.threads, stage, fn, args)
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "peak_pending": self.peak_pending,
+            "stages": {k: dict(v) for k, v in self.stages.items()},
+        }
+
+    def shutdown(self):
+        for executor in {self._executor, self._threads} - {None}:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._threads = None
+
+
+crypto_pool = WorkerPool()
+
+
+# # Encryption utilities
+def generate_key_pair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_key = private_key.public_key()
+    return private_key, public_key
+
+
+def generate_key_pair_pem():
+    """Generate a share key pair as (private PEM, public PEM). Runs in a worker."""
+    private_key, public_key = generate_key_pair()
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode()
+    public_pem = public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    return private_pem, public_pem
+
+
+class KeyPool:
+    """Keeps RSA key pairs ready so creating a share never waits for keygen.
+
+    When fewer than low_water keys are left a background task refills the
+    pool to capacity on the worker pool. An empty pool falls back to
+    generating a key on demand (still off the event loop).
+    """
+
+    def __init__(self, capacity=KEY_POOL_SIZE, low_water=KEY_POOL_LOW_WATER):
+        self.capacity = capacity
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self._keys = collections.deque()
+        self._refill_task = None
+
+    async def _generate(self):
+        private_pem, public_pem = await crypto_pool.run(
+            "rsa_keygen", generate_key_pair_pem
+        )
+        return serialization.load_pem_public_key(public_pem), private_pem
+
+    async def _refill(self):
+        # Runs in the background, not on behalf of the upload that started it
+        _stage_timer.set(None)
+        try:
+            while len(self._keys) < self.capacity:
+                self._keys.append(await self._generate())
+        except Exception as e:
+            logger.error(f"Key pool refill failed: {e}", exc_info=True)
+
+    def fill(self):
+        if len(self._keys) < self.low_water and (
+            self._refill_task is None or self._refill_task.done()
+        ):
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def get(self):
+        """Return (public_key, private PEM) for a new share"""
+        if self._keys:
+            self.hits += 1
+            key = self._keys.popleft()
+        else:
+            self.misses += 1
+            key = await self._generate()
+        self.fill()
+        return key
+
+    def stats(self):
+        return {
+            "available": len(self._keys),
+            "capacity": self.capacity,
+            "low_water": self.low_water,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refilling": bool(self._refill_task and not self._refill_task.done()),
+        }
+
+
+key_pool = KeyPool()
+
+
+def wrap_aes_key(public_key, aes_key):
+    return public_key.encrypt(
+        aes_key,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None,
+        ),
+    )
+
+
+# ========== SHARE CONTAINER ==========
+#
+# Segmented layout (current):
+#   magic | segment size | nonce prefix | RSA encrypted AES key | segments...
+# Each segment is sealed on its own with AES-GCM under the nonce
+# prefix | segment index | last flag, with the header as associated data, so
+# any segment can be verified and decrypted without touching the others and
+# truncation or reordering is detected.
+
+
+def unwrap_aes_key(private_key_pem, encrypted_key):
+    private_key = serialization.load_pem_private_key(
+        private_key_pem.encode(), password=None
+    )
+    return private_key.decrypt(
+        encrypted_key,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None,
+        ),
+    )
+
+
+def segment_nonce(prefix, index, last):
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+def seal_segments(aes_key, prefix, header, first_index, data, segment_size, final):
+    """Seal data as consecutive segments starting at first_index.
+
+    Runs in a worker. Unless final, data must be a whole number of segments;
+    with final the last (possibly short or empty) segment gets the last flag.
+    """
+    aead = AESGCM(aes_key)
+    count = max(1, -(-len(data) // segment_size)) if final else len(data) // segment_size
+    sealed = []
+    for i in range(count):
+        piece = data[i * segment_size : (i + 1) * segment_size]
+        last = final and i == count - 1
+        sealed.append(
+            aead.encrypt(segment_nonce(prefix, first_index + i, last), piece, header)
+        )
+    return b"".join(sealed)
+
+
+def open_segments(aes_key, prefix, header, first_index, blocks, last_index):
+    """Verify and decrypt consecutive sealed segments. Runs in a worker."""
+    aead = AESGCM(aes_key)
+    return [
+        aead.decrypt(
+            segment_nonce(prefix, index, index == last_index), block, header
+        )
+        for index, block in enumerate(blocks, first_index)
+    ]
+
+
+class SegmentEncryptor:
+    """Encrypts a share into the segmented layout as data arrives"""
+
+    def __init__(self, public_key, segment_size=SEGMENT_SIZE):
+        self._aes_key = os.urandom(32)
+        self.segment_size = segment_size
+        self._prefix = os.urandom(SEGMENT_NONCE_PREFIX_BYTES)
+        self._index = 0
+        self._pending = bytearray()
+        # Wrapping is a single public-key operation, cheaper than a handoff
+        started = time.perf_counter()
+        self.header = (
+            SEGMENT_MAGIC
+            + struct.pack(">I", segment_size)
+            + self._prefix
+            + wrap_aes_key(public_key, self._aes_key)
+        )
+        charge_stage("rsa_wrap", started)
+
+    @classmethod
+    def resume(cls, header, aes_key, index):
+        """Continue a share whose first index segments are already sealed"""
+        self = cls.__new__(cls)
+        self._aes_key = aes_key
+        self.segment_size = struct.unpack(">I", header[4:8])[0]
+        self._prefix = header[8 : 8 + SEGMENT_NONCE_PREFIX_BYTES]
+        self._index = index
+        self._pending = bytearray()
+        self.header = header
+        return self
+
+    @property
+    def sealed(self):
+        """Plaintext bytes sealed so far"""
+        return self._index * self.segment_size
+
+    @property
+    def received(self):
+        return self.sealed + len(self._pending)
+
+    async def _seal(self, data, final):
+        sealed = await crypto_pool.run(
+            "encrypt",
+            seal_segments,
+            self._aes_key,
+            self._prefix,
+            self.header,
+            self._index,
+            data,
+            self.segment_size,
+            final,
+            size=len(data),
+        )
+        self._index += len(data) // self.segment_size
+        return sealed
+
+    async def update(self, chunk):
+        # Segments are sealed in batches of CRYPTO_BATCH_SIZE, always holding
+        # back at least one byte so the final segment is only sealed (with its
+        # last flag) by finalize()
+        self._pending += chunk
+        ready = (len(self._pending) - 1) // self.segment_size * self.segment_size
+        if ready < CRYPTO_BATCH_SIZE:
+            return b""
+        data = bytes(self._pending[:ready])
+        del self._pending[:ready]
+        return await self._seal(data, False)
+
+    async def finalize(self):
+        data = bytes(self._pending)
+        self._pending = bytearray()
+        return await self._seal(data, True)
+
+    def checkpoint(self):
+        return self._index, bytes(self._pending)
+
+    def restore(self, checkpoint):
+        """Go back to a checkpoint. Segments sealed since are sealed again
+        under the same nonces, so only the last sealing may leave the spool."""
+        self._index, pending = checkpoint
+        self._pending = bytearray(pending)
+
+
+async def iter_blocks(chunks, block_size):
+    """Regroup an async stream of byte chunks into block_size pieces"""
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            yield bytes(buf[:block_size])
+            del buf[:block_size]
+    if buf:
+        yield bytes(buf)
+
+
+class BlobSource:
+    """Random access over an encrypted share held in memory"""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self.size = len(data)
+
+    async def read(self, offset, length):
+        return self._data[offset : offset + length]
+
+    async def stream(self, offset, length):
+        yield self._data[offset : offset + length]
+
+    def close(self):
+        pass
+
+
+class IPFSBlobSource:
+    """Random access over an encrypted share on IPFS using ranged cat calls"""
+
+    def __init__(self, client, ipfs_hash, size):
+        self._client = client
+        self.ipfs_hash = ipfs_hash
+        self.size = size
+
+    @classmethod
+    async def open(cls, client, ipfs_hash):
+        return cls(client, ipfs_hash, await client.stat_size(ipfs_hash))
+
+    async def read(self, offset, length):
+        return b"".join([chunk async for chunk in self.stream(offset, length)])
+
+    def stream(self, offset, length):
+        return self._client.cat(self.ipfs_hash, offset, length)
+
+    def close(self):
+        pass
+
+
+# ========== BLOB CACHE ==========
+
+
+class CacheEntry:
+    def __init__(self, ipfs_hash, path, size):
+        self.ipfs_hash = ipfs_hash
+        self.path = path
+        self.size = size
+        self.filled = 0
+        self.error = None
+        self.readers = 0
+        self.doomed = False
+        self.changed = asyncio.Condition()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self._fd, size)
+        self.map = mmap.mmap(self._fd, size)
+
+    @property
+    def complete(self):
+        return self.filled >= self.size
+
+    def write(self, data, offset):
+        os.pwrite(self._fd, data, offset)
+
+    def remove(self):
+        self.map.close()
+        os.close(self._fd)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class CachedBlobSource:
+    """Reads a cache entry, waiting for the fill where it has not got to yet"""
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self.ipfs_hash = entry.ipfs_hash
+        self.size = entry.size
+        self._closed = False
+
+    async def read(self, offset, length):
+        return b"".join([chunk async for chunk in self.stream(offset, length)])
+
+    async def stream(self, offset, length):
+        entry = self._entry
+        end = min(offset + length, entry.size)
+        while offset < end:
+            if entry.filled <= offset:
+                async with entry.changed:
+                    await entry.changed.wait_for(
+                        lambda: entry.filled > offset or entry.error
+                    )
+                if entry.error:
+                    raise entry.error
+            stop = min(end, entry.filled, offset + BLOB_CACHE_CHUNK)
+            yield entry.map[offset:stop]
+            offset = stop
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._cache._release(self._entry)
+
+
+class BlobCache:
+    """Size-bounded LRU of share ciphertext in memory-mapped local files.
+
+    The first download of a hash fetches it once into a sparse file; readers
+    of the same hash share that fetch (single flight) and follow it as it
+    fills instead of waiting for the end. Entries in use are never evicted,
+    and invalidated ones go as soon as their last reader is done.
+    """
+
+    def __init__(self, directory=BLOB_CACHE_DIR, capacity=BLOB_CACHE_BYTES):
+        self.directory = directory
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._prepared = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def _prepare(self):
+        # Files left by a previous run have no index, start empty
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self._prepared = True
+
+    async def open(self, client, ipfs_hash):
+        """A source for ipfs_hash, cached when it fits"""
+        entry = self._entries.get(ipfs_hash)
+        if entry:
+            self.hits += 1
+            self._entries.move_to_end(ipfs_hash)
+            entry.readers += 1
+            return CachedBlobSource(self, entry)
+
+        source = await IPFSBlobSource.open(client, ipfs_hash)
+        # Another download may have started the fetch while we asked for the size
+        entry = self._entries.get(ipfs_hash)
+        if entry:
+            self.hits += 1
+            entry.readers += 1
+            return CachedBlobSource(self, entry)
+        if not 0 < source.size <= self.capacity or not self._make_room(source.size):
+            self.bypassed += 1
+            return source
+
+        self.misses += 1
+        if not self._prepared:
+            self._prepare()
+        # Unique per entry: an invalidated copy may still be open under it
+        path = os.path.join(self.directory, secrets.token_hex(16))
+        entry = CacheEntry(ipfs_hash, path, source.size)
+        entry.readers += 1
+        self._entries[ipfs_hash] = entry
+        self._size += entry.size
+        asyncio.create_task(self._fill(client, entry))
+        return CachedBlobSource(self, entry)
+
+    def _make_room(self, size):
+        for ipfs_hash in list(self._entries):
+            if self._size + size <= self.capacity:
+                break
+            entry = self._entries[ipfs_hash]
+            if entry.readers == 0 and entry.complete:
+                self._drop(entry)
+                self.evictions += 1
+        return self._size + size <= self.capacity
+
+    async def _fill(self, client, entry):
+        loop = asyncio.get_running_loop()
+        pending = bytearray()
+        try:
+            async for chunk in client.cat(entry.ipfs_hash, 0, entry.size):
+                pending += chunk
+                if len(pending) >= BLOB_CACHE_CHUNK or (
+                    entry.filled + len(pending) >= entry.size
+                ):
+                    data = bytes(pending[: entry.size - entry.filled])
+                    pending = bytearray()
+                    await loop.run_in_executor(None, entry.write, data, entry.filled)
+                    entry.filled += len(data)
+                    async with entry.changed:
+                        entry.changed.notify_all()
+            if not entry.complete:
+                raise ConnectionError(f"Short read caching {entry.ipfs_hash}")
+        except Exception as e:
+            logger.warning(f"Failed to cache {entry.ipfs_hash}: {e}")
+            entry.error = e
+            async with entry.changed:
+                entry.changed.notify_all()
+            self._doom(entry)
+        self._collect(entry)
+
+    def _doom(self, entry):
+        """Stop handing out entry; its file goes once nobody uses it"""
+        if self._entries.get(entry.ipfs_hash) is entry:
+            del self._entries[entry.ipfs_hash]
+        entry.doomed = True
+
+    def _collect(self, entry):
+        # The bytes stay counted until the fill stops writing to the file
+        if entry.doomed and entry.readers == 0 and (entry.complete or entry.error):
+            self._drop(entry)
+
+    def _drop(self, entry):
+        if self._entries.get(entry.ipfs_hash) is entry:
+            del self._entries[entry.ipfs_hash]
+        if entry.path:
+            self._size -= entry.size
+            entry.remove()
+            entry.path = None
+
+    def _release(self, entry):
+        entry.readers -= 1
+        self._collect(entry)
+
+    def invalidate(self, ipfs_hash):
+        entry = self._entries.get(ipfs_hash)
+        if entry:
+            self._doom(entry)
+            self._collect(entry)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+        }
+
+    def close(self):
+        for entry in list(self._entries.values()):
+            self._drop(entry)
+        if self._prepared:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+blob_cache = BlobCache()
+
+
+class SegmentedShare:
+    layout = "segmented"
+
+    def __init__(self, source, header, aes_key):
+        self.source = source
+        self.header = header
+        self.segment_size = struct.unpack(">I", header[4:8])[0]
+        self._prefix = header[8 : 8 + SEGMENT_NONCE_PREFIX_BYTES]
+        self._aes_key = aes_key
+
+        stored = self.segment_size + GCM_TAG_BYTES
+        body = source.size - len(header)
+        self.segment_count = max(1, -(-body // stored))
+        self.size = body - self.segment_count * GCM_TAG_BYTES
+        if self.size < 0:
+            raise ValueError("Corrupted share")
+
+    async def _open(self, first_index, blocks):
+        return await crypto_pool.run(
+            "decrypt",
+            open_segments,
+            self._aes_key,
+            self._prefix,
+            self.header,
+            first_index,
+            blocks,
+            self.segment_count - 1,
+            size=sum(map(len, blocks)),
+        )
+
+    async def read_range(self, start, end):
+        """Yield verified plaintext for bytes start..end (inclusive)"""
+        stored = self.segment_size + GCM_TAG_BYTES
+        first = start // self.segment_size
+        last = max(first, end // self.segment_size)
+        offset = len(self.header) + first * stored
+        length = min((last - first + 1) * stored, self.source.size - offset)
+
+        # Decrypt in batches that start at one segment (for time to first
+        # byte) and double up to CRYPTO_BATCH_SIZE
+        index = first
+        batch = []
+        batch_target = stored
+        blocks = iter_blocks(
+            timed_stream("ipfs_fetch", self.source.stream(offset, length)), stored
+        )
+        while True:
+            block = await anext(blocks, None)
+            if block is not None:
+                batch.append(block)
+                if len(batch) * stored < batch_target:
+                    continue
+            if not batch:
+                break
+            for plain in await self._open(index, batch):
+                seg_start = index * self.segment_size
+                lo = max(start - seg_start, 0)
+                hi = min(end - seg_start + 1, len(plain))
+                if lo < hi:
+                    yield plain[lo:hi]
+                index += 1
+            batch = []
+            batch_target = min(batch_target * 2, CRYPTO_BATCH_SIZE)
+            if block is None:
+                break
+        if index <= last:
+            raise ValueError("Truncated share")
+
+
+class GcmShare:
+    """Single-stream AES-GCM shares (legacy and streamed layouts)"""
+
+    def __init__(self, source, aes_key, nonce, tag, data_offset, size, layout):
+        self.source = source
+        self.layout = layout
+        self._aes_key = aes_key
+        self._nonce = nonce
+        self._tag = tag
+        self._data_offset = data_offset
+        self.size = size
 
+    async def read_range(self, start, end):
+        if start == 0 and end == self.size - 1 or self.size == 0:
+            # Whole file: the tag can be checked, but only once everything
+            # has been decrypted
+            decryptor = Cipher(
+                algorithms.AES(self._aes_key), modes.GCM(self._nonce, self._tag)
+            ).decryptor()
+            async for chunk in timed_stream(
+                "ipfs_fetch", self.source.stream(self._data_offset, self.size)
+            ):
+                yield decryptor.update(chunk)
+            yield decryptor.finalize()
+            return
 
-def parse_range_header(range_header, file_size):
-    """Parse Range header and return (start, end) tuple"""
-    if not range_header.startswith("bytes="):
-        raise ValueError("Invalid range unit")
-    ranges = range_header[6:].split("-")
-    if len(ranges) != 2:
-        raise ValueError("Invalid range format")
-    start = int(ranges[0]) if ranges[0] else 0
-    end = int(ranges[1]) if ranges[1] else file_size - 1
-    if start >= file_size or end >= file_size or start > end:
-        raise ValueError("Unsatisfiable range")
-    return start, end
+        # GCM is CTR underneath: seek the keystream to the block holding
+        # start (counter 2 is the first data block). Partial reads cannot be
+        # authenticated in this layout.
+        block, skip = divmod(start, 16)
+        counter = self._nonce + struct.pack(">I", (2 + block) & 0xFFFFFFFF)
+        decryptor = Cipher(algorithms.AES(self._aes_key), modes.CTR(counter)).decryptor()
+        offset = block * 16
+        chunks = self.source.stream(self._data_offset + offset, end + 1 - offset)
+        async for chunk in timed_stream("ipfs_fetch", chunks):
+            plain = decryptor.update(chunk)
+            yield plain[skip:]
+            skip = max(skip - len(plain), 0)
 
 
-# # Encryption utilities
-def generate_key_pair():
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-    public_key = private_key.public_key()
-    return private_key, public_key
+# (private key PEM, wrapped key) -> AES key, most recently used last
+_aes_keys = collections.OrderedDict()
+
+
+async def unwrap_cached(private_key_pem, encrypted_key):
+    """unwrap_aes_key, remembering the result for repeat downloads"""
+    cache_key = (private_key_pem, encrypted_key)
+    aes_key = _aes_keys.get(cache_key)
+    if aes_key is None:
+        aes_key = await crypto_pool.run(
+            "rsa_unwrap", unwrap_aes_key, private_key_pem, encrypted_key
+        )
+        _aes_keys[cache_key] = aes_key
+        while len(_aes_keys) > AES_KEY_CACHE_SIZE:
+            _aes_keys.popitem(last=False)
+    else:
+        _aes_keys.move_to_end(cache_key)
+    return aes_key
+
+
+async def open_share(source, private_key_pem):
+    """Unwrap the share key and return a reader for the blob's layout"""
+    head = bytes(await source.read(0, LEGACY_HEADER_BYTES))
+    if head[:4] == SEGMENT_MAGIC:
+        header = head[:SEGMENT_HEADER_BYTES]
+        aes_key = await unwrap_cached(private_key_pem, header[-RSA_KEY_BYTES:])
+        return SegmentedShare(source, header, aes_key)
+
+    if head[:4] == STREAM_MAGIC:
+        offset = len(STREAM_MAGIC)
+        encrypted_key = head[offset : offset + RSA_KEY_BYTES]
+        offset += RSA_KEY_BYTES
+        nonce = head[offset : offset + GCM_NONCE_BYTES]
+        offset += GCM_NONCE_BYTES
+        tag = bytes(await source.read(source.size - GCM_TAG_BYTES, GCM_TAG_BYTES))
+        size = source.size - offset - GCM_TAG_BYTES
+        layout = "stream"
+    else:
+        encrypted_key = head[:256]  # RSA encrypted AES key
+        tag = head[256:272]  # GCM tag
+        nonce = head[272:284]  # GCM nonce
+        offset = LEGACY_HEADER_BYTES
+        size = source.size - offset
+        layout = "legacy"
+    aes_key = await unwrap_cached(private_key_pem, encrypted_key)
+    return GcmShare(source, aes_key, nonce, tag, offset, size, layout)
+
+
+class ByteWindow:
+    """Bounded FIFO of byte chunks between a producer and an async consumer"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.peak = 0
+        self._chunks = collections.deque()
+        self._cond = asyncio.Condition()
+        self._closed = False
+        self._error = None
+
+    async def put(self, chunk):
+        if not chunk:
+            return
+        async with self._cond:
+            # A single chunk larger than the window is still let through alone
+            await self._cond.wait_for(
+                lambda: self._closed or self.size + len(chunk) <= self.limit or not self.size
+            )
+            if self._closed:
+                raise self._error or RuntimeError("Window closed")
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            self.peak = max(self.peak, self.size)
+            self._cond.notify_all()
+
+    def bind(self, task):
+        """Fail pending puts as soon as the consuming task stops early"""
+
+        def on_done(t):
+            if not self._closed:
+                error = None if t.cancelled() else t.exception()
+                asyncio.ensure_future(
+                    self.close(error or ConnectionAbortedError("Consumer stopped"))
+                )
+
+        task.add_done_callback(on_done)
+
+    async def close(self, error=None):
+        async with self._cond:
+            self._closed = True
+            self._error = error
+            self._cond.notify_all()
+
+    async def __aiter__(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._chunks or self._closed)
+                if self._error:
+                    raise self._error
+                if not self._chunks:
+                    return
+                chunk = self._chunks.popleft()
+                self.size -= len(chunk)
+                self._cond.notify_all()
+            yield chunk
+
+
+async def pump(window, chunks):
+    """Move an async stream into a window, closing it with any error"""
+    try:
+        async for chunk in chunks:
+            await window.put(chunk)
+    except Exception as e:
+        # The consumer re-raises it from the window
+        await window.close(e)
+        return
+    await window.close()
+
+
+class AdaptiveWriter:
+    """Coalesces response writes, sizing them to how fast the transport drains"""
+
+    def __init__(self, response, min_size=WRITE_CHUNK_MIN, max_size=WRITE_CHUNK_MAX):
+        self.response = response
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+        self.first_byte_at = None
+        self._buffer = bytearray()
+
+    async def write(self, data):
+        self._buffer += data
+        # The very first bytes go out immediately to keep time to first byte low
+        while self._buffer and (
+            len(self._buffer) >= self.size or self.first_byte_at is None
+        ):
+            piece = self._buffer[: self.size]
+            del self._buffer[: len(piece)]
+            await self._send(piece)
+
+    async def flush(self):
+        if self._buffer:
+            await self._send(self._buffer)
+            self._buffer = bytearray()
+
+    async def _send(self, data):
+        started = time.monotonic()
+        sent = time.perf_counter()
+        await self.response.write(bytes(data))
+        charge_stage("write", sent)
+        elapsed = time.monotonic() - started
+        if self.first_byte_at is None:
+            self.first_byte_at = started
+        # A write that returns quickly means the socket buffer keeps up
+        if elapsed < 0.01:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > 0.2:
+            self.size = max(self.size // 2, self.min_size)
+
+
+# ========== UPLOAD PROGRESS ==========
+
+
+class ProgressSubscriber:
+    """One progress WebSocket with a single-slot mailbox.
+
+    A dedicated task sends whatever is newest in the slot, so a slow socket
+    only ever skips intermediate updates and never holds up the upload.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.pending = None
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self._send_loop())
+
+    def offer(self, message, final=False):
+        self.pending = (message, final)
+        self.wake.set()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self.wake.wait()
+                self.wake.clear()
+                message, final = self.pending
+                await self.ws.send_str(message)
+                if final:
+                    await self.ws.close()
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+
+
+class ProgressHub:
+    """Per-share upload progress with coalescing and latest-state replay.
+
+    publish() never awaits: it keeps the newest state, drops updates that
+    arrive within PROGRESS_INTERVAL of the last one unless the status changes,
+    serializes once and drops the message into each subscriber's slot.
+    Uploads handled by other workers are relayed in through the worker bus.
+    """
+
+    def __init__(self):
+        self._state = {}
+        self._last_sent = {}
+        self._subscribers = {}
+        self._finished = collections.OrderedDict()
+
+    def publish(self, share_id, progress, status="uploading", final=False):
+        payload = {"progress": progress, "status": status}
+        previous = self._state.get(share_id)
+        now = time.monotonic()
+        if not final and previous is not None:
+            if previous == payload:
+                return
+            if (
+                previous["status"] == status
+                and now - self._last_sent.get(share_id, 0) < PROGRESS_INTERVAL
+            ):
+                return
+        self._last_sent[share_id] = now
+        worker_bus.send(
+            "progress", {"share_id": share_id, "payload": payload, "final": final}
+        )
+        self.deliver(share_id, payload, final)
+
+    def deliver(self, share_id, payload, final=False):
+        """Hand an update that passed throttling, local or relayed, to subscribers"""
+        self._state[share_id] = payload
+        message = json.dumps(payload)
+        for subscriber in self._subscribers.get(share_id, ()):
+            subscriber.offer(message, final)
+
+        if final:
+            self._state.pop(share_id, None)
+            self._last_sent.pop(share_id, None)
+            self._finished[share_id] = message
+            while len(self._finished) > PROGRESS_RETAIN:
+                self._finished.popitem(last=False)
+
+    def subscribe(self, share_id, ws):
+        subscriber = ProgressSubscriber(ws)
+        if share_id in self._finished:
+            subscriber.offer(self._finished[share_id], final=True)
+            return subscriber
+        self._subscribers.setdefault(share_id, set()).add(subscriber)
+        if share_id in self._state:
+            subscriber.offer(json.dumps(self._state[share_id]))
+        return subscriber
+
+    async def unsubscribe(self, share_id, subscriber):
+        subscribers = self._subscribers.get(share_id)
+        if subscribers:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[share_id]
+        if not subscriber.task.done():
+            subscriber.task.cancel()
+
+    def fail(self, share_id):
+        """End an upload that stopped without completing, if it is still open"""
+        state = self._state.get(share_id)
+        if state is not None:
+            self.publish(share_id, state["progress"], "failed", final=True)
+
+    def stats(self):
+        return {
+            "uploads": len(self._state),
+            "subscribers": sum(len(subs) for subs in self._subscribers.values()),
+        }
+
+
+progress_hub = ProgressHub()
+
+
+# ========== STREAMING ZIP ==========
+
+
+def deflate_block(data, zdict, last):
+    """Raw-deflate one block of a member.
+
+    Blocks end on a sync flush, so compressing them independently (primed
+    with the previous block's tail) and concatenating the output gives one
+    valid deflate stream.
+    """
+    if zdict:
+        compressor = zlib.compressobj(
+            ZIP_DEFLATE_LEVEL, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+    else:
+        compressor = zlib.compressobj(ZIP_DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    return (
+        (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+        t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+    )
+
+
+class ZipMember:
+    """One file being written into a ZipStream"""
+
+    def __init__(self, archive, name, method, known=None):
+        self.archive = archive
+        self.name = name.encode("utf-8")
+        self.method = method
+        self.offset = archive.offset
+        self.date, self.time = dos_datetime(time.time())
+        # (size, crc32) when both are known up front, no descriptor needed
+        self.known = known
+        self.crc = 0
+        self.size = 0
+        self.compressed = 0
+        self._pending = bytearray()
+        self._tail = b""
+        self._blocks = collections.deque()
+
+    async def start(self):
+        # Otherwise sizes follow in a zip64 data descriptor, as zipfile does
+        # when streaming with force_zip64
+        size, crc = self.known or (0, 0)
+        await self.archive._emit(
+            struct.pack(
+                "<4sHHHHHLLLHH",
+                b"PK\x03\x04",
+                45,
+                0x0800 if self.known else 0x0808,  # UTF-8 names, data descriptor
+                self.method,
+                self.time,
+                self.date,
+                crc,
+                0xFFFFFFFF,
+                0xFFFFFFFF,
+                len(self.name),
+                20,
+            )
+            + self.name
+            + struct.pack("<HHQQ", 1, 16, size, size)
+        )
+
+    async def _output(self, data):
+        self.compressed += len(data)
+        await self.archive._emit(data)
+
+    def _submit(self, last):
+        block = bytes(self._pending)
+        self._pending = bytearray()
+        self._blocks.append(
+            asyncio.ensure_future(
+                crypto_pool.run(
+                    "deflate", deflate_block, block, self._tail, last, size=len(block)
+                )
+            )
+        )
+        self._tail = block[-32768:]
+
+    async def write(self, chunk):
+        self.crc = zlib.crc32(chunk, self.crc)
+        self.size += len(chunk)
+        if self.method == ZIP_STORED:
+            await self._output(chunk)
+            return
+        self._pending += chunk
+        if len(self._pending) >= CRYPTO_BATCH_SIZE:
+            self._submit(False)
+            # Keep a few blocks deflating at once, output stays in order
+            while len(self._blocks) >= ZIP_PARALLEL_BLOCKS:
+                await self._output(await self._blocks.popleft())
+
+    async def close(self):
+        if self.method != ZIP_STORED:
+            self._submit(True)
+            while self._blocks:
+                await self._output(await self._blocks.popleft())
+        if self.known:
+            if (self.size, self.crc) != self.known:
+                raise ValueError(f"Member {self.name!r} does not match its size or CRC")
+        else:
+            await self.archive._emit(
+                struct.pack(
+                    "<4sLQQ", b"PK\x07\x08", self.crc, self.compressed, self.size
+                )
+            )
+        self.archive.members.append(self)
+
+    def abort(self):
+        for block in self._blocks:
+            block.cancel()
+
+    def central_record(self):
+        extra = b""
+        fields = []
+        size, compressed, offset = self.size, self.compressed, self.offset
+        if size >= 0xFFFFFFFF:
+            fields.append(size)
+            size = 0xFFFFFFFF
+        if compressed >= 0xFFFFFFFF:
+            fields.append(compressed)
+            compressed = 0xFFFFFFFF
+        if offset >= 0xFFFFFFFF:
+            fields.append(offset)
+            offset = 0xFFFFFFFF
+        if fields:
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields)
+        return (
+            struct.pack(
+                "<4sHHHHHHLLLHHHHHLL",
+                b"PK\x01\x02",
+                45,
+                45,
+                0x0800 if self.known else 0x0808,
+                self.method,
+                self.time,
+                self.date,
+                self.crc,
+                compressed,
+                size,
+                len(self.name),
+                len(extra),
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                offset,
+            )
+            + self.name
+            + extra
+        )
+
+
+class ZipStream:
+    """Writes a zip archive front to back into an async sink.
+
+    Nothing is ever sought back to, so the archive can go straight into the
+    encryption stage while the files are still being uploaded. Members are
+    stored when their type or first chunk says deflate would not pay off.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self.offset = 0
+        self.members = []
+
+    async def _emit(self, data):
+        if data:
+            self.offset += len(data)
+            await self._sink(data)
+
+    @staticmethod
+    def choose_method(content_type, sample):
+        if content_type and content_type.lower().startswith(STORED_CONTENT_TYPES):
+            return ZIP_STORED
+        if sample and len(deflate_block(sample, b"", True)) > len(sample) * ZIP_STORE_RATIO:
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    async def open(self, name, content_type, sample):
+        """Start a member, sample being its first chunk (not yet written)"""
+        member = ZipMember(self, name, self.choose_method(content_type, sample))
+        await member.start()
+        return member
+
+    async def open_stored(self, name, size, crc):
+        """Start a member stored as is, whose size and CRC are known"""
+        member = ZipMember(self, name, ZIP_STORED, known=(size, crc))
+        await member.start()
+        return member
+
+    @staticmethod
+    def stored_size(members):
+        """Exact length of an archive of (name, size) members from open_stored"""
+        offset = 0
+        central = 0
+        for name, size in members:
+            name_length = len(name.encode("utf-8"))
+            overflow = 2 * (size >= 0xFFFFFFFF) + (offset >= 0xFFFFFFFF)
+            offset += 30 + name_length + 20 + size
+            central += 46 + name_length + (4 + 8 * overflow if overflow else 0)
+        end = offset + central + 22
+        if len(members) >= 0xFFFF or central >= 0xFFFFFFFF or offset >= 0xFFFFFFFF:
+            end += 56 + 20
+        return end
+
+    async def close(self):
+        start = self.offset
+        for member in self.members:
+            await self._emit(member.central_record())
+        size = self.offset - start
+        count = len(self.members)
+
+        if count >= 0xFFFF or size >= 0xFFFFFFFF or start >= 0xFFFFFFFF:
+            zip64_end = self.offset
+            await self._emit(
+                struct.pack(
+                    "<4sQHHLLQQQQ",
+                    b"PK\x06\x06",
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    size,
+                    start,
+                )
+                + struct.pack("<4sLQL", b"PK\x06\x07", 0, zip64_end, 1)
+            )
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            start = min(start, 0xFFFFFFFF)
+        await self._emit(
+            struct.pack("<4sHHHHLLH", b"PK\x05\x06", 0, 0, count, count, size, start, 0)
+        )
+
+
+# ========== COMPRESSION ==========
+
+
+def byte_entropy(sample):
+    """Shannon entropy of a sample in bits per byte (8 for random data)"""
+    total = len(sample)
+    return -sum(
+        n / total * math.log2(n / total)
+        for n in collections.Counter(sample).values()
+    )
+
+
+def compression_codec():
+    return "zstd" if zstandard and COMPRESSION == "auto" else "deflate"
+
+
+def choose_compression(content_type, sample, size):
+    """(codec, level) to compress a file with before encryption, or None.
+
+    Known compressed types, short files and samples that look random are
+    stored as they are; anything else must shrink its first chunk below
+    COMPRESSION_RATIO. The level goes down as the file gets bigger.
+    """
+    if COMPRESSION == "off" or len(sample) < COMPRESSION_MIN_SIZE:
+        return None
+    if content_type and content_type.lower().startswith(STORED_CONTENT_TYPES):
+        return None
+    sample = sample[:COMPRESSION_SAMPLE]
+    if byte_entropy(sample) > COMPRESSION_MAX_ENTROPY:
+        return None
+    codec = compression_codec()
+    for limit, zstd_level, zlib_level in COMPRESSION_LEVELS:
+        if limit is None or size <= limit:
+            level = zstd_level if codec == "zstd" else zlib_level
+            break
+    trial = FrameCompressor(codec, level)
+    if len(trial.compress(sample) + trial.flush()) > len(sample) * COMPRESSION_RATIO:
+        return None
+    return codec, level
+
+
+class FrameCompressor:
+    """Compresses a file one COMPRESSION_FRAME_SIZE frame at a time, each
+    decodable without the ones before it.
+
+    zstd frames are standalone zstd frames; deflate frames end in a full
+    flush, which resets the window but keeps a single valid zlib stream.
+    Either way the output can go out as is with a Content-Encoding.
+    """
+
+    def __init__(self, codec, level):
+        self.codec = codec
+        self.offsets = []  # where each frame starts in the output
+        self.size = 0
+        if codec == "zstd":
+            self._zstd = zstandard.ZstdCompressor(level=level)
+        else:
+            self._zlib = zlib.compressobj(level)
+
+    def compress(self, frame):
+        self.offsets.append(self.size)
+        if self.codec == "zstd":
+            data = self._zstd.compress(frame)
+        else:
+            data = self._zlib.compress(frame) + self._zlib.flush(zlib.Z_FULL_FLUSH)
+        self.size += len(data)
+        return data
+
+    def flush(self):
+        """The end of the stream, part of the last frame"""
+        data = b"" if self.codec == "zstd" else self._zlib.flush()
+        self.size += len(data)
+        return data
 
+    @property
+    def index(self):
+        return struct.pack(f">{len(self.offsets)}Q", *self.offsets)
 
-from zipfile import ZipFile
+
+def unpack_frames(packed):
+    """Frame offsets from a packed index, None for a single stream"""
+    return list(struct.unpack(f">{len(packed) // 8}Q", packed)) if packed else None
+
+
+def frame_decoder(codec, first):
+    """Decoder for one frame; deflate frames after the first are raw deflate"""
+    if codec == "zstd":
+        if not zstandard:
+            raise RuntimeError("zstd share but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(zlib.MAX_WBITS if first else -zlib.MAX_WBITS)
+
+
+async def frame_pieces(chunks, bounds):
+    """(frame, data) pieces of stored bytes from bounds[0] to bounds[-1],
+    split where each frame ends and batched up to CRYPTO_BATCH_SIZE"""
+    frame, offset = 0, bounds[0]
+    pending = bytearray()
+    async for chunk in chunks:
+        pending += chunk
+        while pending:
+            size = min(bounds[frame + 1] - offset, CRYPTO_BATCH_SIZE)
+            if len(pending) < size:
+                break
+            yield frame, bytes(pending[:size])
+            del pending[:size]
+            offset += size
+            if offset == bounds[frame + 1]:
+                frame += 1
+    if pending:
+        yield frame, bytes(pending)
+
+
+async def decompress_range(share, codec, frames, start, end):
+    """Plaintext bytes start..end of a compressed share.
+
+    With frames, the stored offsets of its frames, only the frames holding
+    the range are fetched and decoded. Shares compressed as one stream
+    (frames is None) are decoded from their beginning.
+    """
+    if frames:
+        first = start // COMPRESSION_FRAME_SIZE
+        bounds = frames[first : end // COMPRESSION_FRAME_SIZE + 2]
+        if len(bounds) < end // COMPRESSION_FRAME_SIZE - first + 2:
+            bounds.append(share.size)
+    else:
+        first, bounds = 0, [0, share.size]
+    position = first * COMPRESSION_FRAME_SIZE
+    current = decoder = None
+    chunks = share.read_range(bounds[0], bounds[-1] - 1)
+    async for frame, data in frame_pieces(chunks, bounds):
+        if frame != current:
+            current, decoder = frame, frame_decoder(codec, first + frame == 0)
+        data = await crypto_pool.run_local(
+            "decompress", decoder.decompress, data, size=len(data)
+        )
+        if position + len(data) > start:
+            yield data[max(0, start - position) : end + 1 - position]
+        position += len(data)
+        if position > end:
+            break
+
+
+def accepts_encoding(request, coding):
+    """Whether Accept-Encoding allows coding (q=0 refuses it)"""
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() in (coding, "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+# ========== UPLOAD ==========
+
+
+class EncryptedUpload:
+    """Segment-encrypts plaintext as it arrives into a new IPFS object,
+    optionally compressing it first (see compress)"""
+
+    def __init__(self, public_key):
+        self._encryptor = SegmentEncryptor(public_key)
+        self._window = ByteWindow(UPLOAD_WINDOW_SIZE)
+        self._task = asyncio.create_task(ipfs.add_stream(self._window))
+        self._window.bind(self._task)
+        self._started = False
+        self.codec = None
+        self._compressor = None
+        self._pending = bytearray()
+
+    def compress(self, choice):
+        """Compress what is written from now on with (codec, level), if given"""
+        if choice:
+            self.codec = choice[0]
+            self._compressor = FrameCompressor(*choice)
+
+    @property
+    def encoded_size(self):
+        """Compressed bytes stored, with a codec"""
+        return self._compressor.size if self._compressor else None
+
+    @property
+    def frames(self):
+        """Packed frame index, with a codec"""
+        return self._compressor.index if self._compressor else None
+
+    async def _compress(self, frame):
+        # The compressor is stateful so it runs on a thread
+        return await crypto_pool.run_local(
+            "compress", self._compressor.compress, frame, size=len(frame)
+        )
+
+    async def _put(self, data):
+        # Time spent here is IPFS not keeping up with the encrypted stream
+        started = time.perf_counter()
+        await self._window.put(data)
+        charge_stage("ipfs_add", started)
+
+    async def write(self, chunk):
+        if not self._started:
+            self._started = True
+            await self._put(self._encryptor.header)
+        if not self._compressor:
+            await self._put(await self._encryptor.update(chunk))
+            return
+        self._pending += chunk
+        while len(self._pending) >= COMPRESSION_FRAME_SIZE:
+            frame = bytes(self._pending[:COMPRESSION_FRAME_SIZE])
+            del self._pending[:COMPRESSION_FRAME_SIZE]
+            await self._put(await self._encryptor.update(await self._compress(frame)))
+
+    async def finish(self):
+        """Seal the last segment and return the IPFS hash"""
+        if not self._started:
+            await self.write(b"")
+        if self._compressor:
+            data = await self._compress(bytes(self._pending)) if self._pending else b""
+            data += self._compressor.flush()
+            await self._put(await self._encryptor.update(data))
+        await self._put(await self._encryptor.finalize())
+        await self._window.close()
+        return await timed_stage("ipfs_add", self._task)
+
+    @property
+    def peak(self):
+        return self._window.peak
+
+    async def abort(self):
+        if not self._task.done():
+            await self._window.close(ConnectionAbortedError("Upload aborted"))
+            self._task.cancel()
+
+
+def unique_name(name, taken):
+    """name, or name with a counter before the suffix if already taken"""
+    candidate = name
+    stem, suffix = Path(name).stem, Path(name).suffix
+    n = 1
+    while candidate in taken:
+        candidate = f"{stem} ({n}){suffix}"
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+
+async def bundle_member(upload, public_key, private_key_pem, size, crc):
+    """A finished single-file upload as a bundle member, whose files are
+    stored uncompressed: as is, or decompressed into a new object"""
+    ipfs_hash = await upload.finish()
+    if upload.codec:
+        source = await IPFSBlobSource.open(ipfs, ipfs_hash)
+        plain = EncryptedUpload(public_key)
+        try:
+            share = await open_share(source, private_key_pem)
+            frames = unpack_frames(upload.frames)
+            async for chunk in decompress_range(
+                share, upload.codec, frames, 0, size - 1
+            ):
+                await plain.write(chunk)
+            stored, ipfs_hash = ipfs_hash, await plain.finish()
+        except BaseException:
+            await plain.abort()
+            raise
+        finally:
+            source.close()
+        await unpin_many({stored})
+    return {"size": size, "crc32": crc, "ipfs_hash": ipfs_hash}
+
+
+def share_links_response(share_id, filename, max_downloads, sha256=None, files=None):
+    return web.json_response(
+        {
+            "share_links": [
+                {
+                    "share_id": share_id,
+                    "share_link": f"http://{service_id}.onion/download/{share_id}",
+                    "filename": filename,
+                    "max_downloads": max_downloads,
+                    "sha256": sha256,
+                    "files": files,
+                }
+            ]
+        }
+    )
 
 
 async def upload_file(request):
+    share_id = None
+    upload = None
+    member = None
+    orphans = set()
     try:
         reader = await request.multipart()
         if not reader:
@@ -368,149 +3965,630 @@ async def upload_file(request):
                 {"error": "Max downloads must be at least 1"}, status=400
             )
 
-        private_key, public_key = generate_key_pair()
-        share_id = request.query.get("share_id") or secrets.token_urlsafe(16)
-        upload_progress_store[share_id] = 0
+        share_id = request.query.get("share_id") or secrets.token_urlsafe(16)
+        progress_hub.publish(share_id, 0)
+
+        # With a zip_name files become one zip archive; with mode=bundle as
+        # well, every file is stored on its own behind an encrypted manifest,
+        # so recipients can fetch single files. Several files without a
+        # zip_name make a bundle called bundle.zip.
+        bundled = "zip_name" in request.query
+        split = bundled and request.query.get("mode") == "bundle"
+        total_size = request.content_length or 0
+        processed = 0
+
+        # Single files are deduplicated on their plaintext SHA-256. A client
+        # that already knows the digest of stored content (the sha256 query)
+        # only has its bytes hashed to prove it, nothing is encrypted or added.
+        # Whether or not the content is stored, a claim is checked against
+        # the bytes and refused alike, so it cannot be used to probe for it.
+        digest = None if bundled else hashlib.sha256()
+        claimed = request.query.get("sha256", "").lower()
+        reuse = not bundled and claimed and await share_metadata.find_blob(claimed)
+
+        if not reuse:
+            public_key, private_key_pem = await key_pool.get()
+        if not reuse and not split:
+            upload = EncryptedUpload(public_key)
+        if bundled and not split:
+            # The archive is encrypted as it is written, in a single pass
+            archive = ZipStream(upload.write)
+
+        members = []
+        taken = set()
+        file_count = 0
+        crc = 0
+        async for part in reader:
+            if part.name != "files":
+                continue
+            file_count += 1
+            if file_count > 1 and not bundled:
+                # Only now is it known there are several: the file already
+                # stored becomes the first member of a bundle
+                if claimed:
+                    raise ValueError("sha256 applies to a single file")
+                first = await bundle_member(
+                    upload, public_key, private_key_pem, processed, crc
+                )
+                upload = None
+                orphans.add(first["ipfs_hash"])
+                first.update(
+                    name=unique_name(filename, taken),
+                    content_type=content_type,
+                    sha256=digest.hexdigest(),
+                )
+                members.append(first)
+                bundled = split = True
+
+            filename = Path(part.filename).name
+            content_type = part.headers.get("Content-Type", "application/octet-stream")
+            if split:
+                # Members share the bundle's key pair but not their AES keys
+                upload = EncryptedUpload(public_key)
+                digest = hashlib.sha256()
+                crc = 0
+                size = 0
+
+            while True:
+                received = time.perf_counter()
+                chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                charge_stage("receive", received)
+                if bundled and not split and not member:
+                    # The first chunk decides whether the member is deflated
+                    member = await archive.open(filename, content_type, chunk)
+                if not chunk:
+                    break
+                processed += len(chunk)
+                if split:
+                    digest.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    await upload.write(chunk)
+                elif bundled:
+                    await member.write(chunk)
+                else:
+                    digest.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    if not reuse:
+                        if processed == len(chunk):
+                            # The first chunk decides whether the file is compressed
+                            choice = await crypto_pool.run_local(
+                                "compress",
+                                choose_compression,
+                                content_type,
+                                chunk,
+                                total_size,
+                            )
+                            upload.compress(choice)
+                        await upload.write(chunk)
+
+                if total_size:
+                    progress_hub.publish(
+                        share_id, min(90, int((processed / total_size) * 90))
+                    )
+
+            if split:
+                ipfs_hash = await upload.finish()
+                upload = None
+                orphans.add(ipfs_hash)
+                members.append(
+                    {
+                        "name": unique_name(filename, taken),
+                        "content_type": content_type,
+                        "size": size,
+                        "crc32": crc,
+                        "sha256": digest.hexdigest(),
+                        "ipfs_hash": ipfs_hash,
+                    }
+                )
+            elif bundled:
+                await member.close()
+                member = None
+
+        if file_count == 0:
+            raise ValueError("No valid files uploaded")
+        if claimed and not bundled and digest.hexdigest() != claimed:
+            raise ValueError("Content does not match sha256")
+
+        if bundled:
+            filename = request.query.get("zip_name") or "bundle.zip"
+            if not filename.endswith(".zip"):
+                filename += ".zip"
+            content_type = "application/zip"
+
+        expires_at = time.time() + DEFAULT_TTL
+        if split:
+            # The manifest makes the bundle recoverable from IPFS with its key
+            upload = EncryptedUpload(public_key)
+            await upload.write(
+                json.dumps({"version": 1, "name": filename, "files": members}).encode()
+            )
+            manifest_hash = await upload.finish()
+            upload = None
+            orphans.add(manifest_hash)
+            await timed_stage(
+                "db",
+                share_metadata.create_bundle_share(
+                    manifest_hash,
+                    filename,
+                    private_key_pem,
+                    members,
+                    max_downloads=max_downloads,
+                    expires_at=expires_at,
+                    share_id=share_id,
+                ),
+            )
+            orphans.clear()
+            logger.info(f"Stored bundle {share_id} with {len(members)} files")
+        elif reuse:
+            try:
+                await timed_stage(
+                    "db",
+                    share_metadata.create_blob_share(
+                        claimed,
+                        processed,
+                        filename,
+                        content_type,
+                        max_downloads=max_downloads,
+                        expires_at=expires_at,
+                        share_id=share_id,
+                    ),
+                )
+            except LookupError:
+                return web.json_response(
+                    {"error": "Stored content was released, upload it again"},
+                    status=409,
+                )
+            logger.info(f"Deduplicated upload {share_id} onto {claimed}")
+        else:
+            if bundled:
+                await archive.close()
+            ipfs_hash = await upload.finish()
+            logger.info(
+                f"Streamed {processed} bytes to IPFS for {share_id} (peak window {upload.peak} bytes)"
+            )
+            codec = upload.codec
+            encoded_size, frames = upload.encoded_size, upload.frames
+            upload = None
+
+            if bundled:
+                await timed_stage(
+                    "db",
+                    share_metadata.create_share(
+                        ipfs_hash,
+                        filename,
+                        content_type,
+                        private_key_pem,
+                        max_downloads=max_downloads,
+                        expires_at=expires_at,
+                        share_id=share_id,
+                        size=archive.offset,
+                        layout=SegmentedShare.layout,
+                    ),
+                )
+            else:
+                stored_hash = await timed_stage(
+                    "db",
+                    share_metadata.create_blob_share(
+                        digest.hexdigest(),
+                        processed,
+                        filename,
+                        content_type,
+                        max_downloads=max_downloads,
+                        expires_at=expires_at,
+                        share_id=share_id,
+                        ipfs_hash=ipfs_hash,
+                        private_key=private_key_pem,
+                        codec=codec,
+                        layout=SegmentedShare.layout,
+                        encoded_size=encoded_size,
+                        frames=frames,
+                    ),
+                )
+                if stored_hash != ipfs_hash:
+                    # Same content was already stored, keep that copy only
+                    logger.info(f"Deduplicated upload {share_id} onto {stored_hash}")
+                    await unpin_many({ipfs_hash})
+        expiry_scheduler.announce(share_id, expires_at)
+
+        progress_hub.publish(share_id, 100, "complete", final=True)
+
+        return share_links_response(
+            share_id,
+            filename,
+            max_downloads,
+            sha256=None if bundled else digest.hexdigest(),
+            files=[member["name"] for member in members] if split else None,
+        )
+
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Upload error: {e}", exc_info=True)
+        return web.json_response({"error": "Internal server error"}, status=500)
+    finally:
+        if share_id:
+            progress_hub.fail(share_id)
+        if upload:
+            await upload.abort()
+        if member:
+            member.abort()
+        if orphans:
+            # Members stored before the upload failed
+            await unpin_many(orphans)
+
+
+# ========== RESUMABLE UPLOADS ==========
+
+
+class UploadSession:
+    """A resumable upload being sealed into its spool file.
+
+    Only whole segments reach the spool and the database; the tail of the
+    data received so far stays in memory, so after a restart the client
+    resends from the last sealed segment. Segments are written at their own
+    offset in the spool rather than appended, so a worker that picks the
+    session up from the database can carry on from any sealed segment.
+    """
+
+    def __init__(self, row, encryptor, path):
+        self.row = row
+        self.session_id = row["session_id"]
+        self.share_id = row["share_id"]
+        self.size = row["size"]
+        self.encryptor = encryptor
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.sealed_tail = False
+        self._committed = encryptor.sealed
+        self._checkpoint = None
+        # Whole-file digest for deduplication. hashlib cannot save its state,
+        # so a session picked up after a restart or by another worker has
+        # none and its upload is stored without deduplication.
+        self.digest = hashlib.sha256() if encryptor.sealed == 0 else None
+
+    @property
+    def offset(self):
+        # Sealing the tail rounds the encryptor up to a whole segment
+        return self.size if self.sealed_tail else self.encryptor.received
+
+    def _spool_offset(self, plaintext_offset):
+        """Where the segment starting at plaintext_offset sits in the spool"""
+        segment_size = self.encryptor.segment_size
+        index = plaintext_offset // segment_size
+        return len(self.encryptor.header) + index * (segment_size + GCM_TAG_BYTES)
+
+    async def _write_at(self, offset, data):
+        def write():
+            with open(self.path, "r+b") as f:
+                f.seek(offset)
+                f.write(data)
+
+        await asyncio.get_running_loop().run_in_executor(None, write)
+
+    def begin(self):
+        """Start a chunk, which is kept only if commit() is reached"""
+        digest = self.digest and self.digest.copy()
+        self._checkpoint = self.encryptor.checkpoint(), digest
+
+    async def write(self, data):
+        if self.digest:
+            self.digest.update(data)
+        offset = self._spool_offset(self.encryptor.sealed)
+        sealed = await self.encryptor.update(data)
+        if sealed:
+            await timed_stage("spool", self._write_at(offset, sealed))
+
+    async def commit(self):
+        self._checkpoint = None
+        if self.encryptor.sealed > self._committed:
+            self._committed = self.encryptor.sealed
+            committed = share_metadata.commit_upload(self.session_id, self._committed)
+            await timed_stage("db", committed)
+
+    def rollback(self):
+        """Forget the chunk being written, if it was not committed. Segments
+        it sealed stay in the spool past the commit, to be overwritten."""
+        if self._checkpoint:
+            encryptor_state, self.digest = self._checkpoint
+            self.encryptor.restore(encryptor_state)
+            self._checkpoint = None
+
+    async def finish(self):
+        """Seal the tail and add the spool to IPFS, returning its hash"""
+        if not self.sealed_tail:
+            offset = self._spool_offset(self.encryptor.sealed)
+            await self._write_at(offset, await self.encryptor.finalize())
+            self.sealed_tail = True
+        # Another worker may have left segments past the end of this share
+        segments = max(1, -(-self.size // self.encryptor.segment_size))
+        remaining = len(self.encryptor.header) + self.size + segments * GCM_TAG_BYTES
+
+        window = ByteWindow(UPLOAD_WINDOW_SIZE)
+        add_task = asyncio.create_task(ipfs.add_stream(window))
+        window.bind(add_task)
+        loop = asyncio.get_running_loop()
+        try:
+            with open(self.path, "rb") as f:
+                while remaining:
+                    chunk = await loop.run_in_executor(
+                        None, f.read, min(remaining, CRYPTO_BATCH_SIZE)
+                    )
+                    if not chunk:
+                        raise IOError("Upload spool is incomplete")
+                    remaining -= len(chunk)
+                    await window.put(chunk)
+            await window.close()
+            return await add_task
+        finally:
+            if not add_task.done():
+                await window.close(ConnectionAbortedError("Upload aborted"))
+                add_task.cancel()
+
+
+class UploadSessions:
+    """Resumable upload sessions, persisted in the metadata database"""
+
+    def __init__(self, directory=UPLOAD_SPOOL_DIR):
+        self.directory = directory
+        self._live = {}
+        self._task = None
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, session_id)
+
+    async def create(self, share_id, filename, content_type, size, max_downloads):
+        public_key, private_key_pem = await key_pool.get()
+        encryptor = SegmentEncryptor(public_key)
+        row = {
+            "session_id": secrets.token_urlsafe(16),
+            "share_id": share_id,
+            "filename": filename,
+            "content_type": content_type,
+            "size": size,
+            "max_downloads": max_downloads,
+            "private_key": private_key_pem,
+            "header": encryptor.header,
+            "updated_at": time.time(),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(row["session_id"])
+        with open(path, "wb") as f:
+            f.write(encryptor.header)
+        await share_metadata.create_upload_session(row)
+        session = UploadSession(row, encryptor, path)
+        self._live[session.session_id] = session
+        return session
+
+    async def get(self, session_id):
+        session = self._live.get(session_id)
+        if session and WORKERS > 1:
+            # Chunks may have gone to another worker since we last saw it
+            row = await share_metadata.get_upload_session(session_id)
+            if not row or row["committed"] > session.encryptor.sealed:
+                self._live.pop(session_id, None)
+                session = None
+        if session:
+            return session
+        row = await share_metadata.get_upload_session(session_id)
+        path = self._path(session_id)
+        if not row or not os.path.exists(path):
+            return None
+
+        # Picked up after a restart or from another worker: carry on from the
+        # last commit, later segments in the spool get overwritten
+        header = bytes(row["header"])
+        segment_size = struct.unpack(">I", header[4:8])[0]
+        index = row["committed"] // segment_size
+        aes_key = await unwrap_cached(row["private_key"], header[-RSA_KEY_BYTES:])
+        session = self._live.setdefault(
+            session_id,
+            UploadSession(row, SegmentEncryptor.resume(header, aes_key, index), path),
+        )
+        return session
+
+    async def discard(self, session_id):
+        self._live.pop(session_id, None)
+        await share_metadata.delete_upload_session(session_id)
+        try:
+            os.remove(self._path(session_id))
+        except OSError:
+            pass
+
+    async def collect(self):
+        """Remove sessions idle for UPLOAD_SESSION_TTL and stray spool files"""
+        stale = await share_metadata.stale_upload_sessions(
+            time.time() - UPLOAD_SESSION_TTL
+        )
+        for session_id in stale:
+            session = self._live.get(session_id)
+            if session and session.lock.locked():
+                continue
+            await self.discard(session_id)
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name not in self._live and not await share_metadata.get_upload_session(name):
+                    os.remove(self._path(name))
+        if stale:
+            logger.info(f"Removed {len(stale)} abandoned upload session(s)")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as e:
+                logger.error(f"Error collecting upload sessions: {e}", exc_info=True)
+            await asyncio.sleep(UPLOAD_GC_INTERVAL)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
 
-        file_parts = []
-        async for part in reader:
-            if part.name != "files":
-                continue
+upload_sessions = UploadSessions()
 
-            filename = Path(part.filename).name
-            temp_file = tempfile.NamedTemporaryFile(delete=False)
-            temp_path = temp_file.name
 
-            while True:
-                chunk = await part.read_chunk(8192)
-                if not chunk:
-                    break
-                temp_file.write(chunk)
-            temp_file.close()
+async def create_upload(request):
+    """Start a resumable upload: ?filename=&size=[&content_type=&max_downloads=&share_id=]"""
+    try:
+        filename = Path(request.query["filename"]).name
+        size = int(request.query["size"])
+        max_downloads = int(request.query.get("max_downloads", 1))
+    except (KeyError, ValueError):
+        return web.json_response({"error": "filename and size are required"}, status=400)
+    if not filename or not 0 <= size <= UPLOAD_MAX_SIZE:
+        return web.json_response({"error": "Invalid filename or size"}, status=400)
+    if max_downloads < 1:
+        return web.json_response({"error": "Max downloads must be at least 1"}, status=400)
 
-            file_parts.append(
-                {
-                    "filename": filename,
-                    "temp_path": temp_path,
-                    "content_type": part.headers.get(
-                        "Content-Type", "application/octet-stream"
-                    ),
-                }
-            )
+    session = await upload_sessions.create(
+        request.query.get("share_id") or secrets.token_urlsafe(16),
+        filename,
+        request.query.get("content_type", "application/octet-stream"),
+        size,
+        max_downloads,
+    )
+    progress_hub.publish(session.share_id, 0)
+    return web.json_response(
+        {
+            "session_id": session.session_id,
+            "share_id": session.share_id,
+            "offset": 0,
+            "size": size,
+            "chunk_size": UPLOAD_SESSION_CHUNK,
+        },
+        status=201,
+    )
 
-        if len(file_parts) == 0:
-            return web.json_response({"error": "No valid files uploaded"}, status=400)
 
-        # === If multiple files, zip them ===
-        if len(file_parts) > 1:
-            zip_path = tempfile.NamedTemporaryFile(delete=False, suffix=".zip").name
-            with ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for file in file_parts:
-                    zipf.write(file["temp_path"], arcname=file["filename"])
+async def upload_status(request):
+    session = await upload_sessions.get(request.match_info["session_id"])
+    if not session:
+        return web.json_response({"error": "Unknown upload session"}, status=404)
+    return web.json_response(
+        {"share_id": session.share_id, "offset": session.offset, "size": session.size}
+    )
 
-            filename = request.query.get("zip_name", "bundle.zip")
-            if not filename.endswith(".zip"):
-                filename += ".zip"
-            content_type = "application/zip"
-            data_path = zip_path
-        else:
-            # Single file case
-            filename = file_parts[0]["filename"]
-            content_type = file_parts[0]["content_type"]
-            data_path = file_parts[0]["temp_path"]
-
-        # === Encrypt the file ===
-        aes_key = os.urandom(32)
-        nonce = os.urandom(12)
-        cipher = Cipher(algorithms.AES(aes_key), modes.GCM(nonce))
-        encryptor = cipher.encryptor()
-        buffer = BytesIO()
-
-        total_size = os.path.getsize(data_path)
-        processed = 0
 
-        with open(data_path, "rb") as f:
-            while chunk := f.read(8192):
-                encrypted_chunk = encryptor.update(chunk)
-                buffer.write(encrypted_chunk)
-                processed += len(chunk)
+async def upload_chunk(request):
+    """Append the body at ?offset=, optionally checked against ?sha256=
 
-                progress = min(90, int((processed / total_size) * 90))
-                if share_id in websocket_connections:
-                    for ws in websocket_connections[share_id]:
-                        try:
-                            await ws.send_str(
-                                json.dumps(
-                                    {"progress": progress, "status": "uploading"}
-                                )
-                            )
-                        except:
-                            pass
-
-        buffer.write(encryptor.finalize())
-        tag = encryptor.tag
-
-        encrypted_content = (
-            public_key.encrypt(
-                aes_key,
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None,
-                ),
-            )
-            + tag
-            + nonce
-            + buffer.getvalue()
-        )
+    The offset is checked before the body is read, which is then sealed into
+    the spool as it arrives. A chunk that is cut short, too large or does not
+    match its sha256 is rolled back whole.
+    """
+    session = await upload_sessions.get(request.match_info["session_id"])
+    if not session:
+        return web.json_response({"error": "Unknown upload session"}, status=404)
+    try:
+        offset = int(request.query["offset"])
+    except (KeyError, ValueError):
+        return web.json_response({"error": "offset is required"}, status=400)
+    claimed = request.query.get("sha256")
+    length = request.content_length
 
-        ipfs_hash = ipfs.add_bytes(encrypted_content)
+    async with session.lock:
+        if offset != session.offset or session.sealed_tail:
+            # Already have it (a retried chunk) or a gap: tell where to go on
+            return web.json_response(
+                {"error": "Offset mismatch", "offset": session.offset}, status=409
+            )
+        if length is not None and length > UPLOAD_MAX_CHUNK:
+            return web.json_response({"error": "Chunk too large"}, status=413)
+        if length is not None and offset + length > session.size:
+            return web.json_response({"error": "Chunk exceeds declared size"}, status=400)
 
-        await share_metadata.create_share(
-            ipfs_hash,
-            filename,
-            content_type,
-            private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption(),
-            ).decode(),
-            max_downloads=max_downloads,
-            share_id=share_id,
-        )
-
-        # Cleanup temp files
-        for f in file_parts:
-            os.remove(f["temp_path"])
-        if len(file_parts) > 1:
-            os.remove(zip_path)
-
-        if share_id in websocket_connections:
-            for ws in websocket_connections[share_id]:
-                try:
-                    await ws.send_str(
-                        json.dumps({"progress": 100, "status": "complete"})
+        digest = hashlib.sha256()
+        received = 0
+        session.begin()
+        try:
+            async for chunk in timed_stream(
+                "receive", request.content.iter_chunked(UPLOAD_CHUNK_SIZE)
+            ):
+                received += len(chunk)
+                if received > UPLOAD_MAX_CHUNK:
+                    return web.json_response({"error": "Chunk too large"}, status=413)
+                if offset + received > session.size:
+                    return web.json_response(
+                        {"error": "Chunk exceeds declared size"}, status=400
                     )
-                    await ws.close()
-                except:
-                    pass
+                if claimed:
+                    digest.update(chunk)
+                await session.write(chunk)
+            if claimed and digest.hexdigest() != claimed.lower():
+                return web.json_response(
+                    {"error": "Chunk does not match sha256", "offset": offset},
+                    status=400,
+                )
+            await session.commit()
+        finally:
+            session.rollback()
+        if session.size:
+            progress_hub.publish(
+                session.share_id, min(90, int(session.offset / session.size * 90))
+            )
+        return web.json_response({"offset": session.offset})
 
-        return web.json_response(
-            {
-                "share_links": [
-                    {
-                        "share_id": share_id,
-                        "share_link": f"http://{service_id}.onion/download/{share_id}",
-                        "filename": filename,
-                        "max_downloads": max_downloads,
-                    }
-                ]
-            }
-        )
 
-    except Exception as e:
-        logger.error(f"Upload error: {e}", exc_info=True)
-        return web.json_response({"error": "Internal server error"}, status=500)
+async def finalize_upload(request):
+    session = await upload_sessions.get(request.match_info["session_id"])
+    if not session:
+        return web.json_response({"error": "Unknown upload session"}, status=404)
+
+    async with session.lock:
+        if session.offset != session.size:
+            return web.json_response(
+                {"error": "Upload incomplete", "offset": session.offset}, status=409
+            )
+        try:
+            ipfs_hash = await timed_stage("ipfs_add", session.finish())
+        except Exception as e:
+            # The spool is complete, finalize can simply be retried
+            logger.error(f"Upload error: {e}", exc_info=True)
+            return web.json_response({"error": "Failed to store upload"}, status=502)
+
+        row = session.row
+        expires_at = time.time() + DEFAULT_TTL
+        digest = session.digest.hexdigest() if session.digest else None
+        if digest:
+            stored_hash = await share_metadata.create_blob_share(
+                digest,
+                session.size,
+                row["filename"],
+                row["content_type"],
+                max_downloads=row["max_downloads"],
+                expires_at=expires_at,
+                share_id=session.share_id,
+                ipfs_hash=ipfs_hash,
+                private_key=row["private_key"],
+                layout=SegmentedShare.layout,
+            )
+            if stored_hash != ipfs_hash:
+                logger.info(f"Deduplicated upload {session.share_id} onto {stored_hash}")
+                await unpin_many({ipfs_hash})
+        else:
+            await share_metadata.create_share(
+                ipfs_hash,
+                row["filename"],
+                row["content_type"],
+                row["private_key"],
+                max_downloads=row["max_downloads"],
+                expires_at=expires_at,
+                share_id=session.share_id,
+                size=session.size,
+                layout=SegmentedShare.layout,
+            )
+        expiry_scheduler.announce(session.share_id, expires_at)
+        await upload_sessions.discard(session.session_id)
+        logger.info(f"Finalized resumable upload {session.share_id} ({session.size} bytes)")
+
+    progress_hub.publish(session.share_id, 100, "complete", final=True)
+    return share_links_response(
+        session.share_id, row["filename"], row["max_downloads"], sha256=digest
+    )
 
 
 async def websocket_progress(request):
@@ -523,10 +4601,8 @@ async def websocket_progress(request):
     await ws.prepare(request)
     logger.info(f"WebSocket connected for share_id: {share_id}")
 
-    # Store WebSocket connection
-    if share_id not in websocket_connections:
-        websocket_connections[share_id] = []
-    websocket_connections[share_id].append(ws)
+    # Current progress is sent right away, then updates as they come
+    subscriber = progress_hub.subscribe(share_id, ws)
 
     try:
         # Keep WebSocket open until upload completes or client disconnects
@@ -540,11 +4616,7 @@ async def websocket_progress(request):
                     )
                     break
     finally:
-        # Clean up WebSocket connection
-        if share_id in websocket_connections and ws in websocket_connections[share_id]:
-            websocket_connections[share_id].remove(ws)
-        if not websocket_connections[share_id]:
-            del websocket_connections[share_id]
+        await progress_hub.unsubscribe(share_id, subscriber)
         logger.info(f"WebSocket disconnected for share_id: {share_id}")
         await ws.close()
     return ws
@@ -552,15 +4624,14 @@ async def websocket_progress(request):
 
 async def stop_sharing(request):
     share_id = request.match_info["share_id"]
-    ipfs_hash = share_metadata.stop_share(share_id)
-    if not ipfs_hash:
+    unpin = await share_metadata.stop_share(share_id)
+    if unpin is None:
         return web.json_response({"error": "Invalid share ID"}, status=404)
 
-    try:
-        ipfs.pin.rm(ipfs_hash)
-    except Exception as e:
-        logger.warning(f"Failed to unpin IPFS hash {ipfs_hash}: {e}")
+    # Content other shares still use stays pinned
+    await unpin_many(set(unpin))
 
+    share_events.publish(share_id, "stopped")
     logger.info(f"Stopped sharing for share_id: {share_id}")
     return web.json_response({"status": "stopped", "share_id": share_id})
 
@@ -570,117 +4641,1007 @@ async def cors_middleware(app, handler):
     async def middleware(request):
         response = await handler(request)
         response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Methods"] = "GET, HEAD, POST, OPTIONS"
         response.headers["Access-Control-Allow-Headers"] = (
-            "Content-Type, Accept, X-Requested-With, Upgrade, Connection"
+            "Content-Type, Accept, X-Requested-With, Upgrade, Connection, Range"
+        )
+        response.headers["Access-Control-Expose-Headers"] = (
+            "ETag, X-Revision, X-Next-Cursor, X-Download-Session"
         )
         return response
 
     return middleware
 
 
-# Rate limiting middleware
-from aiohttp import web
+# ========== RATE LIMITING ==========
+
+
+def take_tokens(limits, buckets, now):
+    """Take one token from every (key, capacity, period) bucket, or none.
+
+    A bucket is just (tokens, last_seen) in buckets, and a missing one is
+    full: refill is computed from the elapsed time whenever the bucket is
+    touched, so there are no timers. Returns (0, [(key, tokens left)]) when
+    allowed, otherwise the seconds until a retry can succeed and no change.
+    """
+    levels = []
+    retry_after = 0
+    for key, capacity, period in limits:
+        rate = capacity / period
+        tokens, last = buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+        if tokens < 1:
+            retry_after = max(retry_after, (1 - tokens) / rate)
+        levels.append((key, tokens - 1))
+    return (retry_after, []) if retry_after else (0, levels)
+
+
+class RateLimiter:
+    """Token buckets in a bounded LRU map, one per worker process.
+
+    The least recently used buckets are dropped once max_keys is reached. A
+    dropped bucket comes back full, which only ever errs towards allowing.
+    Requests never wait on another process: with WORKERS > 1 each worker
+    decides from its own buckets, and every RATE_LIMIT_SYNC_INTERVAL sends
+    the tokens it took per key over the worker bus, which the other workers
+    take from their buckets too. A limit then holds for the whole server,
+    give or take what the workers let through before hearing of each other.
+    """
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS, shared=WORKERS > 1):
+        self.max_keys = max_keys
+        self.shared = shared
+        self._buckets = collections.OrderedDict()
+        self._spent = {}  # key -> [tokens, capacity, period] not yet sent
+        self._sync_task = None
+        self.rejected = 0
+        self.absorbed = 0
+
+    def _store(self, key, tokens, now):
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    async def acquire(self, limits):
+        """Returns 0 when allowed, otherwise the seconds until a retry can succeed"""
+        if not limits:
+            return 0
+        now = time.monotonic()
+        retry_after, taken = take_tokens(limits, self._buckets, now)
+        if retry_after:
+            self.rejected += 1
+            return retry_after
+        for key, tokens in taken:
+            self._store(key, tokens, now)
+        if self.shared:
+            for key, capacity, period in limits:
+                self._spent.setdefault(key, [0, capacity, period])[0] += 1
+        return 0
+
+    def drain(self):
+        """The tokens taken since the last call, as [key, tokens, capacity, period]"""
+        spent, self._spent = self._spent, {}
+        return [[key, *usage] for key, usage in spent.items()]
+
+    def absorb(self, spent):
+        """Take what another worker reported from drain() out of these buckets"""
+        now = time.monotonic()
+        for key, count, capacity, period in spent:
+            key = tuple(key)
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * capacity / period)
+            self._store(key, max(0, tokens - count), now)
+            self.absorbed += count
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(RATE_LIMIT_SYNC_INTERVAL)
+            spent = self.drain()
+            if spent:
+                worker_bus.send("rate", spent)
+
+    def start(self):
+        if self.shared:
+            self._sync_task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._sync_task:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            spent = self.drain()
+            if spent:
+                worker_bus.send("rate", spent)
+
+    def stats(self):
+        return {
+            "buckets": len(self._buckets),
+            "shared": self.shared,
+            "rejected": self.rejected,
+            "absorbed": self.absorbed,
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+def peer_address(request):
+    """The peer's IP address, None if it has none (e.g. a Unix socket)"""
+    try:
+        address = ipaddress.ip_address(request.remote)
+    except (TypeError, ValueError):
+        return None
+    return getattr(address, "ipv4_mapped", None) or address
+
+
+def client_address(request):
+    """The peer address to hold to client limits, None for loopback peers"""
+    address = peer_address(request)
+    return None if address is None or address.is_loopback else str(address)
+
+
+def is_local_request(request):
+    """Whether the request comes from this machine and not through Tor"""
+    address = peer_address(request)
+    sockname = request.get_extra_info("sockname")
+    return (
+        address is not None
+        and address.is_loopback
+        and isinstance(sockname, tuple)
+        and sockname[1] != ONION_PORT
+    )
+
+
+@web.middleware
+async def local_only_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else None
+    if route in LOCAL_ROUTES and not is_local_request(request):
+        return web.json_response({"error": "Only available locally"}, status=403)
+    return await handler(request)
 
 
 @web.middleware
 async def rate_limit_middleware(request, handler):
-    share_id = request.match_info.get("share_id")
-    if not share_id:
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else None
+    policy = RATE_LIMIT_POLICIES.get(route)
+    if not policy:
         return await handler(request)
 
-    # Simple in-memory rate limiting (not persistent)
-    if share_id not in upload_progress_store:
-        upload_progress_store[share_id] = 0
+    limits = []
+    share_id = request.match_info.get("share_id")
+    session = "session" in policy and download_sessions.from_request(request)
+    client = client_address(request)
+    if session:
+        limits.append((("session", route, session), *policy["session"]))
+    else:
+        if share_id and "share" in policy:
+            limits.append((("share", route, share_id), *policy["share"]))
+        if client and "client" in policy:
+            limits.append((("client", route, client), *policy["client"]))
+        elif not client and "loopback" in policy:
+            limits.append((("loopback", route), *policy["loopback"]))
+
+    retry_after = await rate_limiter.acquire(limits)
+    if retry_after:
+        return web.json_response(
+            {"error": "Too many requests"},
+            status=429,
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
+    return await handler(request)
 
-    upload_progress_store[share_id] += 1
-    if upload_progress_store[share_id] > 10:  # limit per minute
-        return web.json_response({"error": "Too many requests"}, status=429)
 
-    # Reset counter after 60 seconds asynchronously
-    async def reset_counter():
-        await asyncio.sleep(60)
-        upload_progress_store.pop(share_id, None)
+# ========== EXPIRY SCHEDULER ==========
 
-    asyncio.create_task(reset_counter())
-    return await handler(request)
 
+class ExpiryScheduler:
+    """Reaps shares within seconds of their deadline.
+
+    Deadlines sit in a min-heap, loaded from the database at startup and fed
+    by new uploads. The task sleeps until the earliest one, then unpins every
+    share due within EXPIRY_BATCH_WINDOW in one IPFS call. The heap only holds
+    deadlines up to EXPIRY_HORIZON ahead and is topped up from the indexed
+    unreaped set as time moves on, which also picks up shares created by
+    other processes.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = set()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._loaded_until = 0
+        self.reaped = 0
+
+    def schedule(self, share_id, expires_at):
+        if share_id in self._scheduled or expires_at > self._loaded_until:
+            return
+        self._scheduled.add(share_id)
+        heapq.heappush(self._heap, (expires_at, share_id))
+        if self._heap[0][1] == share_id:
+            self._wake.set()
+
+    def announce(self, share_id, expires_at):
+        """Schedule a new share, on whichever worker leads"""
+        self.schedule(share_id, expires_at)
+        worker_bus.send("expiry", {"share_id": share_id, "expires_at": expires_at})
+
+    async def _load(self):
+        until = time.time() + EXPIRY_HORIZON
+        self._loaded_until = until
+        for share_id, expires_at in await share_metadata.get_unreaped(until):
+            self.schedule(share_id, expires_at)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def rescan(self):
+        """Pick up deadlines written to the database behind our back"""
+        await self._load()
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                if now >= self._loaded_until - EXPIRY_HORIZON / 2:
+                    await self._load()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    latest = now
+                    while self._heap and self._heap[0][0] <= now + EXPIRY_BATCH_WINDOW:
+                        latest, share_id = heapq.heappop(self._heap)
+                        due.append(share_id)
+                    self._scheduled.difference_update(due)
+                    # Hold the batch until its last member is due too
+                    await asyncio.sleep(max(latest - time.time(), 0))
+                    await self._reap(due)
+                    continue
+
+                next_due = self._heap[0][0] if self._heap else self._loaded_until
+                next_load = self._loaded_until - EXPIRY_HORIZON / 2
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wake.wait(), max(min(next_due, next_load) - now, 0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error during expiry task: {e}", exc_info=True)
+                await asyncio.sleep(EXPIRY_BATCH_WINDOW)
+
+    async def _reap(self, share_ids):
+        started = time.perf_counter()
+        reaped, unpin = await share_metadata.reap_expired(share_ids)
+        if not reaped:
+            return
+        await unpin_many(set(unpin))
+        for share_id in reaped:
+            share_events.publish(share_id, "expired")
+        self.reaped += len(reaped)
+        expiry_reap_seconds.observe(time.perf_counter() - started)
+        logger.info(f"Reaped {len(reaped)} expired share(s)")
+
+
+async def unpin_many(ipfs_hashes):
+    """Unpin in batched calls, falling back to one by one if a batch is refused"""
+    ipfs_hashes = list(ipfs_hashes)
+    for ipfs_hash in ipfs_hashes:
+        blob_cache.invalidate(ipfs_hash)
+    for i in range(0, len(ipfs_hashes), IPFS_UNPIN_BATCH):
+        batch = ipfs_hashes[i : i + IPFS_UNPIN_BATCH]
+        try:
+            await ipfs.pin_rm(*batch)
+            continue
+        except Exception as e:
+            if len(batch) == 1:
+                logger.warning(f"Failed to unpin IPFS hash {batch[0]}: {e}")
+                continue
+        for ipfs_hash in batch:
+            try:
+                await ipfs.pin_rm(ipfs_hash)
+            except Exception as e:
+                logger.warning(f"Failed to unpin IPFS hash {ipfs_hash}: {e}")
+
+
+expiry_scheduler = ExpiryScheduler()
+
+
+# ========== WORKERS ==========
+
+
+class WorkerBus:
+    """Relays share events, progress, deadlines and rate-limit usage.
+
+    Only active with WORKERS > 1. Messages are appended to the worker_bus
+    table in batches by one writer task per process, and each process reads
+    what the others wrote every BUS_POLL_INTERVAL. The leader trims messages
+    older than BUS_RETAIN.
+    """
+
+    def __init__(self):
+        self._outbox = []
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self.relayed = 0
+
+    def send(self, channel, payload):
+        if WORKERS > 1:
+            self._outbox.append((channel, json.dumps(payload)))
+            self._wake.set()
+
+    def _dispatch(self, channel, payload):
+        message = json.loads(payload)
+        if channel == "share":
+            share_events.deliver(message)
+        elif channel == "expiry":
+            expiry_scheduler.schedule(message["share_id"], message["expires_at"])
+        elif channel == "progress":
+            progress_hub.deliver(
+                message["share_id"], message["payload"], message["final"]
+            )
+        elif channel == "rate":
+            rate_limiter.absorb(message)
+
+    async def _write(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            messages, self._outbox = self._outbox, []
+            try:
+                await share_metadata.bus_append(os.getpid(), messages)
+            except Exception as e:
+                logger.error(f"Failed to relay {len(messages)} message(s): {e}")
+
+    async def _read(self):
+        cursor = await share_metadata.bus_head()
+        while True:
+            try:
+                for seq, channel, payload in await share_metadata.bus_read(
+                    cursor, os.getpid()
+                ):
+                    cursor = seq
+                    self.relayed += 1
+                    self._dispatch(channel, payload)
+            except Exception as e:
+                logger.error(f"Error reading the worker bus: {e}", exc_info=True)
+            await asyncio.sleep(BUS_POLL_INTERVAL)
+
+    async def _trim(self):
+        while True:
+            await asyncio.sleep(BUS_RETAIN)
+            try:
+                await share_metadata.bus_trim(time.time() - BUS_RETAIN)
+            except Exception as e:
+                logger.error(f"Error trimming the worker bus: {e}")
+
+    def start(self):
+        if WORKERS > 1:
+            self._tasks += [
+                asyncio.create_task(self._write()),
+                asyncio.create_task(self._read()),
+            ]
+
+    def start_trimming(self):
+        if WORKERS > 1:
+            self._tasks.append(asyncio.create_task(self._trim()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._outbox:
+            # Deliver the last messages (a final progress update, say)
+            await share_metadata.bus_append(os.getpid(), self._outbox)
+            self._outbox = []
+
+
+worker_bus = WorkerBus()
+
+
+class Leader:
+    """Elects the one worker that runs the once-per-server jobs.
+
+    Whoever holds an exclusive lock on LEADER_LOCK publishes the onion
+    service, reaps expired shares, collects abandoned upload sessions and
+    trims the worker bus. The OS releases the lock with the process, so if
+    the leader dies another worker takes over within LEADER_POLL_INTERVAL.
+    """
+
+    def __init__(self, path=LEADER_LOCK):
+        self.path = path
+        self.is_leader = False
+        self.elected = asyncio.Event()
+        self._file = None
+        self._task = None
+
+    def _try_lock(self):
+        f = open(self.path, "a+b")
+        try:
+            f.seek(0)
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    async def _run(self):
+        while not self.is_leader:
+            await asyncio.sleep(LEADER_POLL_INTERVAL)
+            self.is_leader = self._try_lock()
+        self.elected.set()
+        logger.info(f"Worker {WORKER_INDEX or 0} (pid {os.getpid()}) is the leader")
+        upload_sessions.start()
+        worker_bus.start_trimming()
+        # Reaping unpins, so it waits for the daemon
+        await readiness.wait("ipfs")
+        expiry_scheduler.start()
 
-# Cleanup task
-async def cleanup_expired_shares():
+    def start(self):
+        # Tried right away so a single process knows it leads before serving
+        self.is_leader = self._try_lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+leader = Leader()
+
+
+async def share_metrics():
+    """Publish this worker's samples so /metrics on any worker shows all"""
     while True:
         try:
-            expired_items = share_metadata.get_all_expired()
-            for share_id, ipfs_hash in expired_items:
-                try:
-                    ipfs.pin.rm(ipfs_hash)
-                    logger.info(f"Unpinned expired share: {share_id}")
-                except Exception as e:
-                    logger.warning(f"Failed to unpin IPFS hash {ipfs_hash}: {e}")
-                share_metadata.stop_share(share_id)
+            await share_metadata.set_state(
+                f"metrics:{WORKER_INDEX}", metrics.snapshot()
+            )
         except Exception as e:
-            logger.error(f"Error during cleanup task: {e}", exc_info=True)
+            logger.error(f"Failed to share metrics: {e}")
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
 
-        await asyncio.sleep(3600)  # Run every hour
 
+def listening_sockets(host="0.0.0.0", port=5000):
+    """The sockets to serve: the public port and the onion service's port"""
+    return [
+        socket.create_server((host, port), backlog=1024),
+        socket.create_server(("127.0.0.1", ONION_PORT), backlog=1024),
+    ]
 
-# Application setup
-async def on_startup(app):
+
+def serve_worker(socks, setup=None):
+    """Entry point of a worker process: serve the inherited listening sockets"""
+    if setup:
+        setup()
+    web.run_app(app, sock=socks, print=None)
+
+
+def serve_workers(count, host="0.0.0.0", port=5000, setup=None):
+    """Run count worker processes accepting on the same sockets.
+
+    The sockets are bound here, so the ports open before any worker has
+    started; workers are spawned (never forked, the parent holds threads and
+    database connections) and restarted if they die. setup, if given, is
+    called in each worker before it serves.
+    """
+    socks = listening_sockets(host, port)
+    context = multiprocessing.get_context("spawn")
+    # Workers read these when they import this module
+    os.environ["WORKERS"] = str(count)
+    os.environ["DFS_RUN_ID"] = RUN_ID
+    workers = {}
+
+    def start(index):
+        os.environ["DFS_WORKER_INDEX"] = str(index)
+        process = context.Process(
+            target=serve_worker, args=(socks, setup), name=f"worker-{index}"
+        )
+        process.start()
+        workers[index] = process
+
+    # Stop the workers too when the supervisor is terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    for index in range(count):
+        start(index)
+    logger.info(f"Serving on {host}:{port} with {count} workers")
+    try:
+        while True:
+            sentinels = {p.sentinel: index for index, p in workers.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                index = sentinels[sentinel]
+                logger.warning(
+                    f"Worker {index} exited ({workers[index].exitcode}), restarting"
+                )
+                time.sleep(1)
+                start(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join(5)
+        for sock in socks:
+            sock.close()
+
+
+# ========== STARTUP ==========
+
+
+class Readiness:
+    """Components brought up in the background once the port is open.
+
+    The database is opened at import, so routes that only read it (history,
+    status, events, stats) answer from the first request. IPFS and the onion
+    service come up in tasks that retry with backoff until they succeed;
+    routes that need them answer 503 until then (see ROUTE_REQUIREMENTS).
+    Times are seconds since the module was imported.
+    """
+
+    def __init__(self):
+        self.launched = time.monotonic()
+        self.first_response = None
+        self._components = {}
+        self._ready = collections.defaultdict(asyncio.Event)
+        self._tasks = []
+
+    def add(self, name, start):
+        """Run start() in the background until it succeeds"""
+        self._components[name] = {
+            "ready": False,
+            "seconds": None,
+            "attempts": 0,
+            "error": None,
+        }
+        self._tasks.append(asyncio.create_task(self._bring_up(name, start)))
+
+    async def _bring_up(self, name, start):
+        state = self._components[name]
+        delay = STARTUP_RETRY_DELAY
+        while True:
+            state["attempts"] += 1
+            try:
+                await start()
+                break
+            except Exception as e:
+                state["error"] = str(e) or type(e).__name__
+                logger.info(
+                    f"{name} not ready ({state['error']}), retrying in {delay}s"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, STARTUP_RETRY_MAX_DELAY)
+        state.update(ready=True, error=None, seconds=self.elapsed())
+        self._ready[name].set()
+        logger.info(f"{name} ready {state['seconds']}s after launch")
+
+    async def wait(self, name):
+        await self._ready[name].wait()
+
+    def elapsed(self):
+        return round(time.monotonic() - self.launched, 3)
+
+    def missing(self, names):
+        return [n for n in names if not self._components.get(n, {}).get("ready")]
+
+    def responded(self):
+        if self.first_response is None:
+            self.first_response = self.elapsed()
+            logger.info(f"First response {self.first_response}s after launch")
+
+    def timings(self):
+        """Seconds after launch of each component and of the first response"""
+        timings = {
+            name: state["seconds"]
+            for name, state in self._components.items()
+            if state["ready"]
+        }
+        if self.first_response is not None:
+            timings["first_response"] = self.first_response
+        return timings
+
+    def status(self):
+        return {
+            "ready": not self.missing(self._components),
+            "uptime": self.elapsed(),
+            "first_response": self.first_response,
+            "components": {"database": {"ready": True}, **self._components},
+        }
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+readiness = Readiness()
+
+
+async def start_ipfs():
+    await ipfs.version()
+
+
+async def start_tor():
+    """Publish the onion service on the leader; other workers share it.
+
+    The service is recorded under this run, so a worker restarted by the
+    supervisor picks it up again, and one left over from an earlier run is
+    never mistaken for it.
+    """
     global tor_service, service_id
-    tor_service = start_tor_service()
+    while True:
+        onion = await share_metadata.get_state("onion")
+        if onion and onion["run"] == RUN_ID:
+            service_id = onion["service_id"]
+            logger.info(f"Serving behind {service_id}.onion")
+            return
+        if leader.is_leader:
+            break
+        try:
+            await asyncio.wait_for(leader.elected.wait(), LEADER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    tor_service = await asyncio.get_running_loop().run_in_executor(
+        None, start_tor_service
+    )
     service_id = tor_service.service_id
+    await share_metadata.set_state("onion", {"run": RUN_ID, "service_id": service_id})
     logger.info(f"Tor hidden service started: {service_id}.onion")
 
-    # Start cleanup task
-    asyncio.create_task(cleanup_expired_shares())
+
+@web.middleware
+async def readiness_middleware(request, handler):
+    resource = request.match_info.route.resource
+    # HEAD probes answer from the database alone
+    missing = request.method != "HEAD" and readiness.missing(
+        ROUTE_REQUIREMENTS.get(resource.canonical if resource else None, ())
+    )
+    if missing:
+        response = web.json_response(
+            {"error": "Starting up", "waiting_for": missing},
+            status=503,
+            headers={"Retry-After": str(STARTUP_RETRY_DELAY)},
+        )
+    else:
+        response = await handler(request)
+    readiness.responded()
+    return response
+
+
+async def get_ready(request):
+    """Which components are up; 200 once all of them are"""
+    status = readiness.status()
+    return web.json_response(status, status=200 if status["ready"] else 503)
+
+
+# Application setup
+async def on_startup(app):
+    # Only local work here, the port opens as soon as startup hooks return
+    await download_sessions.load()
+    await entity_tags.load()
+    leader.start()
+    worker_bus.start()
+    rate_limiter.start()
+    if WORKERS > 1:
+        app["share_metrics"] = asyncio.create_task(share_metrics())
+    readiness.add("ipfs", start_ipfs)
+    readiness.add("tor", start_tor)
+
+
+async def on_startup_key_pool(app):
+    key_pool.fill()
+
+
+async def on_cleanup(app):
+    if "share_metrics" in app:
+        app["share_metrics"].cancel()
+    await asyncio.gather(*[transfer.close() for transfer in list(pcs.values())])
+    await readiness.stop()
+    await leader.stop()
+    await rate_limiter.stop()
+    await worker_bus.stop()
+    await expiry_scheduler.stop()
+    await upload_sessions.stop()
+    await ipfs.close()
+    crypto_pool.shutdown()
+    blob_cache.close()
+    share_metadata.close()
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Count, time and size every request, and collect its stage timings"""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else "unmatched"
+    started = time.perf_counter()
+    status = 500
+    response = None
+    http_in_flight.add(1, route)
+    try:
+        with StageTimer(route):
+            response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_in_flight.add(-1, route)
+        http_request_seconds.observe(time.perf_counter() - started, route)
+        http_requests.inc(route, request.method, status)
+        http_bytes.inc("in", amount=request.content.total_bytes)
+        if response is not None:
+            # Streamed responses are written by now, plain ones right after
+            if response.prepared:
+                sent = response.body_length
+            else:
+                sent = len(response.body) if isinstance(response.body, bytes) else 0
+            http_bytes.inc("out", amount=sent)
+
+
+# Existing counters and gauges, read when /metrics is scraped
+metrics.gauge(
+    "dfs_worker_jobs_pending",
+    "Jobs on the crypto pool",
+    collect=lambda: crypto_pool.pending,
+)
+metrics.counter(
+    "dfs_worker_seconds_total",
+    "Time spent in worker pool jobs, queueing included",
+    ("stage",),
+    collect=lambda: {(k,): v["seconds"] for k, v in crypto_pool.stages.items()},
+)
+metrics.gauge(
+    "dfs_key_pool_available",
+    "Pregenerated RSA key pairs",
+    collect=lambda: key_pool.stats()["available"],
+)
+metrics.counter(
+    "dfs_key_pool_misses_total",
+    "New shares that had to wait for a key pair",
+    collect=lambda: key_pool.misses,
+)
+metrics.gauge(
+    "dfs_blob_cache_bytes",
+    "Bytes of ciphertext cached",
+    collect=lambda: blob_cache.stats()["bytes"],
+)
+metrics.counter(
+    "dfs_blob_cache_requests_total",
+    "Blob cache lookups",
+    ("result",),
+    collect=lambda: {("hit",): blob_cache.hits, ("miss",): blob_cache.misses},
+)
+metrics.gauge(
+    "dfs_progress_subscribers",
+    "Open upload progress websockets",
+    collect=lambda: progress_hub.stats()["subscribers"],
+)
+metrics.counter(
+    "dfs_rate_limited_total",
+    "Requests refused with 429",
+    collect=lambda: rate_limiter.rejected,
+)
+metrics.counter(
+    "dfs_expired_shares_total",
+    "Shares reaped after expiry",
+    collect=lambda: expiry_scheduler.reaped,
+)
+metrics.gauge(
+    "dfs_webrtc_transfers_in_flight",
+    "WebRTC transfers connecting or sending",
+    collect=lambda: len(pcs),
+)
+
+
+metrics.gauge(
+    "dfs_startup_seconds",
+    "Seconds after launch each component came up",
+    ("component",),
+    collect=lambda: {(name,): seconds for name, seconds in readiness.timings().items()},
+)
+
+
+async def get_metrics(request):
+    others = []
+    if WORKERS > 1:
+        states = await share_metadata.get_states_like("metrics:%")
+        others = [v for k, v in states.items() if k != f"metrics:{WORKER_INDEX}"]
+    return web.Response(
+        body=metrics.render(others).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def get_stats(request):
+    return web.json_response(
+        {
+            "workers": crypto_pool.stats(),
+            "key_pool": key_pool.stats(),
+            "rate_limiter": rate_limiter.stats(),
+            "progress": progress_hub.stats(),
+            "blob_cache": blob_cache.stats(),
+        }
+    )
 
 
 async def check_status(request):
     share_id = request.match_info["share_id"]
-    if not share_metadata.is_active(share_id):
+    if not await share_metadata.is_active(share_id):
         return web.json_response({"active": False})
     return web.json_response({"active": True})
 
 
-async def get_share_history(request):
-    with sqlite3.connect("metadata.db") as conn:
-        cur = conn.execute(
-            """
-            SELECT share_id, filename, max_downloads, download_count, active, expires_at, magnet_created
-            FROM share_metadata
-            ORDER BY expires_at DESC
-        """
+async def bulk_status(request):
+    """Status of many shares at once: {"share_ids": [...]} -> {"statuses": {...}}"""
+    try:
+        # Parsed regardless of Content-Type so browsers can send it as
+        # text/plain and skip the CORS preflight
+        share_ids = json.loads(await request.text())["share_ids"]
+        if not isinstance(share_ids, list) or not all(
+            isinstance(x, str) for x in share_ids
+        ):
+            raise ValueError("share_ids must be a list of strings")
+    except (ValueError, KeyError, TypeError) as e:
+        return web.json_response({"error": f"Invalid request: {e}"}, status=400)
+    if len(share_ids) > STATUS_MAX_IDS:
+        return web.json_response(
+            {"error": f"At most {STATUS_MAX_IDS} share IDs per request"}, status=400
         )
-        rows = cur.fetchall()
-        result = [
-            {
-                "share_id": r[0],
-                "filename": r[1],
-                "max_downloads": r[2],
-                "download_count": r[3],
-                "active": bool(r[4]),
-                "expires_at": r[5],
-                "share_link": f"http://{service_id}.onion/download/{r[0]}",
-                "magnet_created": bool(r[6]),
-            }
-            for r in rows
-        ]
-        return web.json_response(result)
+    return web.json_response({"statuses": await share_metadata.get_states(share_ids)})
+
+
+async def share_event_stream(request):
+    """Server-sent events for share state changes (downloaded, exhausted,
+    expired, stopped), optionally filtered with ?share_id=...&share_id=..."""
+    wanted = set(request.query.getall("share_id", []))
+    queue = share_events.subscribe(request.headers.get("Last-Event-ID"))
+    try:
+        async with sse_response(
+            request, headers={"Access-Control-Allow-Origin": "*"}
+        ) as resp:
+            while resp.is_connected():
+                event = await queue.get()
+                if event is None:
+                    break  # fell too far behind, the client resyncs on reconnect
+                if wanted and event["share_id"] not in wanted:
+                    continue
+                await resp.send(
+                    json.dumps(event), id=share_events.event_id(event), event="share"
+                )
+        return resp
+    finally:
+        share_events.unsubscribe(queue)
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(token):
+    expires_at, share_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+    return float(expires_at), str(share_id)
+
+
+def parse_time_param(value):
+    return float(value) if value not in (None, "") else None
+
+
+async def get_share_history(request):
+    """Share history, newest expiry first.
+
+    Query parameters: limit + cursor (keyset pagination, next page cursor in
+    X-Next-Cursor), active=1, expires_after / expires_before (unix seconds),
+    prefix (filename prefix), order=asc|desc. Responses carry an ETag and the
+    X-Revision change counter; If-None-Match or since=<revision> answer 304
+    when nothing changed.
+    """
+    query = request.query
+    try:
+        limit = int(query["limit"]) if query.get("limit") else None
+        if limit is not None and not 1 <= limit <= HISTORY_MAX_LIMIT:
+            raise ValueError("limit out of range")
+        cursor = decode_cursor(query["cursor"]) if query.get("cursor") else None
+        expires_after = parse_time_param(query.get("expires_after"))
+        expires_before = parse_time_param(query.get("expires_before"))
+    except (ValueError, TypeError) as e:
+        return web.json_response({"error": f"Invalid query: {e}"}, status=400)
+
+    revision = await share_metadata.get_revision()
+    # Links embed the onion address, so it is part of the representation
+    variant = hashlib.sha256(
+        f"{service_id}|{sorted((k, v) for k, v in query.items() if k != 'since')}".encode()
+    ).hexdigest()[:16]
+    token = f"{revision}-{variant}"
+    etag = f'W/"{token}"'
+    headers = {"ETag": etag, "X-Revision": token}
+    if request.headers.get("If-None-Match") == etag or query.get("since") == token:
+        return web.Response(status=304, headers=headers)
+
+    rows, next_cursor = await share_metadata.list_shares(
+        limit=limit,
+        cursor=cursor,
+        active_only=query.get("active") in ("1", "true"),
+        expires_after=expires_after,
+        expires_before=expires_before,
+        prefix=query.get("prefix"),
+        descending=query.get("order", "desc") != "asc",
+    )
+    result = [
+        {
+            "share_id": r[0],
+            "filename": r[1],
+            "max_downloads": r[2],
+            "download_count": r[3],
+            "active": bool(r[4]),
+            "expires_at": r[5],
+            # No onion address until Tor has published the service
+            "share_link": service_id and f"http://{service_id}.onion/download/{r[0]}",
+            "magnet_created": bool(r[6]),
+        }
+        for r in rows
+    ]
+    if next_cursor:
+        headers["X-Next-Cursor"] = encode_cursor(next_cursor)
+    return web.json_response(result, headers=headers)
 
 
 app = web.Application(
-    middlewares=[cors_middleware, rate_limit_middleware], client_max_size=20 * 1024**3
+    middlewares=[
+        metrics_middleware,
+        cors_middleware,
+        readiness_middleware,
+        local_only_middleware,
+        rate_limit_middleware,
+    ],
+    client_max_size=20 * 1024**3,
 )
 
 app.router.add_post("/upload", upload_file)
+app.router.add_post("/uploads", create_upload)
+app.router.add_get("/uploads/{session_id}", upload_status)
+app.router.add_put("/uploads/{session_id}", upload_chunk)
+app.router.add_post("/uploads/{session_id}", upload_chunk)
+app.router.add_post("/uploads/{session_id}/finalize", finalize_upload)
 app.router.add_get("/download/{share_id}", download_file)
-app.router.add_get("/signal/{share_id}", handle_signaling)
+app.router.add_get("/download/{share_id}/{file}", download_file)
+app.router.add_get("/bundle/{share_id}", list_bundle)
+app.router.add_post("/signal/{share_id}", handle_signaling)
 app.router.add_get("/status/{share_id}", check_status)
+app.router.add_get("/meta/{share_id}", get_share_meta)
+app.router.add_post("/status", bulk_status)
+app.router.add_get("/events", share_event_stream)
 app.router.add_get("/ws/progress/{share_id}", websocket_progress)
 app.router.add_post("/stop/{share_id}", stop_sharing)
 app.router.add_get("/history", get_share_history)
+app.router.add_get("/stats", get_stats)
+app.router.add_get("/metrics", get_metrics)
+app.router.add_get("/ready", get_ready)
 
+app.on_startup.append(on_startup_key_pool)
 app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
 
 if __name__ == "__main__":
-    web.run_app(app, host="0.0.0.0", port=5000)
+    multiprocessing.freeze_support()  # process pool workers in the frozen .exe
+    if int(os.environ.get("WORKERS", 1)) > 1:
+        serve_workers(int(os.environ["WORKERS"]))
+    else:
+        web.run_app(app, sock=listening_sockets())
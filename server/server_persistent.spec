@@ -6,12 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[
-    'multiaddr.codecs.idna',
-    'multiaddr.codecs.uint16be',
-    'multiaddr.codecs.ip4',
-    'multiaddr.codecs.http'
-    ],
+    hiddenimports=[],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,103 @@
+"""Fixtures running server_persistent in-process against benchmark.FakeIPFS.
+
+The server reads its configuration when it is imported and keeps its state
+in module globals, so the whole session shares one event loop, one fake IPFS
+daemon and one database. Tests drive the loop with the run fixture:
+
+    def test_something(run, client):
+        async def scenario():
+            async with client.get("/ready") as resp:
+                assert resp.status == 200
+
+        run(scenario())
+"""
+
+import asyncio
+import os
+import sys
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def run(loop):
+    """Run a coroutine to completion on the session loop"""
+    return loop.run_until_complete
+
+
+@pytest.fixture(scope="session")
+def ipfs(run):
+    fake = benchmark.FakeIPFS()
+    # Kubo accepts request lines far longer than aiohttp's default
+    runner, url = run(benchmark.serve(fake.app(), max_line_size=benchmark.MiB))
+    fake.url = url
+    yield fake
+    run(runner.cleanup())
+
+
+@pytest.fixture(scope="session")
+def sp(ipfs, tmp_path_factory):
+    """The server module, configured for a scratch directory and the fake"""
+    workdir = tmp_path_factory.mktemp("server")
+    os.environ["IPFS_API_URL"] = f"{ipfs.url}/api/v0"
+    os.environ["METADATA_DB"] = str(workdir / "metadata.db")
+    os.environ["BLOB_CACHE_DIR"] = str(workdir / "blob-cache")
+    os.environ["UPLOAD_SPOOL_DIR"] = str(workdir / "upload-spool")
+    import server_persistent
+
+    server_persistent.start_tor_service = lambda: benchmark.StubHiddenService()
+    return server_persistent
+
+
+@pytest.fixture(scope="session")
+def client(run, sp):
+    """A client of the running server, once IPFS and Tor are up"""
+
+    async def start():
+        client = TestClient(TestServer(sp.app))
+        await client.start_server()
+        while not sp.readiness.status()["ready"]:
+            await asyncio.sleep(0.01)
+        return client
+
+    client = run(start())
+    yield client
+    run(client.close())
+
+
+@pytest.fixture
+def no_rate_limits(sp, monkeypatch):
+    monkeypatch.setattr(sp, "RATE_LIMIT_POLICIES", {})
+
+
+@pytest.fixture
+def upload(client):
+    """upload(data, **query) -> share_id, through POST /upload"""
+
+    async def upload(data, filename="test.bin", content_type=None, **query):
+        form = aiohttp.FormData()
+        form.add_field(
+            "files",
+            data,
+            filename=filename,
+            content_type=content_type or "application/octet-stream",
+        )
+        async with client.post("/upload", params=query, data=form) as resp:
+            body = await resp.json()
+            assert resp.status == 200, body
+            return body["share_links"][0]["share_id"]
+
+    return upload
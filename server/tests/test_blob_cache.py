@@ -0,0 +1,106 @@
+"""BlobCache: one fetch per object, LRU eviction, invalidation on unpin"""
+
+import asyncio
+import os
+import secrets
+
+import pytest
+
+SIZE = 1000
+
+
+@pytest.fixture
+def cache(sp, client, tmp_path):
+    cache = sp.BlobCache(directory=str(tmp_path / "cache"), capacity=3 * SIZE)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def blob(ipfs):
+    """blob() -> (ipfs_hash, data) of a fresh object on the fake daemon"""
+
+    def blob(size=SIZE):
+        ipfs_hash = f"bafk-cache-{secrets.token_hex(8)}"
+        ipfs.blobs[ipfs_hash] = os.urandom(size)
+        ipfs.pinned.add(ipfs_hash)
+        return ipfs_hash, ipfs.blobs[ipfs_hash]
+
+    return blob
+
+
+async def fetch(sp, cache, ipfs_hash, close=True):
+    """Read a whole object through the cache; returns (source, data)"""
+    source = await cache.open(sp.ipfs, ipfs_hash)
+    data = await source.read(0, source.size)
+    if close:
+        source.close()
+    return source, data
+
+
+def test_concurrent_readers_share_one_fetch(run, sp, ipfs, cache, blob):
+    ipfs_hash, data = blob()
+    cats = ipfs.calls.get("cat", 0)
+
+    async def scenario():
+        return await asyncio.gather(*(fetch(sp, cache, ipfs_hash) for _ in range(5)))
+
+    results = run(scenario())
+    assert [body for _, body in results] == [data] * 5
+    assert all(isinstance(source, sp.CachedBlobSource) for source, _ in results)
+    assert ipfs.calls["cat"] == cats + 1
+    assert (cache.misses, cache.hits) == (1, 4)
+
+    # Later reads come from the local file
+    assert run(fetch(sp, cache, ipfs_hash))[1] == data
+    assert ipfs.calls["cat"] == cats + 1
+
+
+def test_eviction_is_lru_and_skips_entries_in_use(run, sp, cache, blob):
+    a, b, c, d, e = (blob()[0] for _ in range(5))
+
+    async def scenario():
+        held, _ = await fetch(sp, cache, a, close=False)
+        for ipfs_hash in (b, c):
+            await fetch(sp, cache, ipfs_hash)
+        # Touching b makes c the least recently used idle entry
+        await fetch(sp, cache, b)
+        await fetch(sp, cache, d)
+        after_d = set(cache._entries)
+        # Only in-use entries left to evict: the next object bypasses the cache
+        holders = [(await fetch(sp, cache, h, close=False))[0] for h in (b, d)]
+        source, data = await fetch(sp, cache, e)
+        held.close()
+        for holder in holders:
+            holder.close()
+        return after_d, source
+
+    after_d, source = run(scenario())
+    assert after_d == {a, b, d}
+    assert cache.evictions == 1
+    assert isinstance(source, sp.IPFSBlobSource)
+    assert cache.bypassed == 1
+    assert cache.stats()["bytes"] == 3 * SIZE
+
+
+def test_unpin_invalidates_once_the_last_reader_is_done(
+    run, sp, ipfs, cache, blob, monkeypatch
+):
+    monkeypatch.setattr(sp, "blob_cache", cache)
+    ipfs_hash, data = blob()
+
+    async def scenario():
+        reader, _ = await fetch(sp, cache, ipfs_hash, close=False)
+        path = cache._entries[ipfs_hash].path
+        await sp.unpin_many([ipfs_hash])
+        # Gone from the index at once, but the open reader keeps its copy
+        assert ipfs_hash not in cache._entries
+        assert os.path.exists(path)
+        assert await reader.read(0, SIZE) == data
+        reader.close()
+        return path
+
+    path = run(scenario())
+    assert not os.path.exists(path)
+    assert cache.stats()["bytes"] == 0
+    assert ipfs_hash not in ipfs.pinned
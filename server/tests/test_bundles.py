@@ -0,0 +1,143 @@
+"""Bundle shares: the listing, single files, the zip of all, and counting"""
+
+import io
+import json
+import os
+import zipfile
+
+import aiohttp
+import pytest
+
+FILES = {
+    "notes.txt": ("text/plain", b"".join(b"note %d\n" % i for i in range(30_000))),
+    "data.bin": ("application/octet-stream", os.urandom(200_000)),
+    "empty.txt": ("text/plain", b""),
+}
+
+
+@pytest.fixture
+def bundle(run, client):
+    """bundle(max_downloads) -> share_id of a bundle of FILES"""
+
+    def bundle(max_downloads=10):
+        async def upload():
+            form = aiohttp.FormData()
+            for name, (content_type, data) in FILES.items():
+                form.add_field("files", data, filename=name, content_type=content_type)
+            query = {"zip_name": "trip", "mode": "bundle"}
+            query["max_downloads"] = max_downloads
+            async with client.post("/upload", params=query, data=form) as resp:
+                assert resp.status == 200
+                return (await resp.json())["share_links"][0]["share_id"]
+
+        return run(upload())
+
+    return bundle
+
+
+def get(run, client, path, headers=None, session=None):
+    """(status, headers, body) of a GET from a new client without cookies"""
+
+    async def fetch():
+        jar = aiohttp.DummyCookieJar()
+        async with aiohttp.ClientSession(cookie_jar=jar) as http:
+            params = {"session": session} if session else None
+            url = client.make_url(path)
+            async with http.get(url, headers=headers, params=params) as resp:
+                return resp.status, resp.headers, await resp.read()
+
+    return run(fetch())
+
+
+def download_count(run, sp, share_id):
+    return run(sp.share_metadata.get_metadata(share_id))["download_count"]
+
+
+def test_listing_names_every_file_without_counting(
+    run, client, sp, no_rate_limits, bundle, upload
+):
+    share_id = bundle()
+    status, _, body = get(run, client, f"/bundle/{share_id}")
+    assert status == 200
+    listing = json.loads(body)
+    assert listing["filename"] == "trip.zip"
+    assert [
+        (f["name"], f["size"], f["content_type"]) for f in listing["files"]
+    ] == [(name, len(data), ct) for name, (ct, data) in FILES.items()]
+    assert download_count(run, sp, share_id) == 0
+
+    for entry in listing["files"]:
+        status, _, body = get(run, client, entry["path"])
+        assert (status, body) == (200, FILES[entry["name"]][1])
+    assert get(run, client, f"/download/{share_id}/missing.txt")[0] == 404
+
+    single = run(upload(b"just one file"))
+    assert get(run, client, f"/bundle/{single}")[0] == 404
+
+
+def test_member_ranges(run, client, no_rate_limits, bundle):
+    share_id = bundle()
+    data = FILES["data.bin"][1]
+    path = f"/download/{share_id}/data.bin"
+
+    status, headers, body = get(run, client, path, {"Range": "bytes=100-70099"})
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes 100-70099/{len(data)}"
+    assert body == data[100:70100]
+
+    session = headers["X-Download-Session"]
+    status, headers, body = get(
+        run, client, path, {"Range": "bytes=-1000"}, session=session
+    )
+    assert (status, body) == (206, data[-1000:])
+
+    status, headers, _ = get(
+        run, client, path, {"Range": f"bytes={len(data)}-"}, session=session
+    )
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(data)}"
+
+
+def test_zip_of_all_files_has_its_exact_length_up_front(
+    run, client, sp, no_rate_limits, bundle
+):
+    share_id = bundle()
+    status, headers, body = get(run, client, f"/download/{share_id}")
+    assert status == 200
+    assert headers["Content-Type"] == "application/zip"
+    sizes = [(name, len(data)) for name, (_, data) in FILES.items()]
+    assert int(headers["Content-Length"]) == len(body)
+    assert len(body) == sp.ZipStream.stored_size(sizes)
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == {
+            name: data for name, (_, data) in FILES.items()
+        }
+        assert {info.compress_type for info in archive.infolist()} == {
+            zipfile.ZIP_STORED
+        }
+
+
+def test_each_download_is_counted_once(run, client, sp, no_rate_limits, bundle):
+    share_id = bundle(max_downloads=3)
+    member = f"/download/{share_id}/notes.txt"
+
+    assert get(run, client, member)[0] == 200
+    assert download_count(run, sp, share_id) == 1
+    assert get(run, client, f"/download/{share_id}")[0] == 200
+    assert download_count(run, sp, share_id) == 2
+    status, headers, _ = get(run, client, member, {"Range": "bytes=0-99"})
+    assert status == 206
+    assert download_count(run, sp, share_id) == 3
+
+    # The rest of that download rides on its session
+    session = headers["X-Download-Session"]
+    for start in range(100, 1000, 100):
+        range_header = {"Range": f"bytes={start}-{start + 99}"}
+        assert get(run, client, member, range_header, session=session)[0] == 206
+    assert download_count(run, sp, share_id) == 3
+    # A session is for the file it was issued for
+    other = f"/download/{share_id}/data.bin"
+    assert get(run, client, other, {"Range": "bytes=0-9"}, session=session)[0] == 403
+    assert get(run, client, member)[0] == 403
+    assert download_count(run, sp, share_id) == 3
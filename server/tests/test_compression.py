@@ -0,0 +1,166 @@
+"""Compressed shares: Content-Encoding passthrough, framed ranges, old blobs"""
+
+import zlib
+
+import aiohttp
+import pytest
+
+# Four frames and a bit, compressible but not trivially so
+TEXT = b"".join(b"%08d: a line of a compressible log file\n" % i for i in range(90_000))
+
+
+@pytest.fixture
+def compressed(run, sp, no_rate_limits, upload):
+    """compressed(tag) -> (share_id, data, row) of a new compressed share"""
+
+    def compressed(tag):
+        # A different digest per share, so none is deduplicated
+        data = tag.encode() + TEXT
+        share_id = run(upload(data, "log.txt", "text/plain", max_downloads=100))
+        row = run(sp.share_metadata.get_metadata(share_id))
+        assert row["codec"] == sp.compression_codec()
+        assert row["encoded_size"] < len(data) // 4
+        return share_id, data, row
+
+    return compressed
+
+
+def request(run, client, method, path, headers=None, session=None):
+    """(status, headers, body) as sent, without decoding any Content-Encoding"""
+
+    async def fetch():
+        async with aiohttp.ClientSession(auto_decompress=False) as http:
+            params = {"session": session} if session else None
+            url = client.make_url(path)
+            async with http.request(
+                method, url, headers=headers, params=params
+            ) as resp:
+                return resp.status, resp.headers, await resp.read()
+
+    return run(fetch())
+
+
+def decode(codec, body):
+    assert codec == "deflate", "zstd shares need the zstandard package"
+    return zlib.decompress(body)
+
+
+def test_encoding_is_passed_through_to_clients_that_accept_it(
+    run, client, sp, compressed
+):
+    share_id, data, row = compressed("passthrough")
+    codec = row["codec"]
+    path = f"/download/{share_id}"
+
+    status, headers, body = request(
+        run, client, "GET", path, {"Accept-Encoding": f"gzip, {codec}"}
+    )
+    assert status == 200
+    assert headers["Content-Encoding"] == codec
+    assert headers["Vary"] == "Accept-Encoding"
+    assert int(headers["Content-Length"]) == len(body) == row["encoded_size"]
+    assert decode(codec, body) == data
+
+    for accept in ("identity", f"{codec};q=0"):
+        status, headers, body = request(
+            run, client, "GET", path, {"Accept-Encoding": accept}
+        )
+        assert status == 200
+        assert "Content-Encoding" not in headers
+        assert headers["Vary"] == "Accept-Encoding"
+        assert int(headers["Content-Length"]) == len(data)
+        assert body == data
+
+
+def test_head_matches_get_for_either_encoding(run, client, sp, compressed):
+    share_id, data, row = compressed("head")
+    codec = row["codec"]
+    path = f"/download/{share_id}"
+    tags = {}
+    for accept, length in ((codec, row["encoded_size"]), ("identity", len(data))):
+        head = request(run, client, "HEAD", path, {"Accept-Encoding": accept})
+        get = request(run, client, "GET", path, {"Accept-Encoding": accept})
+        assert head[0] == get[0] == 200
+        for name in ("ETag", "Vary", "Content-Length", "Content-Type"):
+            assert head[1][name] == get[1][name], name
+        assert head[1].get("Content-Encoding") == get[1].get("Content-Encoding")
+        assert int(head[1]["Content-Length"]) == length
+        tags[accept] = head[1]["ETag"]
+    # The two representations are told apart
+    assert tags[codec] != tags["identity"]
+
+
+def test_ranges_only_decode_the_frames_they_span(
+    run, client, sp, compressed, monkeypatch
+):
+    share_id, data, row = compressed("ranges")
+    frame = sp.COMPRESSION_FRAME_SIZE
+    frames = run(sp.share_metadata.get_frames(row["digest"]))
+    assert len(frames) == len(data) // frame + 1
+    decoded = []
+    frame_decoder = sp.frame_decoder
+
+    def counting(codec, first):
+        decoded.append(first)
+        return frame_decoder(codec, first)
+
+    monkeypatch.setattr(sp, "frame_decoder", counting)
+    path = f"/download/{share_id}"
+    accept = {"Accept-Encoding": row["codec"]}
+
+    # Across the end of the first frame
+    headers = {**accept, "Range": f"bytes={frame - 1000}-{frame + 999}"}
+    status, response, body = request(run, client, "GET", path, headers)
+    assert status == 206
+    assert "Content-Encoding" not in response
+    content_range = f"bytes {frame - 1000}-{frame + 999}/{len(data)}"
+    assert response["Content-Range"] == content_range
+    assert body == data[frame - 1000 : frame + 1000]
+    assert decoded == [True, False]
+    session = response["X-Download-Session"]
+
+    # From the middle of the second frame into the fourth
+    decoded.clear()
+    start, end = frame + frame // 2, 3 * frame + 10
+    headers = {**accept, "Range": f"bytes={start}-{end}"}
+    status, _, body = request(run, client, "GET", path, headers, session)
+    assert (status, body) == (206, data[start : end + 1])
+    assert decoded == [False] * 3
+
+    # The tail, in the last and shortest frame
+    decoded.clear()
+    headers = {**accept, "Range": "bytes=-5000"}
+    status, _, body = request(run, client, "GET", path, headers, session)
+    assert (status, body) == (206, data[-5000:])
+    assert decoded == [False]
+
+
+def test_blobs_without_a_frame_index_decode_from_the_start(
+    run, client, sp, compressed, monkeypatch
+):
+    # Stored as one stream and without frames, like blobs before migration 11
+    with monkeypatch.context() as patch:
+        patch.setattr(sp, "COMPRESSION_FRAME_SIZE", 1 << 40)
+        share_id, data, row = compressed("unframed")
+
+    def forget_frames(conn):
+        sql = "UPDATE blobs SET frames = NULL WHERE digest = ?"
+        conn.execute(sql, (row["digest"],))
+
+    run(sp.share_metadata._run("forget_frames", forget_frames))
+    assert run(sp.share_metadata.get_frames(row["digest"])) is None
+
+    path = f"/download/{share_id}"
+    start, end = 2_000_000, 2_100_000
+    headers = {"Accept-Encoding": row["codec"], "Range": f"bytes={start}-{end}"}
+    status, response, body = request(run, client, "GET", path, headers)
+    assert (status, body) == (206, data[start : end + 1])
+
+    status, response, body = request(
+        run, client, "GET", path, {"Accept-Encoding": "identity"}
+    )
+    assert (status, body) == (200, data)
+    headers = {"Accept-Encoding": row["codec"]}
+    status, response, body = request(run, client, "GET", path, headers)
+    assert response["Content-Encoding"] == row["codec"]
+    assert decode(row["codec"], body) == data
@@ -0,0 +1,61 @@
+"""Deduplicated uploads reveal nothing about content held by the server"""
+
+import hashlib
+import os
+
+import aiohttp
+
+
+def test_sha256_claim_is_refused_alike_whether_stored_or_not(
+    run, client, upload, no_rate_limits
+):
+    stored = os.urandom(50_000)
+    other = os.urandom(50_000)
+
+    async def claim(data, digest):
+        form = aiohttp.FormData()
+        form.add_field("files", data, filename="claimed.bin")
+        async with client.post("/upload", params={"sha256": digest}, data=form) as resp:
+            return resp.status, await resp.json()
+
+    async def scenario():
+        await upload(stored)
+        return (
+            await claim(other, hashlib.sha256(stored).hexdigest()),
+            await claim(other, hashlib.sha256(os.urandom(16)).hexdigest()),
+            await claim(stored, hashlib.sha256(stored).hexdigest()),
+        )
+
+    stored_claim, unknown_claim, honest_claim = run(scenario())
+    assert stored_claim == unknown_claim == (
+        400,
+        {"error": "Content does not match sha256"},
+    )
+    assert honest_claim[0] == 200
+
+
+def test_public_responses_leave_out_the_plaintext_digest(
+    run, client, upload, no_rate_limits
+):
+    data = os.urandom(50_000)
+    digest = hashlib.sha256(data).hexdigest()
+
+    async def scenario():
+        first = await upload(data, max_downloads=5)
+        second = await upload(data, max_downloads=5)
+        async with client.get(f"/meta/{first}") as resp:
+            meta = await resp.json()
+        async with client.head(f"/download/{first}") as resp:
+            head = resp.headers["ETag"]
+        async with client.get(f"/download/{first}") as resp:
+            get = resp.headers["ETag"]
+            await resp.read()
+        async with client.get(f"/meta/{second}") as resp:
+            other = (await resp.json())["etag"]
+        return meta, head, get, other
+
+    meta, head, get, other = run(scenario())
+    assert digest not in str(meta) and digest not in head
+    assert meta["etag"] == head == get
+    # Two links to the same content cannot be matched by their tags
+    assert other != head
@@ -0,0 +1,133 @@
+"""max_downloads holds under concurrent downloads"""
+
+import asyncio
+import os
+
+import aiohttp
+import pytest
+
+MAX_DOWNLOADS = 5
+CLIENTS = 30
+
+
+async def burst(client, path, count):
+    """(status, body) of count simultaneous GETs from clients without cookies,
+    so none of them rides on another's download session"""
+    start = asyncio.Event()
+
+    async def fetch(session):
+        await start.wait()
+        async with session.get(client.make_url(path)) as resp:
+            return resp.status, await resp.read()
+
+    sessions = [
+        aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+        for _ in range(count)
+    ]
+    try:
+        tasks = [asyncio.create_task(fetch(session)) for session in sessions]
+        start.set()
+        return await asyncio.gather(*tasks)
+    finally:
+        await asyncio.gather(*(session.close() for session in sessions))
+
+
+@pytest.mark.parametrize("bundle", [False, True])
+def test_concurrent_downloads_never_exceed_max_downloads(
+    run, client, sp, no_rate_limits, bundle
+):
+    data = os.urandom(300_000)
+
+    async def scenario():
+        form = aiohttp.FormData()
+        form.add_field("files", data, filename="a.bin")
+        query = {"max_downloads": MAX_DOWNLOADS}
+        if bundle:
+            form.add_field("files", b"second file", filename="b.txt")
+            query.update(zip_name="both", mode="bundle")
+        async with client.post("/upload", params=query, data=form) as resp:
+            share_id = (await resp.json())["share_links"][0]["share_id"]
+        path = f"/download/{share_id}/a.bin" if bundle else f"/download/{share_id}"
+        return share_id, await burst(client, path, CLIENTS)
+
+    share_id, results = run(scenario())
+    served = [body for status, body in results if status == 200]
+    refused = [status for status, _ in results if status != 200]
+    assert len(served) == MAX_DOWNLOADS
+    assert all(body == data for body in served)
+    assert refused == [403] * (CLIENTS - MAX_DOWNLOADS)
+    metadata = run(sp.share_metadata.get_metadata(share_id))
+    assert metadata["download_count"] == MAX_DOWNLOADS
+
+
+def test_parallel_range_fetch_rides_on_its_download_session(
+    run, client, sp, upload, monkeypatch
+):
+    """With rate limits on, a multi-range fetch is counted and limited once"""
+    data = os.urandom(4 * 1024 * 1024)
+    piece = 16 * 1024
+    # Held to client limits like a remote peer, not exempt like loopback
+    monkeypatch.setattr(sp, "client_address", lambda request: "203.0.113.7")
+
+    async def scenario():
+        share_id = await upload(data, max_downloads=1)
+        path = f"/download/{share_id}"
+        async with client.get(path, headers={"Range": f"bytes=0-{piece - 1}"}) as resp:
+            assert resp.status == 206
+            session = resp.headers["X-Download-Session"]
+            first = await resp.read()
+
+        async def fetch(http, start):
+            headers = {"Range": f"bytes={start}-{start + piece - 1}"}
+            url = client.make_url(path)
+            async with http.get(url, params={"session": session}, headers=headers) as resp:
+                return resp.status, await resp.read()
+
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar()) as http:
+            results = await asyncio.gather(
+                *(fetch(http, start) for start in range(piece, len(data), piece))
+            )
+        return share_id, first, results
+
+    share_id, first, results = run(scenario())
+    # Far more requests than the share (10) and client (60) buckets hold
+    assert len(results) > 200
+    assert [status for status, _ in results] == [206] * len(results)
+    assert first + b"".join(body for _, body in results) == data
+    metadata = run(sp.share_metadata.get_metadata(share_id))
+    assert metadata["download_count"] == 1
+
+
+def test_session_token_is_no_way_around_max_downloads(
+    run, client, sp, upload, no_rate_limits
+):
+    data = os.urandom(100_000)
+
+    async def scenario():
+        share_id = await upload(data, max_downloads=1)
+        path = f"/download/{share_id}"
+        async with client.get(path) as resp:
+            assert await resp.read() == data
+            session = resp.headers["X-Download-Session"]
+
+        async def fetch(range_header=None):
+            headers = {"Range": range_header} if range_header else {}
+            jar = aiohttp.DummyCookieJar()
+            async with aiohttp.ClientSession(cookie_jar=jar) as http:
+                url = client.make_url(path)
+                params = {"session": session}
+                async with http.get(url, params=params, headers=headers) as resp:
+                    return resp.status, await resp.read()
+
+        # A full GET is a new download, and the share is exhausted
+        full = await fetch()
+        # Ranges ride on the session until it has fetched twice the file
+        ranges = [await fetch("bytes=0-49999"), await fetch("bytes=50000-")]
+        over = await fetch("bytes=0-")
+        return full, ranges, over
+
+    full, ranges, over = run(scenario())
+    assert full[0] == 403
+    assert [status for status, _ in ranges] == [206, 206]
+    assert b"".join(body for _, body in ranges) == data
+    assert over[0] == 403
@@ -0,0 +1,145 @@
+"""ExpiryScheduler: batched reaping, each share handled once"""
+
+import asyncio
+import secrets
+import time
+
+import pytest
+
+
+@pytest.fixture
+def fresh(run, sp, client):
+    """Nothing left due, so a scheduler only reaps the test's own shares"""
+
+    async def reap_due():
+        due = await sp.share_metadata.get_unreaped(time.time())
+        await sp.share_metadata.reap_expired([share_id for share_id, _ in due])
+
+    run(reap_due())
+
+
+@pytest.fixture
+def events(sp):
+    """IDs of the shares reported expired on /events"""
+    queue = sp.share_events.subscribe()
+
+    def expired():
+        share_ids = []
+        while not queue.empty():
+            event = queue.get_nowait()
+            if event["state"] == "expired":
+                share_ids.append(event["share_id"])
+        return share_ids
+
+    yield expired
+    sp.share_events.unsubscribe(queue)
+
+
+async def create(sp, ipfs, expires_at):
+    """(share_id, ipfs_hash) of a share owning a pinned object"""
+    ipfs_hash = f"bafk-expiry-{secrets.token_hex(8)}"
+    ipfs.pinned.add(ipfs_hash)
+    share_id = await sp.share_metadata.create_share(
+        ipfs_hash, "expiry.bin", "text/plain", b"", expires_at=expires_at
+    )
+    return share_id, ipfs_hash
+
+
+async def stop(*schedulers):
+    for scheduler in schedulers:
+        await scheduler.stop()
+    await asyncio.gather(
+        *(scheduler._task for scheduler in schedulers), return_exceptions=True
+    )
+
+
+def test_due_shares_are_reaped_in_one_batch(run, sp, ipfs, fresh, events):
+    scheduler = sp.ExpiryScheduler()
+    unpin_calls = ipfs.calls.get("pin/rm", 0)
+
+    async def scenario():
+        now = time.time()
+        shares = [await create(sp, ipfs, now + delay) for delay in (0.2, 0.5, 1.2)]
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        # Written after the scheduler loaded, as by another process
+        shares.append(await create(sp, ipfs, now + 0.3))
+        await scheduler.rescan()
+        await asyncio.sleep(0.6)
+        # The batch waits for its last member
+        assert scheduler.reaped == 0
+        await asyncio.sleep(1.0)
+        await stop(scheduler)
+        return shares
+
+    shares = run(scenario())
+    share_ids = [share_id for share_id, _ in shares]
+    assert scheduler.reaped == len(shares)
+    assert ipfs.calls["pin/rm"] == unpin_calls + 1
+    assert not {ipfs_hash for _, ipfs_hash in shares} & ipfs.pinned
+    assert sorted(events()) == sorted(share_ids)
+    states = run(sp.share_metadata.get_states(share_ids))
+    assert {state["state"] for state in states.values()} == {"expired"}
+
+
+def test_each_share_is_reaped_once(run, sp, ipfs, fresh, events):
+    schedulers = [sp.ExpiryScheduler(), sp.ExpiryScheduler()]
+    unpinned = ipfs.unpinned
+
+    async def scenario():
+        now = time.time()
+        shares = [await create(sp, ipfs, now + 0.2) for _ in range(20)]
+        for scheduler in schedulers:
+            scheduler.start()
+        await asyncio.sleep(0.05)
+        for share_id, _ in shares:
+            # Announced twice, and known to both schedulers as to two workers
+            for scheduler in schedulers:
+                scheduler.schedule(share_id, now + 0.2)
+                scheduler.schedule(share_id, now + 0.2)
+        await asyncio.sleep(0.5)
+        await stop(*schedulers)
+        return shares
+
+    shares = run(scenario())
+    assert all(len(scheduler._heap) == 0 for scheduler in schedulers)
+    assert sum(scheduler.reaped for scheduler in schedulers) == len(shares)
+    assert ipfs.unpinned == unpinned + len(shares)
+    assert sorted(events()) == sorted(share_id for share_id, _ in shares)
+
+    # Concurrent reaps of the same shares split them without overlap
+    async def race():
+        share_ids = [
+            (await create(sp, ipfs, time.time() - 1))[0] for _ in range(50)
+        ]
+        results = await asyncio.gather(
+            *(sp.share_metadata.reap_expired(share_ids) for _ in range(4))
+        )
+        return share_ids, [reaped for reaped, _ in results]
+
+    share_ids, results = run(race())
+    assert sorted(sum(results, [])) == sorted(share_ids)
+
+
+def test_stopped_shares_are_released_once(run, sp, ipfs, fresh, events):
+    scheduler = sp.ExpiryScheduler()
+
+    async def scenario():
+        share_id, ipfs_hash = await create(sp, ipfs, time.time() + 0.2)
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        scheduler.schedule(share_id, time.time() + 0.15)
+        unpin = await sp.share_metadata.stop_share(share_id)
+        again = await sp.share_metadata.stop_share(share_id)
+        await asyncio.sleep(0.5)
+        await stop(scheduler)
+        return share_id, ipfs_hash, unpin, again
+
+    share_id, ipfs_hash, unpin, again = run(scenario())
+    # Stopping releases the content; expiry then has nothing left to do
+    assert unpin == [ipfs_hash]
+    assert again == []
+    assert scheduler.reaped == 0
+    assert events() == []
+    states = run(sp.share_metadata.get_states([share_id]))
+    assert states[share_id]["state"] == "stopped"
@@ -0,0 +1,110 @@
+"""GET /history: keyset pages, filters and conditional requests"""
+
+import secrets
+import time
+
+import pytest
+
+
+@pytest.fixture
+def shares(run, sp):
+    """Five shares under a fresh filename prefix, expiring a minute apart
+    from base; the third is stopped. Returns (prefix, base, share ids by
+    ascending expiry)."""
+    prefix = f"history-{secrets.token_hex(4)}-"
+    base = time.time() + 3600
+
+    async def create():
+        ids = []
+        for i in range(5):
+            ids.append(
+                await sp.share_metadata.create_share(
+                    f"Qm{i}",
+                    f"{prefix}{i}.bin",
+                    "text/plain",
+                    b"",
+                    expires_at=base + 60 * i,
+                )
+            )
+        await sp.share_metadata.stop_share(ids[2])
+        return ids
+
+    return prefix, base, run(create())
+
+
+def history(run, client, params, headers=None):
+    async def fetch():
+        async with client.get("/history", params=params, headers=headers) as resp:
+            body = await resp.json() if resp.status == 200 else None
+            return resp.status, resp.headers, body
+
+    return run(fetch())
+
+
+def test_keyset_pages_cover_every_share_once(run, client, no_rate_limits, shares):
+    prefix, _, ids = shares
+    seen, cursor, pages = [], None, 0
+    while True:
+        params = {"prefix": prefix, "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        status, headers, body = history(run, client, params)
+        assert status == 200
+        pages += 1
+        seen += [row["share_id"] for row in body]
+        cursor = headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert pages == 3
+    assert seen == ids[::-1]
+
+    _, _, body = history(run, client, {"prefix": prefix, "order": "asc", "limit": 10})
+    assert [row["share_id"] for row in body] == ids
+
+
+def test_filters(run, client, no_rate_limits, shares):
+    prefix, base, ids = shares
+    _, _, body = history(run, client, {"prefix": prefix, "active": "1"})
+    assert {row["share_id"] for row in body} == set(ids) - {ids[2]}
+    assert all(row["active"] for row in body)
+
+    window = {"expires_after": base + 30, "expires_before": base + 150}
+    _, _, body = history(run, client, {"prefix": prefix, **window})
+    assert [row["share_id"] for row in body] == [ids[2], ids[1]]
+
+    # LIKE wildcards in the prefix match literally
+    _, _, body = history(run, client, {"prefix": prefix.replace("-", "_")})
+    assert body == []
+
+
+@pytest.mark.parametrize(
+    "query", ["limit=0", "limit=x", "cursor=???", "expires_after=soon"]
+)
+def test_invalid_query_is_400(run, client, no_rate_limits, query):
+    async def fetch():
+        async with client.get(f"/history?{query}") as resp:
+            return resp.status
+
+    assert run(fetch()) == 400
+
+
+def test_unchanged_history_answers_304(run, client, sp, no_rate_limits, shares):
+    prefix, _, ids = shares
+    params = {"prefix": prefix}
+    status, headers, _ = history(run, client, params)
+    etag, revision = headers["ETag"], headers["X-Revision"]
+
+    status, headers, _ = history(run, client, params, {"If-None-Match": etag})
+    assert status == 304
+    assert headers["ETag"] == etag
+    assert history(run, client, {**params, "since": revision})[0] == 304
+    # Another query is another representation
+    other = {"prefix": prefix, "limit": 1}
+    assert history(run, client, other, {"If-None-Match": etag})[0] == 200
+
+    run(sp.share_metadata.stop_share(ids[0]))
+    status, headers, body = history(run, client, params, {"If-None-Match": etag})
+    assert status == 200
+    assert headers["ETag"] != etag
+    assert not next(row for row in body if row["share_id"] == ids[0])["active"]
+    assert history(run, client, {**params, "since": revision})[0] == 200
@@ -0,0 +1,202 @@
+"""IPFSClient under concurrency, errors and timeouts, against a fake daemon"""
+
+import asyncio
+import os
+
+import aiohttp
+import pytest
+
+import benchmark
+
+
+class ScriptedIPFS(benchmark.FakeIPFS):
+    """FakeIPFS that counts calls in flight and can stall or drop them"""
+
+    def __init__(self):
+        super().__init__()
+        self.delay = 0  # seconds every short call and cat body waits
+        self.drop = 0  # connections to drop before answering
+        self.stall_after_first_chunk = False
+        self.attempts = 0  # requests received, dropped and timed out ones too
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def _enter(self, request):
+        self.attempts += 1
+        if self.drop:
+            self.drop -= 1
+            request.transport.abort()
+            return False
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        return True
+
+    def _tracked(self, handler):
+        async def tracked(request):
+            if not await self._enter(request):
+                return aiohttp.web.Response()
+            try:
+                return await handler(request)
+            finally:
+                self.in_flight -= 1
+
+        return tracked
+
+    async def stalling_cat(self, request):
+        self._count("cat")
+        response = aiohttp.web.StreamResponse()
+        await response.prepare(request)
+        await response.write(self.blobs[request.query["arg"]][:1024])
+        # Longer than the client waits between reads
+        await asyncio.sleep(1)
+        return response
+
+    def app(self):
+        app = aiohttp.web.Application(client_max_size=1024**3)
+        app.router.add_post("/api/v0/version", self._tracked(self.version))
+        app.router.add_post("/api/v0/add", self._tracked(self.add))
+        app.router.add_post("/api/v0/cat", self._tracked(self.route_cat))
+        app.router.add_post("/api/v0/files/stat", self._tracked(self.stat))
+        app.router.add_post("/api/v0/pin/rm", self._tracked(self.pin_rm))
+        return app
+
+    async def route_cat(self, request):
+        if self.stall_after_first_chunk:
+            return await self.stalling_cat(request)
+        return await self.cat(request)
+
+
+@pytest.fixture
+def fake(run):
+    fake = ScriptedIPFS()
+    runner, url = run(benchmark.serve(fake.app(), max_line_size=benchmark.MiB))
+    fake.url = f"{url}/api/v0"
+    yield fake
+    run(runner.cleanup())
+
+
+@pytest.fixture
+def make_client(run, sp, fake):
+    clients = []
+
+    def make_client(**kwargs):
+        kwargs.setdefault("timeout", 5)
+        client = sp.IPFSClient(api_url=fake.url, **kwargs)
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        run(client.close())
+
+
+async def one_chunk(data):
+    yield data
+
+
+async def read_all(chunks):
+    return b"".join([chunk async for chunk in chunks])
+
+
+def test_parallel_add_cat_and_pin_rm(run, fake, make_client):
+    client = make_client()
+    blobs = [os.urandom(100_000 + n) for n in range(20)]
+
+    async def scenario():
+        hashes = await asyncio.gather(
+            *(client.add_stream(one_chunk(data)) for data in blobs)
+        )
+        read = await asyncio.gather(*(read_all(client.cat(h)) for h in hashes))
+        ranges = await asyncio.gather(
+            *(read_all(client.cat(h, offset=1000, length=500)) for h in hashes)
+        )
+        sizes = await asyncio.gather(*(client.stat_size(h) for h in hashes))
+        await asyncio.gather(*(client.pin_rm(h) for h in hashes[:10]))
+        await client.pin_rm(*hashes[10:])
+        return hashes, read, ranges, sizes
+
+    hashes, read, ranges, sizes = run(scenario())
+    assert len(set(hashes)) == len(blobs)
+    assert read == blobs
+    assert ranges == [data[1000:1500] for data in blobs]
+    assert sizes == [len(data) for data in blobs]
+    assert not fake.pinned & set(hashes)
+    assert fake.calls["add"] == fake.calls["files/stat"] == 20
+    assert fake.calls["pin/rm"] == 11
+
+
+def test_calls_and_streams_are_bounded(run, fake, make_client):
+    client = make_client(max_concurrency=2, max_streams=3)
+    data = os.urandom(10_000)
+
+    async def scenario():
+        ipfs_hash = await client.add_stream(one_chunk(data))
+        fake.delay = 0.05
+        await asyncio.gather(*(client.stat_size(ipfs_hash) for _ in range(12)))
+        short_calls = fake.peak_in_flight
+        fake.peak_in_flight = 0
+        await asyncio.gather(*(read_all(client.cat(ipfs_hash)) for _ in range(12)))
+        return short_calls, fake.peak_in_flight
+
+    short_calls, streams = run(scenario())
+    assert short_calls == 2
+    assert streams == 3
+
+
+def test_error_status_is_raised_without_retry(run, fake, make_client):
+    client = make_client(retries=3)
+
+    async def scenario():
+        with pytest.raises(aiohttp.ClientResponseError) as stat_error:
+            await client.stat_size("bafkmissing")
+        with pytest.raises(aiohttp.ClientResponseError) as cat_error:
+            await read_all(client.cat("bafkmissing"))
+        return stat_error.value.status, cat_error.value.status
+
+    assert run(scenario()) == (500, 500)
+    assert fake.calls["files/stat"] == 1
+    assert fake.calls["cat"] == 1
+
+
+def test_dropped_connections_are_retried(run, fake, make_client):
+    client = make_client(retries=3)
+    fake.drop = 2
+
+    async def scenario():
+        return await client.version()
+
+    assert run(scenario()) == {"Version": "fake"}
+    assert fake.attempts == 3
+    assert fake.calls["version"] == 1
+
+
+def test_timeouts_are_retried_then_raised(run, fake, make_client):
+    client = make_client(timeout=0.1, retries=2)
+    fake.delay = 1
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await client.version()
+
+    run(scenario())
+    # The first attempt and both retries reached the daemon
+    assert fake.attempts == 3
+
+
+def test_stalled_stream_times_out_without_retry(run, fake, make_client):
+    client = make_client(timeout=0.2, retries=3)
+    data = os.urandom(10_000)
+
+    async def scenario():
+        ipfs_hash = await client.add_stream(one_chunk(data))
+        fake.stall_after_first_chunk = True
+        received = []
+        with pytest.raises(asyncio.TimeoutError):
+            async for chunk in client.cat(ipfs_hash):
+                received.append(chunk)
+        return b"".join(received)
+
+    assert run(scenario()) == data[:1024]
+    # Part of the body was delivered, so the call is not repeated
+    assert fake.calls["cat"] == 1
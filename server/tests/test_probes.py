@@ -0,0 +1,82 @@
+"""HEAD and /meta cost nothing; If-Range decides between a range and the body"""
+
+import json
+import os
+
+import aiohttp
+
+
+def request(run, client, method, path, headers=None, session=None):
+    """(status, headers, body) from a new client without cookies"""
+
+    async def fetch():
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar()) as http:
+            params = {"session": session} if session else None
+            url = client.make_url(path)
+            async with http.request(
+                method, url, headers=headers, params=params
+            ) as resp:
+                return resp.status, resp.headers, await resp.read()
+
+    return run(fetch())
+
+
+def download_count(run, sp, share_id):
+    return run(sp.share_metadata.get_metadata(share_id))["download_count"]
+
+
+def test_head_and_meta_fetch_and_count_nothing(
+    run, client, sp, ipfs, no_rate_limits, upload
+):
+    data = os.urandom(200_000)
+    share_id = run(upload(data, max_downloads=1))
+    path = f"/download/{share_id}"
+    calls = dict(ipfs.calls)
+
+    for _ in range(3):
+        status, headers, body = request(run, client, "HEAD", path)
+        assert (status, body) == (200, b"")
+        assert int(headers["Content-Length"]) == len(data)
+        status, headers, _ = request(run, client, "HEAD", path, {"Range": "bytes=0-9"})
+        assert (status, headers["Content-Range"]) == (206, f"bytes 0-9/{len(data)}")
+        status, _, body = request(run, client, "GET", f"/meta/{share_id}")
+        assert status == 200
+    assert ipfs.calls == calls
+    assert download_count(run, sp, share_id) == 0
+
+    # The one download still goes to whoever asks for it first
+    assert request(run, client, "GET", path)[::2] == (200, data)
+    assert request(run, client, "HEAD", path)[0] == 403
+    status, _, body = request(run, client, "GET", f"/meta/{share_id}")
+    assert status == 200
+    assert json.loads(body)["state"] == "exhausted"
+
+
+def test_if_range_mismatch_sends_the_whole_body(
+    run, client, sp, no_rate_limits, upload
+):
+    data = os.urandom(300_000)
+    share_id = run(upload(data, max_downloads=5))
+    path = f"/download/{share_id}"
+
+    status, headers, body = request(run, client, "GET", path, {"Range": "bytes=0-99"})
+    assert (status, body) == (206, data[:100])
+    etag, session = headers["ETag"], headers["X-Download-Session"]
+    assert download_count(run, sp, share_id) == 1
+
+    # The rest of the same download, on its session: a matching tag gets the
+    # range, a stale one the current body in full
+    resume = {"Range": "bytes=100-", "If-Range": etag}
+    status, _, body = request(run, client, "GET", path, resume, session)
+    assert (status, body) == (206, data[100:])
+    stale = {"Range": "bytes=100-", "If-Range": '"an-older-version"'}
+    status, headers, body = request(run, client, "GET", path, stale, session)
+    assert (status, body) == (200, data)
+    assert "Content-Range" not in headers
+    assert download_count(run, sp, share_id) == 1
+
+    # Shares have no modification time, so a date never matches
+    dated = {"Range": "bytes=100-", "If-Range": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    status, _, body = request(run, client, "GET", path, dated)
+    assert (status, body) == (200, data)
+    assert download_count(run, sp, share_id) == 2
@@ -0,0 +1,62 @@
+"""Rate limits hold for the whole server, however many workers serve it"""
+
+import json
+
+
+def test_workers_take_each_others_usage(run, sp, monkeypatch):
+    workers = [sp.RateLimiter(shared=True), sp.RateLimiter(shared=True)]
+    limits = [(("share", "/download/{share_id}", "shared-test"), 10, 60)]
+    # Deciding never touches the database
+    monkeypatch.setattr(sp, "share_metadata", None)
+
+    async def scenario():
+        return [await workers[n % 2].acquire(limits) for n in range(8)]
+
+    # Each worker decides alone between syncs
+    assert run(scenario()) == [0] * 8
+
+    # Relayed as JSON over the bus, as the sync task sends it
+    for sender, receiver in (workers, workers[::-1]):
+        monkeypatch.setattr(sp, "rate_limiter", receiver)
+        sp.worker_bus._dispatch("rate", json.dumps(sender.drain()))
+    assert [worker.absorbed for worker in workers] == [4, 4]
+    assert workers[0].drain() == []
+
+    # Both now hold 2 of the 10 tokens
+    results = run(scenario())
+    assert results.count(0) == 4
+    assert all(0 < retry_after <= 6 for retry_after in results if retry_after)
+    assert sum(worker.rejected for worker in workers) == 4
+
+
+def test_usage_from_other_workers_empties_a_bucket_at_most(run, sp):
+    limiter = sp.RateLimiter(shared=True)
+    key = ("client", "/status", "absorb-test")
+    limiter.absorb([[list(key), 25, 10, 60]])
+    assert limiter._buckets[key][0] == 0
+
+    # A token comes back after period / capacity, not after paying off 15
+    retry_after = run(limiter.acquire([(key, 10, 60)]))
+    assert 5.9 < retry_after <= 6
+    # Only its own tokens are sent on
+    assert limiter.drain() == []
+
+
+def test_loopback_peers_share_a_ceiling(run, client, sp, monkeypatch):
+    """Everyone coming through Tor looks like loopback: one bucket per route"""
+    monkeypatch.setattr(sp, "rate_limiter", sp.RateLimiter(shared=False))
+    monkeypatch.setitem(
+        sp.RATE_LIMIT_POLICIES, "/status", {"client": (60, 60), "loopback": (3, 60)}
+    )
+
+    async def post():
+        async with client.post("/status", data='{"share_ids": []}') as resp:
+            return resp.status
+
+    async def scenario():
+        return [await post() for _ in range(5)]
+
+    assert run(scenario()) == [200] * 3 + [429] * 2
+    # A remote peer is held to its own client bucket instead
+    monkeypatch.setattr(sp, "client_address", lambda request: "203.0.113.9")
+    assert run(post()) == 200
@@ -0,0 +1,167 @@
+"""Resumable uploads: offsets, rollback of bad chunks, restarts, retries"""
+
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def session(run, client, no_rate_limits):
+    """session(data) -> session_id of a resumable upload of len(data) bytes"""
+
+    def session(data):
+        async def create():
+            query = {"filename": "resumed.bin", "size": len(data), "max_downloads": 5}
+            async with client.post("/uploads", params=query) as resp:
+                assert resp.status == 201
+                return (await resp.json())["session_id"]
+
+        return run(create())
+
+    return session
+
+
+def put(run, client, session_id, offset, data, **query):
+    async def send():
+        path = f"/uploads/{session_id}"
+        params = {"offset": offset, **query}
+        async with client.put(path, params=params, data=data) as resp:
+            return resp.status, await resp.json()
+
+    return run(send())
+
+
+def offset_of(run, client, session_id):
+    async def get():
+        async with client.get(f"/uploads/{session_id}") as resp:
+            return (await resp.json())["offset"]
+
+    return run(get())
+
+
+def finalize(run, client, session_id):
+    async def post():
+        async with client.post(f"/uploads/{session_id}/finalize") as resp:
+            return resp.status, await resp.json()
+
+    return run(post())
+
+
+def download(run, client, share_id):
+    async def get():
+        async with client.get(f"/download/{share_id}") as resp:
+            assert resp.status == 200
+            return await resp.read()
+
+    return run(get())
+
+
+def test_wrong_offsets_are_409(run, client, session):
+    data = os.urandom(300_000)
+    session_id = session(data)
+    assert put(run, client, session_id, 0, data[:100_000]) == (200, {"offset": 100_000})
+
+    # A retried chunk, and one past a gap
+    for offset in (0, 150_000):
+        status, body = put(run, client, session_id, offset, data[offset:][:1000])
+        assert (status, body["offset"]) == (409, 100_000)
+
+    # Answered before the body is read: this one only ends once it has been
+    answered = asyncio.Event()
+
+    async def stalled():
+        yield data[:1000]
+        await answered.wait()
+
+    async def early():
+        path = f"/uploads/{session_id}"
+        async with client.put(path, params={"offset": 0}, data=stalled()) as resp:
+            answered.set()
+            return resp.status
+
+    assert run(asyncio.wait_for(early(), 5)) == 409
+    assert put(run, client, session_id, 100_000, data[100_000:])[0] == 200
+    status, body = finalize(run, client, session_id)
+    assert status == 200
+    assert download(run, client, body["share_links"][0]["share_id"]) == data
+
+
+def test_bad_chunks_are_rolled_back_whole(run, client, sp, session, monkeypatch):
+    data = os.urandom(3 * MiB)
+    session_id = session(data)
+    first = data[: MiB + 12345]
+    assert put(run, client, session_id, 0, first)[0] == 200
+
+    # Sealed into the spool as it arrives, then dropped as a whole
+    rest = data[len(first) :]
+    status, body = put(run, client, session_id, len(first), rest, sha256="0" * 64)
+    assert (status, body["offset"]) == (400, len(first))
+    monkeypatch.setattr(sp, "UPLOAD_MAX_CHUNK", MiB)
+
+    async def stream():
+        for i in range(0, len(rest), 256 * 1024):
+            yield rest[i : i + 256 * 1024]
+
+    # Sent chunked, so the size is only found out while reading
+    assert put(run, client, session_id, len(first), stream())[0] == 413
+    assert offset_of(run, client, session_id) == len(first)
+    monkeypatch.undo()
+
+    sha256 = hashlib.sha256(rest).hexdigest()
+    assert put(run, client, session_id, len(first), rest, sha256=sha256)[0] == 200
+    status, body = finalize(run, client, session_id)
+    # The whole-file digest survived the rollbacks
+    assert body["share_links"][0]["sha256"] == hashlib.sha256(data).hexdigest()
+    assert download(run, client, body["share_links"][0]["share_id"]) == data
+
+
+def test_restart_resumes_from_the_last_commit(run, client, sp, session):
+    data = os.urandom(3 * MiB + 777)
+    session_id = session(data)
+    assert put(run, client, session_id, 0, data[: 2 * MiB])[0] == 200
+
+    # A restart forgets the session and the unsealed tail, and leaves the
+    # spool holding the committed segments only
+    row = run(sp.share_metadata.get_upload_session(session_id))
+    committed = row["committed"]
+    assert 0 < committed < 2 * MiB
+    del sp.upload_sessions._live[session_id]
+    segments = committed // sp.SEGMENT_SIZE
+    header = len(bytes(row["header"]))
+    with open(sp.upload_sessions._path(session_id), "r+b") as f:
+        f.truncate(header + segments * (sp.SEGMENT_SIZE + sp.GCM_TAG_BYTES))
+
+    offset = offset_of(run, client, session_id)
+    assert offset == committed
+    status, body = put(run, client, session_id, offset, data[offset:])
+    assert (status, body["offset"]) == (200, len(data))
+    status, body = finalize(run, client, session_id)
+    assert status == 200
+    link = body["share_links"][0]
+    # No digest to deduplicate with after a restart
+    assert link.get("sha256") is None
+    assert download(run, client, link["share_id"]) == data
+
+
+def test_finalize_can_be_retried_after_a_failed_add(
+    run, client, sp, session, monkeypatch
+):
+    data = os.urandom(500_000)
+    session_id = session(data)
+    assert put(run, client, session_id, 0, data)[0] == 200
+
+    async def unavailable(chunks):
+        raise ConnectionError("IPFS daemon went away")
+
+    monkeypatch.setattr(sp.ipfs, "add_stream", unavailable)
+    assert finalize(run, client, session_id)[0] == 502
+    monkeypatch.undo()
+
+    status, body = finalize(run, client, session_id)
+    assert status == 200
+    assert download(run, client, body["share_links"][0]["share_id"]) == data
+    assert finalize(run, client, session_id)[0] == 404
@@ -0,0 +1,193 @@
+"""The segmented share container: tampering is caught, older layouts still
+decrypt and Range requests map onto segments"""
+
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+SEGMENT = 1024
+TAG = 16
+
+
+@pytest.fixture(scope="module")
+def keys(sp):
+    private_pem, _ = sp.generate_key_pair_pem()
+    private_key = serialization.load_pem_private_key(private_pem.encode(), None)
+    return private_key.public_key(), private_pem
+
+
+def seal(run, sp, public_key, data):
+    async def scenario():
+        encryptor = sp.SegmentEncryptor(public_key, segment_size=SEGMENT)
+        return encryptor.header + await encryptor.update(data) + await encryptor.finalize()
+
+    return run(scenario())
+
+
+def read(run, sp, private_pem, blob, start=0, end=None):
+    async def scenario():
+        share = await sp.open_share(sp.BlobSource(blob), private_pem)
+        last = share.size - 1 if end is None else end
+        return share, b"".join([bytes(c) async for c in share.read_range(start, last)])
+
+    return run(scenario())
+
+
+def segments(sp, blob):
+    """The header and the sealed segments of a blob"""
+    header, body = blob[: sp.SEGMENT_HEADER_BYTES], blob[sp.SEGMENT_HEADER_BYTES :]
+    stored = SEGMENT + TAG
+    return header, [body[i : i + stored] for i in range(0, len(body), stored)]
+
+
+def test_segmented_round_trip_and_ranges(run, client, sp, keys):
+    data = os.urandom(10 * SEGMENT + 100)
+    blob = seal(run, sp, keys[0], data)
+    share, plain = read(run, sp, keys[1], blob)
+    assert (share.layout, share.size, plain) == ("segmented", len(data), data)
+    for start, end in [
+        (0, 0),
+        (SEGMENT - 1, SEGMENT),  # across a boundary
+        (SEGMENT, 2 * SEGMENT - 1),  # exactly one segment
+        (3 * SEGMENT + 5, 7 * SEGMENT + 9),
+        (len(data) - 1, len(data) - 1),  # in the short last segment
+    ]:
+        assert read(run, sp, keys[1], blob, start, end)[1] == data[start : end + 1]
+
+
+def test_empty_share_round_trips(run, client, sp, keys):
+    blob = seal(run, sp, keys[0], b"")
+    share, _ = read(run, sp, keys[1], blob, 0, 0)
+    assert share.size == 0
+
+
+@pytest.mark.parametrize(
+    "tamper",
+    [
+        "drop last segment",
+        "cut into last segment",
+        "swap segments",
+        "flip a tag bit",
+        "flip a ciphertext bit",
+        "change the segment size",
+        "change the nonce prefix",
+    ],
+)
+def test_tampering_is_rejected(run, client, sp, keys, tamper):
+    data = os.urandom(6 * SEGMENT + 10)
+    header, blocks = segments(sp, seal(run, sp, keys[0], data))
+    if tamper == "drop last segment":
+        blocks = blocks[:-1]
+    elif tamper == "cut into last segment":
+        blocks[-1] = blocks[-1][:-3]
+    elif tamper == "swap segments":
+        blocks[1], blocks[2] = blocks[2], blocks[1]
+    elif tamper == "flip a tag bit":
+        blocks[3] = blocks[3][:-1] + bytes([blocks[3][-1] ^ 1])
+    elif tamper == "flip a ciphertext bit":
+        blocks[0] = bytes([blocks[0][0] ^ 0x80]) + blocks[0][1:]
+    elif tamper == "change the segment size":
+        # Still a valid size, segments no longer line up or authenticate
+        header = header[:4] + (SEGMENT // 2).to_bytes(4, "big") + header[8:]
+    else:
+        header = header[:8] + bytes([header[8] ^ 1]) + header[9:]
+    with pytest.raises((InvalidTag, ValueError)):
+        read(run, sp, keys[1], header + b"".join(blocks))
+
+
+def test_tampering_stays_local_to_its_segment(run, client, sp, keys):
+    """Random access verifies only the segments it reads"""
+    data = os.urandom(6 * SEGMENT)
+    header, blocks = segments(sp, seal(run, sp, keys[0], data))
+    blocks[5] = blocks[5][:-1] + bytes([blocks[5][-1] ^ 1])
+    blob = header + b"".join(blocks)
+    assert read(run, sp, keys[1], blob, 0, 2 * SEGMENT - 1)[1] == data[: 2 * SEGMENT]
+    with pytest.raises(InvalidTag):
+        read(run, sp, keys[1], blob, 5 * SEGMENT, 5 * SEGMENT)
+
+
+def gcm(data):
+    aes_key, nonce = os.urandom(32), os.urandom(12)
+    encryptor = Cipher(algorithms.AES(aes_key), modes.GCM(nonce)).encryptor()
+    ciphertext = encryptor.update(data) + encryptor.finalize()
+    return aes_key, nonce, ciphertext, encryptor.tag
+
+
+@pytest.mark.parametrize("layout", ["legacy", "stream"])
+def test_older_layouts_still_decrypt(run, client, sp, keys, layout):
+    data = os.urandom(100_000)
+    aes_key, nonce, ciphertext, tag = gcm(data)
+    wrapped = sp.wrap_aes_key(keys[0], aes_key)
+    if layout == "legacy":
+        # As the original server wrote them: key | tag | nonce | ciphertext
+        blob = wrapped + tag + nonce + ciphertext
+    else:
+        blob = sp.STREAM_MAGIC + wrapped + nonce + ciphertext + tag
+    share, plain = read(run, sp, keys[1], blob)
+    assert (share.layout, plain) == (layout, data)
+    assert read(run, sp, keys[1], blob, 12_345, 67_890)[1] == data[12_345:67_891]
+
+    # The whole-file read checks the tag
+    broken = bytearray(blob)
+    broken[-1 if layout == "legacy" else -TAG - 1] ^= 1
+    with pytest.raises(InvalidTag):
+        read(run, sp, keys[1], bytes(broken))
+
+
+def test_range_requests(run, client, sp, upload, no_rate_limits, monkeypatch):
+    # Overlapping ranges add up to more than a session may fetch
+    monkeypatch.setattr(sp, "DOWNLOAD_SESSION_BUDGET", 10)
+    segment = sp.SEGMENT_SIZE
+    data = os.urandom(5 * segment + 123)
+    size = len(data)
+
+    async def get(path, session, header):
+        headers = {"Range": header}
+        params = {"session": session} if session else {}
+        async with client.get(path, headers=headers, params=params) as resp:
+            return resp.status, resp.headers, await resp.read()
+
+    async def scenario():
+        share_id = await upload(data)
+        path = f"/download/{share_id}"
+        status, headers, body = await get(path, None, "bytes=0-9")
+        assert (status, body) == (206, data[:10])
+        session = headers["X-Download-Session"]
+        results = {}
+        for header in [
+            "bytes=-100",
+            "bytes=-0",
+            f"bytes=-{size + 50}",
+            f"bytes={3 * segment + 7}-",
+            f"bytes={segment - 10}-{segment + 9}",
+            f"bytes={segment}-{2 * segment - 1}",
+            f"bytes={segment - 1}-{4 * segment}",
+            f"bytes={size - 1}-{size + 1000}",
+            f"bytes={size}-",
+            "bytes=10-5",
+        ]:
+            results[header] = await get(path, session, header)
+        return results
+
+    results = run(scenario())
+
+    def expect(header, start, end):
+        status, headers, body = results[header]
+        assert status == 206, header
+        assert headers["Content-Range"] == f"bytes {start}-{end}/{size}"
+        assert body == data[start : end + 1], header
+
+    expect("bytes=-100", size - 100, size - 1)
+    expect(f"bytes=-{size + 50}", 0, size - 1)
+    expect(f"bytes={3 * segment + 7}-", 3 * segment + 7, size - 1)
+    expect(f"bytes={segment - 10}-{segment + 9}", segment - 10, segment + 9)
+    expect(f"bytes={segment}-{2 * segment - 1}", segment, 2 * segment - 1)
+    expect(f"bytes={segment - 1}-{4 * segment}", segment - 1, 4 * segment)
+    expect(f"bytes={size - 1}-{size + 1000}", size - 1, size - 1)
+    for header in ["bytes=-0", f"bytes={size}-", "bytes=10-5"]:
+        status, headers, _ = results[header]
+        assert status == 416, header
+        assert headers["Content-Range"] == f"bytes */{size}"
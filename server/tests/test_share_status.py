@@ -0,0 +1,125 @@
+"""POST /status and the /events stream of share state changes"""
+
+import asyncio
+import ipaddress
+import json
+import time
+
+import pytest
+
+
+def create(run, sp, **kwargs):
+    return run(
+        sp.share_metadata.create_share("Qm", "status.bin", "text/plain", b"", **kwargs)
+    )
+
+
+def bulk_status(run, client, body):
+    async def post():
+        async with client.post("/status", data=body) as resp:
+            return resp.status, await resp.json()
+
+    return run(post())
+
+
+def test_bulk_status_reports_every_state(run, client, sp, no_rate_limits):
+    active = create(run, sp)
+    exhausted = create(run, sp, max_downloads=1)
+    run(sp.share_metadata.claim_download(exhausted))
+    expired = create(run, sp, expires_at=time.time() - 60)
+    stopped = create(run, sp)
+    run(sp.share_metadata.stop_share(stopped))
+
+    ids = [active, exhausted, expired, stopped, "no-such-share", active]
+    status, body = bulk_status(run, client, json.dumps({"share_ids": ids}))
+    assert status == 200
+    states = body["statuses"]
+    assert {k: v["state"] for k, v in states.items()} == {
+        active: "active",
+        exhausted: "exhausted",
+        expired: "expired",
+        stopped: "stopped",
+        "no-such-share": "unknown",
+    }
+    assert [k for k, v in states.items() if v["active"]] == [active]
+    assert states[exhausted]["download_count"] == 1
+
+
+@pytest.mark.parametrize(
+    "body", ["not json", '{"ids": []}', '{"share_ids": "abc"}', '{"share_ids": [1]}']
+)
+def test_bulk_status_rejects_malformed_bodies(run, client, no_rate_limits, body):
+    assert bulk_status(run, client, body)[0] == 400
+
+
+def test_bulk_status_caps_share_ids(run, client, sp, no_rate_limits, monkeypatch):
+    monkeypatch.setattr(sp, "STATUS_MAX_IDS", 2)
+    assert bulk_status(run, client, '{"share_ids": ["a", "b", "c"]}')[0] == 400
+
+
+async def read_events(resp, count):
+    """The first count events of an SSE response as (id, event, data) tuples"""
+    events, fields = [], {}
+    while len(events) < count:
+        line = (await asyncio.wait_for(resp.content.readline(), 5)).decode()
+        line = line.rstrip("\r\n")
+        if line:
+            name, _, value = line.partition(":")
+            fields[name] = value.strip()
+        elif "data" in fields:
+            events.append((fields["id"], fields["event"], json.loads(fields["data"])))
+            fields = {}
+    return events
+
+
+def test_events_stream_and_replay_from_last_event_id(run, client, sp):
+    share_id = create(run, sp)
+    other = create(run, sp)
+
+    async def scenario():
+        params = {"share_id": share_id}
+        async with client.get("/events", params=params) as resp:
+            assert resp.headers["Content-Type"].startswith("text/event-stream")
+            sp.share_events.publish(other, "stopped")
+            for count in (1, 2, 3):
+                sp.share_events.publish(share_id, "downloaded", download_count=count)
+            live = await read_events(resp, 3)
+
+        # Reconnecting after the first event replays only the ones after it
+        headers = {"Last-Event-ID": live[0][0]}
+        async with client.get("/events", params=params, headers=headers) as resp:
+            replayed = await read_events(resp, 2)
+
+        # An ID from another epoch (a restart) replays nothing
+        headers = {"Last-Event-ID": "00000000-1"}
+        async with client.get("/events", params=params, headers=headers) as resp:
+            sp.share_events.publish(share_id, "stopped")
+            fresh = await read_events(resp, 1)
+        return live, replayed, fresh
+
+    live, replayed, fresh = run(scenario())
+    assert [event for _, event, _ in live] == ["share"] * 3
+    assert [data["share_id"] for _, _, data in live] == [share_id] * 3
+    assert [data["download_count"] for _, _, data in live] == [1, 2, 3]
+    assert replayed == live[1:]
+    assert [data["state"] for _, _, data in fresh] == ["stopped"]
+
+
+@pytest.mark.parametrize("path", ["/events", "/stats", "/metrics"])
+def test_local_routes_are_refused_through_tor_and_to_other_hosts(
+    run, client, sp, monkeypatch, path
+):
+    async def status():
+        async with client.get(path) as resp:
+            return resp.status
+
+    if path != "/events":
+        assert run(status()) == 200
+    # Tor forwards to ONION_PORT, from loopback like the desktop UI
+    monkeypatch.setattr(sp, "ONION_PORT", client.port)
+    assert run(status()) == 403
+    monkeypatch.undo()
+
+    remote = ipaddress.ip_address("203.0.113.7")
+    monkeypatch.setattr(sp, "peer_address", lambda request: remote)
+    assert run(status()) == 403
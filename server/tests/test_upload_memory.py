@@ -0,0 +1,69 @@
+"""Uploads are encrypted and added to IPFS as they arrive: the memory they
+take is bounded by the upload window, not by the size of the file."""
+
+import itertools
+import os
+import tracemalloc
+
+import aiohttp
+import pytest
+
+MiB = 1024 * 1024
+# Set DFS_TEST_UPLOAD_BYTES (e.g. 4294967296) for a multi-GB run
+UPLOAD_BYTES = int(os.environ.get("DFS_TEST_UPLOAD_BYTES", 256 * MiB))
+CHUNK = MiB
+# Upload window, crypto batches, compression frames and socket buffers: a few
+# times what a run takes (about 10 MiB), a fraction of the upload itself
+PEAK_LIMIT = 32 * MiB
+
+
+def random_chunks():
+    while True:
+        yield os.urandom(CHUNK)
+
+
+def text_chunks():
+    # Compressible, so the upload also goes through the frame compressor
+    lines = b"".join(
+        f"{i:06d} GET /download/{i % 97} 200 {i * 7919 % 65536}\n".encode()
+        for i in range(CHUNK // 32)
+    )
+    for n in itertools.count():
+        header = f"chunk {n}\n".encode()
+        yield header + lines[: CHUNK - len(header)]
+
+
+async def generate(chunks, size):
+    sent = 0
+    for chunk in chunks:
+        chunk = chunk[: size - sent]
+        yield chunk
+        sent += len(chunk)
+        if sent >= size:
+            return
+
+
+@pytest.mark.parametrize("chunks", [random_chunks, text_chunks])
+def test_streamed_upload_memory_is_bounded(run, client, ipfs, sp, chunks):
+    async def scenario():
+        with aiohttp.MultipartWriter("form-data") as writer:
+            part = writer.append(generate(chunks(), UPLOAD_BYTES))
+            part.set_content_disposition("form-data", name="files", filename="big.log")
+            tracemalloc.start()
+            try:
+                async with client.post("/upload", data=writer) as resp:
+                    body = await resp.json()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        assert resp.status == 200, body
+        return body["share_links"][0]["share_id"], peak
+
+    ipfs.keep = False
+    try:
+        share_id, peak = run(scenario())
+    finally:
+        ipfs.keep = True
+    metadata = run(sp.share_metadata.get_metadata(share_id))
+    assert metadata["size"] == UPLOAD_BYTES
+    assert peak < PEAK_LIMIT, f"{peak / MiB:.1f} MiB traced for a {UPLOAD_BYTES} byte upload"
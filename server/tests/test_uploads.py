@@ -0,0 +1,71 @@
+"""The upload API as existing callers use it"""
+
+import io
+import zipfile
+
+import aiohttp
+
+
+def text(size):
+    line = b"2026-10-16 12:00:00 GET /download/abc 200 1048576 bytes\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def test_several_files_without_zip_name_make_bundle_zip(
+    run, client, sp, ipfs, no_rate_limits
+):
+    # Compressible, so the first file is stored compressed until the second
+    # one shows it belongs to a bundle
+    files = {"notes.txt": text(3 * 1024 * 1024 + 17), "small.bin": b"\x00\x01" * 999}
+    first = files["notes.txt"]
+    assert sp.choose_compression("text/plain", first[: 64 * 1024], len(first))
+
+    async def scenario():
+        form = aiohttp.FormData()
+        for name, data in files.items():
+            form.add_field("files", data, filename=name, content_type="text/plain")
+        pinned = set(ipfs.pinned)
+        async with client.post("/upload", data=form) as resp:
+            assert resp.status == 200
+            link = (await resp.json())["share_links"][0]
+        async with client.get(f"/download/{link['share_id']}") as resp:
+            assert resp.status == 200
+            archive = await resp.read()
+        return link, archive, ipfs.pinned - pinned
+
+    link, archive, added = run(scenario())
+    assert link["filename"] == "bundle.zip"
+    assert link["files"] == list(files)
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert {name: zf.read(name) for name in zf.namelist()} == files
+    # The members and the manifest; the compressed copy of the first is gone
+    assert len(added) == 3
+
+
+def test_zip_name_archives_files_into_one_zip(run, client, no_rate_limits):
+    files = {
+        "notes.txt": ("text/plain", text(200_000), zipfile.ZIP_DEFLATED),
+        "photo.png": ("image/png", b"\x89PNG" + bytes(range(256)) * 400, 0),
+        "empty.txt": ("text/plain", b"", zipfile.ZIP_DEFLATED),
+    }
+
+    async def scenario():
+        form = aiohttp.FormData()
+        for name, (content_type, data, _) in files.items():
+            form.add_field("files", data, filename=name, content_type=content_type)
+        query = {"zip_name": "holiday"}
+        async with client.post("/upload", params=query, data=form) as resp:
+            assert resp.status == 200
+            link = (await resp.json())["share_links"][0]
+        async with client.get(f"/download/{link['share_id']}") as resp:
+            assert resp.headers["Content-Type"] == "application/zip"
+            return link, await resp.read()
+
+    link, archive = run(scenario())
+    assert link["filename"] == "holiday.zip"
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert [info.filename for info in infos] == list(files)
+        for info, (_, data, method) in zip(infos, files.values()):
+            assert (zf.read(info), info.compress_type) == (data, method)
@@ -0,0 +1,76 @@
+"""Downloads over WebRTC are opt-in and counted only once the peer confirms"""
+
+import asyncio
+import json
+import os
+
+import pytest
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+
+@pytest.fixture
+def rtc(sp, monkeypatch, no_rate_limits):
+    monkeypatch.setattr(sp, "RTC_ENABLED", True)
+    monkeypatch.setattr(sp, "RTC_CONNECT_TIMEOUT", 2)
+
+
+async def peer_download(client, share_id, ack):
+    """(messages, bytes received) of a data-channel download; without ack
+    the peer walks away once it has seen "meta", as a client timing out does"""
+    pc = RTCPeerConnection()
+    channel = pc.createDataChannel("file")
+    finished = asyncio.get_running_loop().create_future()
+    messages, received = [], bytearray()
+
+    @channel.on("message")
+    def on_message(message):
+        if isinstance(message, bytes):
+            received.extend(message)
+            return
+        message = json.loads(message)
+        messages.append(message["type"])
+        if message["type"] == "meta" and ack:
+            channel.send(json.dumps({"type": "ack"}))
+        elif message["type"] in ("meta", "done", "error") and not finished.done():
+            finished.set_result(None)
+
+    try:
+        await pc.setLocalDescription(await pc.createOffer())
+        offer = {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+        async with client.post(f"/signal/{share_id}", data=json.dumps(offer)) as resp:
+            assert resp.status == 200
+            answer = await resp.json()
+        await pc.setRemoteDescription(RTCSessionDescription(**answer))
+        await asyncio.wait_for(finished, 10)
+    finally:
+        await pc.close()
+    return messages, bytes(received)
+
+
+def test_signalling_is_off_by_default(run, client, upload, no_rate_limits):
+    async def scenario():
+        share_id = await upload(b"not over WebRTC")
+        async with client.post(f"/signal/{share_id}", data="{}") as resp:
+            return resp.status
+
+    assert run(scenario()) == 404
+
+
+def test_download_is_counted_only_once_the_peer_confirms(run, client, sp, upload, rtc):
+    data = os.urandom(200_000)
+
+    async def scenario():
+        share_id = await upload(data, max_downloads=2)
+        walked_away = await peer_download(client, share_id, ack=False)
+        # Give the server time to notice the peer is gone
+        await asyncio.sleep(sp.RTC_CONNECT_TIMEOUT + 0.5)
+        uncounted = await sp.share_metadata.get_metadata(share_id)
+        confirmed = await peer_download(client, share_id, ack=True)
+        counted = await sp.share_metadata.get_metadata(share_id)
+        return walked_away, uncounted, confirmed, counted
+
+    walked_away, uncounted, confirmed, counted = run(scenario())
+    assert walked_away == (["meta"], b"")
+    assert uncounted["download_count"] == 0
+    assert confirmed == (["meta", "session", "done"], data)
+    assert counted["download_count"] == 1
@@ -0,0 +1,131 @@
+"""ZipStream archives read back with zipfile"""
+
+import asyncio
+import io
+import itertools
+import os
+import zipfile
+import zlib
+
+TEXT = b"".join(b"line %d of a compressible text file\n" % i for i in range(20_000))
+
+
+def collect(out):
+    async def sink(data):
+        out.write(data)
+
+    return sink
+
+
+async def add(archive, name, data, content_type=None, chunk=64 * 1024):
+    member = await archive.open(name, content_type, data[:chunk])
+    for i in range(0, len(data), chunk):
+        await member.write(data[i : i + chunk])
+    await member.close()
+
+
+def test_mixed_members_round_trip(run, sp):
+    random_data = os.urandom(300_000)
+    png = b"\x89PNG" + os.urandom(50_000)
+    known = b"stored with its size and CRC known up front"
+    out = io.BytesIO()
+
+    async def scenario():
+        archive = sp.ZipStream(collect(out))
+        await add(archive, "notes.txt", TEXT, "text/plain")
+        await add(archive, "random.bin", random_data)
+        await add(archive, "picture.png", png, "image/png")
+        await add(archive, "empty.txt", b"", "text/plain")
+        member = await archive.open_stored("known.txt", len(known), zlib.crc32(known))
+        await member.write(known)
+        await member.close()
+        await add(archive, "dir/ünïcode.txt", TEXT[:1000], "text/plain")
+        await archive.close()
+
+    run(scenario())
+    expected = {
+        "notes.txt": (TEXT, zipfile.ZIP_DEFLATED),
+        "random.bin": (random_data, zipfile.ZIP_STORED),
+        "picture.png": (png, zipfile.ZIP_STORED),
+        "empty.txt": (b"", zipfile.ZIP_DEFLATED),
+        "known.txt": (known, zipfile.ZIP_STORED),
+        "dir/ünïcode.txt": (TEXT[:1000], zipfile.ZIP_DEFLATED),
+    }
+    with zipfile.ZipFile(out) as archive:
+        assert archive.testzip() is None
+        assert [info.filename for info in archive.infolist()] == list(expected)
+        for info in archive.infolist():
+            data, method = expected[info.filename]
+            assert info.compress_type == method
+            assert archive.read(info) == data
+        assert archive.getinfo("notes.txt").compress_size < len(TEXT) // 4
+
+
+def test_parallel_deflate_blocks_stay_in_order(run, sp, monkeypatch):
+    monkeypatch.setattr(sp, "CRYPTO_BATCH_SIZE", 16 * 1024)
+    monkeypatch.setattr(sp, "ZIP_PARALLEL_BLOCKS", 4)
+    blocks = itertools.count()
+    finished = []
+
+    async def slow_run(stage, fn, *args, size=None):
+        # Within each window of four, later blocks finish first
+        n = next(blocks)
+        await asyncio.sleep(0.005 * (3 - n % 4))
+        finished.append(n)
+        return fn(*args)
+
+    monkeypatch.setattr(sp.crypto_pool, "run", slow_run)
+    data = TEXT + os.urandom(20_000) + TEXT
+    out = io.BytesIO()
+
+    async def scenario():
+        archive = sp.ZipStream(collect(out))
+        await add(archive, "big.txt", data, "text/plain", chunk=5000)
+        await archive.close()
+
+    run(scenario())
+    assert len(finished) > 8
+    assert finished != sorted(finished)
+    with zipfile.ZipFile(out) as archive:
+        info = archive.getinfo("big.txt")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert archive.read(info) == data
+
+
+def test_zip64_past_4_gib(run, sp, tmp_path):
+    """A member over 4 GiB, and one whose offset is past 4 GiB"""
+    zeros = bytes(64 * 1024 * 1024)
+    big = 4 * 1024**3 + len(zeros)
+    small = b"after the first 4 GiB"
+    path = tmp_path / "big.zip"
+
+    async def scenario(f):
+        async def sink(data):
+            # Leave the zeros as a hole in a sparse file
+            if data is zeros:
+                f.seek(len(data), io.SEEK_CUR)
+            else:
+                f.write(data)
+
+        crc = 0
+        for _ in range(big // len(zeros)):
+            crc = zlib.crc32(zeros, crc)
+        archive = sp.ZipStream(sink)
+        member = await archive.open_stored("zeros.bin", big, crc)
+        for _ in range(big // len(zeros)):
+            await member.write(zeros)
+        await member.close()
+        member = await archive.open_stored("small.txt", len(small), zlib.crc32(small))
+        await member.write(small)
+        await member.close()
+        await archive.close()
+
+    with open(path, "wb") as f:
+        run(scenario(f))
+    sizes = [("zeros.bin", big), ("small.txt", len(small))]
+    assert os.path.getsize(path) == sp.ZipStream.stored_size(sizes)
+    with zipfile.ZipFile(path) as archive:
+        infos = archive.infolist()
+        assert [(info.filename, info.file_size) for info in infos] == sizes
+        assert infos[1].header_offset > 0xFFFFFFFF
+        assert archive.read("small.txt") == small
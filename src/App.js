@@ -1,7 +1,10 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { QRCodeCanvas } from 'qrcode.react';
 import './App.css';
 
+const RESUMABLE_THRESHOLD = 64 * 1024 * 1024; // bytes; larger single files use /uploads
+const RESUME_ATTEMPTS = 10; // consecutive failed chunks before giving up
+
 function App() {
   const [files, setFiles] = useState([]);
   const [fileStatuses, setFileStatuses] = useState({});
@@ -15,6 +18,7 @@ function App() {
   const [folderError, setFolderError] = useState(false);
   const [sortOrder, setSortOrder] = useState('desc');
   const [dateRange, setDateRange] = useState({ from: '', to: '' });
+  const historyRevision = useRef(null);
 
   const copyToClipboard = (text) => {
     navigator.clipboard.writeText(text)
@@ -23,62 +27,95 @@ function App() {
   };
 
   const [isOnline, setIsOnline] = useState(true);
+  // IPFS and Tor start in the background; uploads wait for both
+  const [waitingFor, setWaitingFor] = useState(['server']);
+  const serverReady = waitingFor.length === 0;
 
   useEffect(() => {
-    fetchHistory();
+    let timer;
+    const poll = async () => {
+      try {
+        const res = await fetch("http://localhost:5000/ready");
+        const { components } = await res.json();
+        const missing = Object.keys(components).filter(name => !components[name].ready);
+        setWaitingFor(missing);
+        if (res.ok) {
+          // History links carry the onion address, known only now
+          fetchHistoryRef.current();
+          return;
+        }
+      } catch {
+        setWaitingFor(['server']);
+      }
+      timer = setTimeout(poll, 1000);
+    };
+    poll();
+    return () => clearTimeout(timer);
   }, []);
 
+  useEffect(() => {
+    fetchHistory();
+  }, [sortOrder, dateRange]);
+
   const fetchHistory = async () => {
     try {
-      const res = await fetch("http://localhost:5000/history");
-      const data = await res.json();
-
-      const filtered = data.filter(item => {
-        if (!dateRange.from && !dateRange.to) return true;
-        const expires = new Date(item.expires_at * 1000);
-        const from = dateRange.from ? new Date(dateRange.from) : null;
-        const to = dateRange.to ? new Date(dateRange.to) : null;
-        return (!from || expires >= from) && (!to || expires <= to);
-      });
-
-      const sorted = [...filtered].sort((a, b) =>
-        sortOrder === 'asc'
-          ? a.expires_at - b.expires_at
-          : b.expires_at - a.expires_at
-      );
+      // Filtering and sorting happen server side; polls with an unchanged
+      // query send the last revision and get an empty 304 if nothing changed
+      const params = new URLSearchParams({ order: sortOrder });
+      if (dateRange.from) params.set('expires_after', new Date(dateRange.from).getTime() / 1000);
+      if (dateRange.to) params.set('expires_before', new Date(dateRange.to).getTime() / 1000);
+      const query = params.toString();
+      if (historyRevision.current && historyRevision.current.query === query) {
+        params.set('since', historyRevision.current.revision);
+      }
 
-      setHistory(sorted);
+      const res = await fetch(`http://localhost:5000/history?${params}`);
+      if (res.status === 304) return;
+      const data = await res.json();
+      historyRevision.current = { query, revision: res.headers.get('X-Revision') };
+      setHistory(data);
     } catch (err) {
       console.error("Failed to fetch history:", err);
     }
   };
+  const fetchHistoryRef = useRef(fetchHistory);
+  fetchHistoryRef.current = fetchHistory;
 
-  useEffect(() => {
-    const interval = setInterval(async () => {
-      if (shareData.length === 0) return;
+  const shareDataRef = useRef(shareData);
+  shareDataRef.current = shareData;
 
-      const checkStatus = async (shareId) => {
+  // Drop live shares as soon as the server reports them finished, instead of
+  // polling each one
+  useEffect(() => {
+    const resync = async () => {
+      const ids = shareDataRef.current.map(item => item.share_id);
+      if (ids.length > 0) {
         try {
-          const res = await fetch(`http://localhost:5000/status/${shareId}`);
-          const data = await res.json();
-          return data.active;
-        } catch {
-          return true;
+          const res = await fetch("http://localhost:5000/status", {
+            method: 'POST',
+            body: JSON.stringify({ share_ids: ids }),
+          });
+          const { statuses } = await res.json();
+          setShareData(prev => prev.filter(item => statuses[item.share_id]?.active !== false));
+        } catch (err) {
+          console.error("Failed to fetch share status:", err);
         }
-      };
-
-      const filtered = [];
-      for (const item of shareData) {
-        const isActive = await checkStatus(item.share_id);
-        if (isActive) filtered.push(item);
       }
+      fetchHistoryRef.current();
+    };
 
-      setShareData(filtered);
-      fetchHistory();
-    }, 10000);
+    const events = new EventSource("http://localhost:5000/events");
+    events.onopen = resync;
+    events.addEventListener('share', e => {
+      const { share_id, state } = JSON.parse(e.data);
+      if (state !== 'downloaded') {
+        setShareData(prev => prev.filter(item => item.share_id !== share_id));
+      }
+      fetchHistoryRef.current();
+    });
 
-    return () => clearInterval(interval);
-  }, [shareData]);
+    return () => events.close();
+  }, []);
 
   useEffect(() => {
     const checkConnectivity = async () => {
@@ -110,6 +147,44 @@ function App() {
     if (selected.length === 1) setZipName("bundle.zip");
   };
 
+  // Large single files go up in chunks that survive a dropped connection
+  const uploadResumable = async (file, shareId) => {
+    const base = 'http://localhost:5000/uploads';
+    const created = await fetch(`${base}?share_id=${shareId}&max_downloads=${maxDownloads}&filename=${encodeURIComponent(file.name)}&size=${file.size}&content_type=${encodeURIComponent(file.type || 'application/octet-stream')}`, { method: 'POST' });
+    const session = await created.json();
+    if (!created.ok) return { res: created, data: session };
+
+    let offset = 0;
+    let failures = 0;
+    while (offset < file.size) {
+      try {
+        // An untyped slice keeps this a simple request, no CORS preflight
+        const res = await fetch(`${base}/${session.session_id}?offset=${offset}`, {
+          method: 'POST',
+          body: file.slice(offset, offset + session.chunk_size),
+        });
+        const data = await res.json();
+        if (res.ok || res.status === 409) {
+          offset = data.offset;
+          failures = 0;
+        } else {
+          return { res, data };
+        }
+      } catch (err) {
+        if (++failures > RESUME_ATTEMPTS) throw err;
+        await new Promise(r => setTimeout(r, Math.min(30000, 1000 * 2 ** failures)));
+        try {
+          const status = await fetch(`${base}/${session.session_id}`);
+          if (status.ok) offset = (await status.json()).offset;
+        } catch (e) {
+          // Still offline, try again after the next delay
+        }
+      }
+    }
+    const res = await fetch(`${base}/${session.session_id}/finalize`, { method: 'POST' });
+    return { res, data: await res.json() };
+  };
+
   const handleUpload = async () => {
     if (files.length === 0) return;
 
@@ -145,9 +220,24 @@ function App() {
         };
       });
 
-      const url = `http://localhost:5000/upload?share_id=${shareId}&max_downloads=${maxDownloads}${bundled ? `&zip_name=${encodeURIComponent(zipName)}` : ''}`;
-      const res = await fetch(url, { method: 'POST', body: formData });
-      const data = await res.json();
+      // Re-sharing a file the server already stores only needs its digest
+      const digests = JSON.parse(localStorage.getItem('contentDigests') || '{}');
+      const fileKey = bundled ? null : `${files[0].name}:${files[0].size}:${files[0].lastModified}`;
+      const knownDigest = fileKey && digests[fileKey];
+
+      let res, data;
+      if (!bundled && !knownDigest && files[0].size >= RESUMABLE_THRESHOLD) {
+        ({ res, data } = await uploadResumable(files[0], shareId));
+      } else {
+        const url = `http://localhost:5000/upload?share_id=${shareId}&max_downloads=${maxDownloads}${bundled ? `&zip_name=${encodeURIComponent(zipName)}&mode=bundle` : ''}${knownDigest ? `&sha256=${knownDigest}` : ''}`;
+        res = await fetch(url, { method: 'POST', body: formData });
+        data = await res.json();
+      }
+
+      if (fileKey && res.ok && data.share_links?.[0]?.sha256) {
+        digests[fileKey] = data.share_links[0].sha256;
+        localStorage.setItem('contentDigests', JSON.stringify(digests));
+      }
 
       if (res.ok && Array.isArray(data.share_links)) {
         setShareData(prev => [...prev, ...data.share_links.map(link => ({ ...link, filename: displayFilename }))]);
@@ -213,6 +303,18 @@ function App() {
               ⚠️ No internet connection detected. Some features like Tor or IPFS may be limited.
             </div>
           )}
+          {!serverReady && (
+            <div style={{
+              backgroundColor: '#0b0f2b',
+              color: '#fff',
+              padding: '1rem',
+              borderRadius: '8px',
+              marginBottom: '1rem',
+              textAlign: 'center'
+            }}>
+              ⏳ Starting {waitingFor.join(' and ')}… uploads are enabled once connected.
+            </div>
+          )}
           <div
             onClick={() => document.getElementById('fileInput').click()}
             onDragOver={(e) => e.preventDefault()}
@@ -308,7 +410,7 @@ function App() {
 
           <button
             onClick={handleUpload}
-            disabled={isUploading || files.length === 0}
+            disabled={isUploading || files.length === 0 || !serverReady}
             style={{
               marginTop: '1rem',
               padding: '10px 20px',
@@ -430,8 +532,9 @@ function App() {
                 <div key={item.share_id} style={{ backgroundColor: '#fff', color: '#000', borderRadius: '12px', padding: '1rem', marginBottom: '1rem' }}>
                   <strong>{item.filename}</strong><br />
                   <div style={{ display: 'flex', alignItems: 'center', gap: '10px', flexWrap: 'wrap' }}>
-                    <a href={item.share_link} target="_blank" rel="noreferrer">{item.share_link}</a>
+                    <a href={item.share_link || undefined} target="_blank" rel="noreferrer">{item.share_link || 'Link available once Tor is connected'}</a>
                     <button
+                      disabled={!item.share_link}
                       onClick={() => copyToClipboard(item.share_link)}
                       style={{
                         padding: '6px 10px',
@@ -1,42 +1,145 @@
 import React, { useState, useEffect } from 'react';
 import { useParams } from 'react-router-dom';
 
+const SERVER = 'http://localhost:5000';
+// How long the direct connection may take before falling back to HTTP. Matches
+// RTC_CONNECT_TIMEOUT on the server, which only counts the download once we
+// confirm its "meta" message in time.
+const PEER_CONNECT_TIMEOUT = 10000;
+
+// Resolves once the offer holds all our candidates (the server does not trickle)
+function iceGatheringComplete(pc) {
+    if (pc.iceGatheringState === 'complete') return Promise.resolve();
+    return new Promise((resolve) => {
+        pc.addEventListener('icegatheringstatechange', () => {
+            if (pc.iceGatheringState === 'complete') resolve();
+        });
+    });
+}
+
+// Download over a WebRTC data channel, if the server has them enabled. Rejects
+// with err.session set once the download has been counted, so the HTTP
+// fallback is not counted again.
+async function downloadPeer(shareId, onProgress) {
+    if (typeof RTCPeerConnection === 'undefined') throw new Error('WebRTC unavailable');
+    // Starts before the server's, so we always give up first
+    const deadline = Date.now() + PEER_CONNECT_TIMEOUT;
+    const pc = new RTCPeerConnection();
+    const channel = pc.createDataChannel('file');
+    channel.binaryType = 'arraybuffer';
+    try {
+        await pc.setLocalDescription(await pc.createOffer());
+        await iceGatheringComplete(pc);
+        const res = await fetch(`${SERVER}/signal/${shareId}`, {
+            method: 'POST',
+            // text/plain skips the CORS preflight
+            headers: { 'Content-Type': 'text/plain' },
+            body: JSON.stringify(pc.localDescription),
+        });
+        if (!res.ok) throw new Error(`Signalling failed (${res.status})`);
+        await pc.setRemoteDescription(await res.json());
+
+        return await new Promise((resolve, reject) => {
+            let meta = null;
+            let session = null;
+            let timedOut = false;
+            const chunks = [];
+            let received = 0;
+            const fail = (message) => {
+                const err = new Error(message);
+                if (session) err.session = session;
+                reject(err);
+            };
+            const timer = setTimeout(() => {
+                timedOut = true;
+                fail('Peer connection timed out');
+            }, deadline - Date.now());
+            channel.onmessage = ({ data }) => {
+                if (typeof data !== 'string') {
+                    chunks.push(data);
+                    received += data.byteLength;
+                    onProgress(received);
+                    return;
+                }
+                const message = JSON.parse(data);
+                if (message.type === 'meta') {
+                    // Too late: we are falling back to HTTP, which counts instead
+                    if (timedOut) return;
+                    clearTimeout(timer);
+                    meta = message;
+                    channel.send(JSON.stringify({ type: 'ack' }));
+                } else if (message.type === 'session') {
+                    session = message.session;
+                } else if (message.type === 'done') {
+                    resolve({
+                        filename: meta.filename,
+                        blob: new Blob(chunks, { type: meta.content_type }),
+                    });
+                } else if (message.type === 'error') {
+                    clearTimeout(timer);
+                    fail(message.error);
+                }
+            };
+            channel.onclose = () => fail('Peer connection closed');
+            pc.onconnectionstatechange = () => {
+                if (pc.connectionState === 'failed') fail('Peer connection failed');
+            };
+        });
+    } finally {
+        pc.close();
+    }
+}
+
+async function downloadHttp(shareId, session, onProgress) {
+    const query = session ? `?session=${encodeURIComponent(session)}` : '';
+    // A counted download's session only carries ranged requests
+    const headers = session ? { Range: 'bytes=0-' } : {};
+    const res = await fetch(`${SERVER}/download/${shareId}${query}`, { headers });
+    if (!res.ok) throw new Error('Invalid or expired link');
+
+    const disposition = res.headers.get('Content-Disposition');
+    const filenameMatch = /filename="(.+?)"/.exec(disposition);
+    const filename = filenameMatch ? filenameMatch[1] : 'downloaded_file';
+
+    const contentType = res.headers.get('Content-Type') || 'application/octet-stream';
+
+    const stream = res.body;
+    const reader = stream.getReader();
+    const chunks = [];
+    let receivedLength = 0;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        chunks.push(value);
+        receivedLength += value.length;
+        onProgress(receivedLength);
+    }
+
+    return { filename, blob: new Blob(chunks, { type: contentType }) };
+}
+
 function Download() {
     const [status, setStatus] = useState('Loading...');
     const { shareId } = useParams();
 
     useEffect(() => {
         const downloadFile = async () => {
+            const onProgress = (received) => console.log(`Downloaded ${received} bytes...`);
             try {
-                const res = await fetch(`http://localhost:5000/download/${shareId}`);
-                if (!res.ok) throw new Error('Invalid or expired link');
-
-                const disposition = res.headers.get('Content-Disposition');
-                const filenameMatch = /filename="(.+?)"/.exec(disposition);
-                const filename = filenameMatch ? filenameMatch[1] : 'downloaded_file';
-
-                const contentType = res.headers.get('Content-Type') || 'application/octet-stream';
-
-                const stream = res.body;
-                const reader = stream.getReader();
-                const chunks = [];
-                let receivedLength = 0;
-
-                while (true) {
-                    const { done, value } = await reader.read();
-                    if (done) break;
-                    chunks.push(value);
-                    receivedLength += value.length;
-                    console.log(`Downloaded ${receivedLength} bytes...`);
+                let result;
+                try {
+                    result = await downloadPeer(shareId, onProgress);
+                } catch (err) {
+                    console.log(`Direct transfer unavailable (${err.message}), using HTTP`);
+                    result = await downloadHttp(shareId, err.session, onProgress);
                 }
 
-
-                const blob = new Blob(chunks, { type: contentType });
-                const url = URL.createObjectURL(blob);
+                const url = URL.createObjectURL(result.blob);
 
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = filename;
+                a.download = result.filename;
                 a.click();
 
                 URL.revokeObjectURL(url);